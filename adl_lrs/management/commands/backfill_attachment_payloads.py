@@ -0,0 +1,45 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from lrs.models import AttachmentPayload, StatementAttachment, attachment_storage, get_payload_path
+
+
+class Command(BaseCommand):
+    help = 'Moves attachment payloads stored before the sharded store into it and recounts the references ' \
+        'to every payload'
+
+    def handle(self, *args, **options):
+        names = StatementAttachment.objects.exclude(payload='').exclude(payload__isnull=True) \
+            .values_list('payload', flat=True).distinct()
+        moved = 0
+        for name in list(names):
+            sha2 = os.path.basename(name)
+            path = get_payload_path(sha2)
+            if name == path:
+                continue
+            if attachment_storage.exists(name):
+                if attachment_storage.exists(path):
+                    attachment_storage.delete(name)
+                else:
+                    os.makedirs(os.path.dirname(attachment_storage.path(path)), exist_ok=True)
+                    os.replace(attachment_storage.path(name), attachment_storage.path(path))
+            StatementAttachment.objects.filter(payload=name).update(payload=path)
+            moved += 1
+        self.stdout.write("Moved %d payloads into the sharded store\n" % moved)
+
+        counts = dict(StatementAttachment.objects.exclude(payload='').exclude(payload__isnull=True)
+                      .values_list('payload').annotate(count=Count('id')).order_by())
+        rows = {os.path.basename(name): count for name, count in counts.items()}
+        with transaction.atomic():
+            AttachmentPayload.objects.bulk_create([AttachmentPayload(sha2=sha2) for sha2 in rows], ignore_conflicts=True)
+            payloads = list(AttachmentPayload.objects.select_for_update())
+            for payload in payloads:
+                payload.ref_count = rows.get(payload.sha2, 0)
+                path = get_payload_path(payload.sha2)
+                if not payload.size and attachment_storage.exists(path):
+                    payload.size = attachment_storage.size(path)
+            AttachmentPayload.objects.bulk_update(payloads, ['ref_count', 'size'], batch_size=1000)
+        self.stdout.write("Successfully counted the references to %d payloads\n" % len(payloads))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lrs.models import Statement, StatementActivity
+
+CONTEXT_FIELDS = ['context_ca_' + r for r in StatementActivity.CONTEXT_RELATIONS]
+
+
+def get_context_activities(stmt):
+    return [(relation, act) for relation, field in zip(StatementActivity.CONTEXT_RELATIONS, CONTEXT_FIELDS)
+            for act in getattr(stmt, field).all()]
+
+
+class Command(BaseCommand):
+    help = 'Fills the statement activity index used by the activity filters for statements stored before it existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Statements indexed per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_pk = 0
+        total = 0
+        while True:
+            stmts = list(Statement.objects.select_related('object_substatement')
+                         .only('object_activity', 'object_substatement', 'object_substatement__object_activity')
+                         .prefetch_related(*CONTEXT_FIELDS, *('object_substatement__' + f for f in CONTEXT_FIELDS))
+                         .filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not stmts:
+                break
+            rows = []
+            for stmt in stmts:
+                sub = stmt.object_substatement
+                rows.extend(StatementActivity.for_statement(stmt, get_context_activities(stmt),
+                                                            get_context_activities(sub) if sub else []))
+            with transaction.atomic():
+                # Rows that are already there are left alone so it can be run again
+                StatementActivity.objects.bulk_create(rows, ignore_conflicts=True)
+            last_pk = stmts[-1].pk
+            total += len(stmts)
+            self.stdout.write("Indexed activities of %d statements\n" % total)
+
+        self.stdout.write("Successfully filled the statement activity index\n")
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lrs.models import Statement, StatementAgent
+
+# Only the foreign keys StatementAgent.for_statement reads
+SUBSTATEMENT_AGENT_FIELDS = ['actor', 'object_agent', 'context_instructor', 'context_team']
+AGENT_FIELDS = SUBSTATEMENT_AGENT_FIELDS + ['authority', 'object_substatement'] + \
+    ['object_substatement__' + f for f in SUBSTATEMENT_AGENT_FIELDS]
+
+
+class Command(BaseCommand):
+    help = 'Fills the statement agent index used by the agent filters for statements stored before it existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Statements indexed per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_pk = 0
+        total = 0
+        while True:
+            stmts = list(Statement.objects.select_related('object_substatement')
+                         .only(*AGENT_FIELDS)
+                         .filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not stmts:
+                break
+            with transaction.atomic():
+                # Rows that are already there are left alone so it can be run again
+                StatementAgent.objects.bulk_create([row for stmt in stmts for row in StatementAgent.for_statement(stmt)],
+                                                   ignore_conflicts=True)
+            last_pk = stmts[-1].pk
+            total += len(stmts)
+            self.stdout.write("Indexed agents of %d statements\n" % total)
+
+        self.stdout.write("Successfully filled the statement agent index\n")
@@ -0,0 +1,92 @@
+import base64
+import json
+import statistics
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.urls import reverse
+
+from lrs.models import Activity, Agent, Statement
+from lrs.utils.lookup_cache import clear_lookup_caches
+from lrs.utils.req_process import process_body
+from lrs.views import dispatch_request
+
+
+class Command(BaseCommand):
+    help = 'Compares GET throughput of the xAPI endpoints run in a transaction, as they used to be, and in ' \
+        'autocommit, the data is committed so the transactions are real and deleted afterwards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--statements', type=int, default=1000, help='Number of statements to load')
+        parser.add_argument('--requests', type=int, default=200, help='Requests sent to each endpoint in each mode')
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:8]
+        password = uuid.uuid4().hex
+        user = User.objects.create_user('benchmark-%s' % tag, 'benchmark@example.com', password)
+        try:
+            acts = 'http://example.com/activities/benchmark-%s/' % tag
+            with transaction.atomic():
+                self.load(user, acts, options['statements'])
+            auth = 'Basic ' + base64.b64encode(('%s:%s' % (user.username, password)).encode()).decode()
+            agent = json.dumps({'mbox': 'mailto:learner0@example.com'})
+            endpoints = [('statements', reverse('lrs:statements'), {'limit': 10}),
+                         ('statements verb', reverse('lrs:statements'),
+                          {'verb': 'http://example.com/verbs/1', 'limit': 10}),
+                         ('activities', reverse('lrs:activities'), {'activityId': acts + '1'}),
+                         ('agents', reverse('lrs:agents'), {'agent': agent})]
+            self.stdout.write("%s backend, %d requests per endpoint\n" % (connection.vendor, options['requests']))
+            self.stdout.write("endpoint         atomic req/s  autocommit req/s  change\n")
+            factory = RequestFactory()
+            for name, path, params in endpoints:
+                # Neither mode gets to fill the caches for the other
+                self.run(factory, path, params, auth, 10, False)
+                rates = [self.run(factory, path, params, auth, options['requests'], atomic)
+                         for atomic in [True, False]]
+                self.stdout.write("%-16s %12.0f  %16.0f  %+.1f%%\n" % (name, rates[0], rates[1],
+                                                                     (rates[1] / rates[0] - 1) * 100))
+        finally:
+            self.clean(user, tag)
+
+    def load(self, user, acts, count):
+        authority = Agent.objects.retrieve_or_create(mbox='mailto:benchmark@example.com')[0]
+        auth = {'agent': authority, 'user': user, 'define': True}
+        stmts = [{'actor': {'mbox': 'mailto:learner%d@example.com' % (i % 50), 'name': 'Learner %d' % (i % 50)},
+                  'verb': {'id': 'http://example.com/verbs/%d' % (i % 5), 'display': {'en-US': 'verb %d' % (i % 5)}},
+                  'object': {'id': acts + str(i % 200),
+                             'definition': {'name': {'en-US': 'Activity %d' % (i % 200)}}}}
+                 for i in range(count)]
+        for offset in range(0, count, 100):
+            process_body(stmts[offset:offset + 100], auth, None)
+
+    def run(self, factory, path, params, auth, count, atomic):
+        times = []
+        for _ in range(count):
+            request = factory.get(path, params, HTTP_AUTHORIZATION=auth,
+                                  HTTP_X_EXPERIENCE_API_VERSION=settings.XAPI_VERSIONS[0])
+            start = time.perf_counter()
+            if atomic:
+                with transaction.atomic():
+                    response = dispatch_request(request)
+            else:
+                response = dispatch_request(request)
+            if response.status_code != 200:
+                raise Exception("%s returned %s: %s" % (path, response.status_code, response.content[:200]))
+            # Streamed pages are read in the request's time too
+            if response.streaming:
+                b''.join(response.streaming_content)
+            times.append(time.perf_counter() - start)
+        return 1 / statistics.median(times)
+
+    def clean(self, user, tag):
+        with transaction.atomic():
+            Statement.objects.filter(user=user).delete()
+            Activity.objects.filter(activity_id__startswith='http://example.com/activities/benchmark-%s/' % tag).delete()
+            user.delete()
+        # Rows the lookup caches hold were deleted
+        clear_lookup_caches()
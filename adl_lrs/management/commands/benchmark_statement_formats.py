@@ -0,0 +1,85 @@
+import statistics
+import time
+import tracemalloc
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from lrs.models import Agent, Statement
+from lrs.utils.lookup_cache import clear_lookup_caches
+from lrs.utils.req_process import process_body
+from lrs.utils.retrieve_statement import CONTEXT_ACTIVITY_PREFETCH, project_stmt_format
+
+FORMATS = ['exact', 'ids', 'canonical']
+# Relations every format read before the projections
+FULL_RELATED = ['actor', 'verb', 'context_team', 'context_instructor', 'authority', 'object_agent', 'object_activity',
+                'object_substatement']
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Times reading and rendering a page of statements in each format, with and without the format ' \
+        'projection, the data is created in a transaction that is rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--statements', type=int, default=1000, help='Number of statements to load')
+        parser.add_argument('--limit', type=int, default=100, help='Statements per page')
+        parser.add_argument('--runs', type=int, default=10, help='Times each page is read')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.load(options['statements'])
+                self.stdout.write("%s backend, %d statements per page\n" % (connection.vendor, options['limit']))
+                self.stdout.write("format     query      queries  ms     peak KB\n")
+                for stmt_format in FORMATS:
+                    for name, stmtset in [('full', self.full_queryset()),
+                                          ('projected', project_stmt_format(Statement.objects.all(), stmt_format))]:
+                        self.run(stmt_format, name, stmtset, options['limit'], options['runs'])
+                raise Rollback()
+        except Rollback:
+            # Rows cached while loading the data were rolled back
+            clear_lookup_caches()
+
+    def load(self, count):
+        user = User.objects.create_user('benchmark-%s' % uuid.uuid4().hex[:8], 'benchmark@example.com', 'benchmark')
+        authority = Agent.objects.retrieve_or_create(mbox='mailto:benchmark@example.com')[0]
+        auth = {'agent': authority, 'user': user, 'define': True}
+        acts = 'http://example.com/activities/benchmark/'
+        stmts = [{'actor': {'mbox': 'mailto:learner%d@example.com' % (i % 50), 'name': 'Learner %d' % (i % 50)},
+                  'verb': {'id': 'http://example.com/verbs/%d' % (i % 5), 'display': {'en-US': 'verb %d' % (i % 5)}},
+                  'object': {'id': acts + str(i % 200),
+                             'definition': {'name': {'en-US': 'Activity %d' % (i % 200)},
+                                            'description': {'en-US': 'Description of activity %d' % (i % 200)}}},
+                  'result': {'score': {'scaled': 0.5}, 'completion': True},
+                  'context': {'contextActivities': {'parent': [{'id': acts + 'parent/%d' % (i % 10)}],
+                                                    'grouping': [{'id': acts + 'course'}]}}}
+                 for i in range(count)]
+        start = time.time()
+        for offset in range(0, count, 100):
+            process_body(stmts[offset:offset + 100], auth, None)
+        self.stdout.write("Loaded %d statements in %.1fs\n" % (count, time.time() - start))
+
+    def full_queryset(self):
+        return Statement.objects.select_related(*FULL_RELATED).prefetch_related(*CONTEXT_ACTIVITY_PREFETCH)
+
+    def run(self, stmt_format, name, stmtset, limit, runs):
+        times = []
+        peak = 0
+        for _ in range(runs):
+            tracemalloc.start()
+            start = time.time()
+            with CaptureQueriesContext(connection) as ctx:
+                [stmt.to_dict([settings.LANGUAGE_CODE], stmt_format) for stmt in stmtset.order_by('-stored', '-id')[:limit]]
+            times.append((time.time() - start) * 1000)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        self.stdout.write("%-10s %-10s %7d  %-6.1f %d\n" % (stmt_format, name, len(ctx.captured_queries),
+                                                           statistics.median(times), peak // 1024))
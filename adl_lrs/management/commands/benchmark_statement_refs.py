@@ -0,0 +1,62 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from lrs.models import Agent, Statement, Verb
+from lrs.utils.lookup_cache import clear_lookup_caches
+from lrs.utils.retrieve_statement import stmt_ref_search
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Times the StatementRef search for a verb filter against chains of growing depth, ' \
+        'the data is created in a transaction that is rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depths', default='1,2,4,8', help='Comma separated chain depths to run')
+        parser.add_argument('--chains', type=int, default=10, help='Number of chains for each depth')
+
+    def handle(self, *args, **options):
+        depths = [int(d) for d in options['depths'].split(',')]
+        self.stdout.write("%s backend\n" % connection.vendor)
+        self.stdout.write("depth  statements  queries  ms\n")
+        for depth in depths:
+            try:
+                with transaction.atomic():
+                    self.run(depth, options['chains'])
+                    raise Rollback()
+            except Rollback:
+                # Rows cached while creating the data were rolled back
+                clear_lookup_caches()
+
+    def run(self, depth, chains):
+        actor = Agent.objects.retrieve_or_create(mbox='mailto:benchmark@example.com')[0]
+        verb = Verb.objects.get_or_create(verb_id='http://example.com/verbs/benchmark-%s' % uuid.uuid4())[0]
+        ref_verb = Verb.objects.get_or_create(verb_id='http://example.com/verbs/benchmark-ref')[0]
+        for _ in range(chains):
+            target = self.create_statement(actor, verb)
+            for _ in range(depth):
+                target = self.create_statement(actor, ref_verb, target)
+
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.time()
+            found = Statement.objects.filter(
+                statement_id__in=stmt_ref_search(Statement.objects.filter(verb=verb), None, None)).count()
+            elapsed = (time.time() - start) * 1000
+        self.stdout.write("%5d  %10d  %7d  %.1f\n" % (depth, found, len(ctx.captured_queries), elapsed))
+
+    def create_statement(self, actor, verb, target=None):
+        stmt_id = uuid.uuid4()
+        full_statement = {'id': str(stmt_id), 'actor': actor.to_dict(), 'verb': {'id': verb.verb_id}}
+        if target:
+            full_statement['object'] = {'objectType': 'StatementRef', 'id': str(target.statement_id)}
+        return Statement.objects.create(statement_id=stmt_id, actor=actor, verb=verb,
+                                        object_statementref=target.statement_id if target else None,
+                                        timestamp=timezone.now(), full_statement=full_statement)
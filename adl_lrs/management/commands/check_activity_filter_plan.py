@@ -0,0 +1,89 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from lrs.models import Activity, Agent, Statement, StatementActivity, Verb
+from lrs.utils.lookup_cache import clear_lookup_caches
+from lrs.utils.retrieve_statement import complex_get
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Loads a large set of statements in a transaction that is rolled back, then checks the plan ' \
+        'of a related_activities statement query uses the statement activity index instead of scanning'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--statements', type=int, default=1000000, help='Number of statements to load')
+        parser.add_argument('--activities', type=int, default=1000, help='Number of distinct activities')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Statements inserted per query')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                activity_id = self.load(options['statements'], options['activities'], options['batch_size'])
+                plans = self.explain(activity_id)
+                raise Rollback()
+        except Rollback:
+            # Rows cached while loading the data were rolled back
+            clear_lookup_caches()
+
+        for plan in plans:
+            self.stdout.write(plan + "\n")
+        if connection.vendor != 'postgresql':
+            self.stdout.write("Plans are only checked on PostgreSQL, %s plans are printed as is\n" % connection.vendor)
+            return
+        for table in [Statement._meta.db_table, StatementActivity._meta.db_table]:
+            if any('Seq Scan on %s' % table in plan for plan in plans):
+                raise CommandError("Statement query scans all of %s" % table)
+        self.stdout.write("Statement activity filter plan uses indexes\n")
+
+    def load(self, statement_count, activity_count, batch_size):
+        actor = Agent.objects.retrieve_or_create(mbox='mailto:plancheck@example.com')[0]
+        verb = Verb.objects.get_or_create(verb_id='http://example.com/verbs/plancheck')[0]
+        prefix = 'http://example.com/activities/plancheck-%s/' % uuid.uuid4()
+        Activity.objects.bulk_create([Activity(activity_id=prefix + str(i)) for i in range(activity_count)])
+        activities = list(Activity.objects.filter(activity_id__startswith=prefix).order_by('pk'))
+
+        start = time.time()
+        for offset in range(0, statement_count, batch_size):
+            count = min(batch_size, statement_count - offset)
+            last_pk = Statement.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+            Statement.objects.bulk_create([Statement(actor=actor, verb=verb, timestamp=timezone.now(), full_statement={},
+                                                     object_activity=activities[(offset + i) % activity_count])
+                                           for i in range(count)])
+            rows = []
+            for i, pk in enumerate(Statement.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)):
+                rows.append(StatementActivity(statement_id=pk, activity=activities[(offset + i) % activity_count],
+                                              relation='object'))
+                rows.append(StatementActivity(statement_id=pk, activity=activities[(offset + i) * 7 % activity_count],
+                                              relation='parent'))
+            StatementActivity.objects.bulk_create(rows)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE %s' % Statement._meta.db_table)
+                cursor.execute('ANALYZE %s' % StatementActivity._meta.db_table)
+        self.stdout.write("Loaded %d statements in %.1fs\n" % (statement_count, time.time() - start))
+        return activities[0].activity_id
+
+    def explain(self, activity_id):
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.time()
+            complex_get({'activity': activity_id, 'related_activities': True}, None, None, 'ids', False)
+            self.stdout.write("Query took %.1fms\n" % ((time.time() - start) * 1000))
+
+        # Plans of the queries that read statements
+        plans = []
+        explain = 'EXPLAIN ANALYZE ' if connection.vendor == 'postgresql' else 'EXPLAIN QUERY PLAN '
+        with connection.cursor() as cursor:
+            for query in ctx.captured_queries:
+                if query['sql'].startswith('SELECT') and 'FROM "%s"' % Statement._meta.db_table in query['sql']:
+                    cursor.execute(explain + query['sql'])
+                    plans.append("\n".join(" ".join(str(c) for c in row) for row in cursor.fetchall()))
+        return plans
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from adl_lrs.models import HookDelivery, HookDeadLetter
+from lrs.utils.hook_delivery import deliver
+
+
+class Command(BaseCommand):
+    help = 'Sends every queued hook delivery that is due, including ones whose task was lost'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requeue-dead', action='store_true',
+                            help='Moves dead lettered deliveries back into the queue first')
+
+    def handle(self, *args, **options):
+        if options['requeue_dead']:
+            with transaction.atomic():
+                dead = list(HookDeadLetter.objects.select_for_update(skip_locked=True).order_by('pk'))
+                HookDelivery.objects.bulk_create([HookDelivery(
+                    hook_id=d.hook_id, statements=d.statements, created_at=d.created_at) for d in dead])
+                HookDeadLetter.objects.filter(pk__in=[d.pk for d in dead]).delete()
+            self.stdout.write("Requeued %d dead lettered deliveries\n" % len(dead))
+
+        hook_ids = list(HookDelivery.objects.filter(next_attempt__lte=timezone.now()).values_list(
+            'hook_id', flat=True).distinct())
+        failed = 0
+        for hook_id in hook_ids:
+            if deliver(hook_id) is not None:
+                failed += 1
+        queued = HookDelivery.objects.count()
+        self.stdout.write("Delivered to %d of %d hooks, %d deliveries still queued, %d dead lettered\n" % (
+            len(hook_ids) - failed, len(hook_ids), queued, HookDeadLetter.objects.count()))
@@ -0,0 +1,54 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from lrs.models import AttachmentPayload, attachment_storage, get_payload_path
+
+
+class Command(BaseCommand):
+    help = 'Deletes attachment payloads that no statement has referenced for a while'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=24,
+                            help='Hours a payload has to have been unreferenced before it is deleted')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Payloads deleted per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+
+    def handle(self, *args, **options):
+        # The age leaves statements that are still being stored time to
+        # take a reference to a payload they are reusing
+        cutoff = timezone.now() - timedelta(hours=options['min_age'])
+        unreferenced = AttachmentPayload.objects.filter(ref_count=0, updated__lt=cutoff)
+        if options['dry_run']:
+            self.stdout.write("%d unreferenced payloads would be deleted\n" % unreferenced.count())
+            return
+
+        total = 0
+        freed = 0
+        while True:
+            with transaction.atomic():
+                payloads = list(unreferenced.select_for_update(skip_locked=True).order_by('pk')
+                                [:options['batch_size']])
+                if not payloads:
+                    break
+                # Still unreferenced now the rows are locked
+                unreferenced_pks = set(AttachmentPayload.objects.filter(
+                    pk__in=[p.pk for p in payloads], ref_count=0).values_list('pk', flat=True))
+                payloads = [p for p in payloads if p.pk in unreferenced_pks]
+                AttachmentPayload.objects.filter(pk__in=[p.pk for p in payloads]).delete()
+                # Files are deleted before the rows are unlocked, a statement
+                # reusing one of the payloads waits for its row and then
+                # stores the payload again
+                delete_files([p.sha2 for p in payloads])
+            total += len(payloads)
+            freed += sum(p.size for p in payloads)
+            self.stdout.write("Deleted %d payloads\n" % total)
+
+        self.stdout.write("Successfully deleted %d unreferenced payloads, freeing %d bytes\n" % (total, freed))
+
+
+def delete_files(shas):
+    for sha2 in shas:
+        attachment_storage.delete(get_payload_path(sha2))
@@ -4,8 +4,11 @@ from django.db import models
 from django.contrib.auth.models import User
 # from django.contrib.postgres.fields import JSONField
 from django.db.models import JSONField
+from django.db.models.signals import post_save, post_delete
 from django.utils import timezone
 
+from lrs.utils.hook_matcher import hook_matcher
+
 
 class Hook(models.Model):
     hook_id = models.UUIDField(
@@ -37,3 +40,33 @@ class Hook(models.Model):
     def to_dict(self):
         return {'id': self.hook_id, 'name': self.name, 'config': self.config, 'filters': self.filters,
                 'created_at': self.created_at.isoformat(), 'updated_at': self.updated_at.isoformat()}
+
+
+class HookDelivery(models.Model):
+    # Statements waiting to be sent to a hook's endpoint, the row is deleted
+    # once they are delivered
+    hook = models.ForeignKey(Hook, related_name="deliveries", on_delete=models.CASCADE)
+    statements = JSONField()
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+
+class HookDeadLetter(models.Model):
+    # Deliveries that failed every attempt, kept until they are requeued
+    hook = models.ForeignKey(Hook, related_name="dead_letters", on_delete=models.CASCADE)
+    statements = JSONField()
+    attempts = models.IntegerField()
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField()
+    failed_at = models.DateTimeField(default=timezone.now)
+
+
+def invalidate_hook_matcher(sender, **kwargs):
+    # Every worker compiles the hooks again before matching the next batch
+    hook_matcher.invalidate()
+
+
+post_save.connect(invalidate_hook_matcher, sender=Hook)
+post_delete.connect(invalidate_hook_matcher, sender=Hook)
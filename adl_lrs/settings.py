@@ -63,6 +63,19 @@ USE_TZ = True
 
 # Set this to True if you would like to utilize the webhooks functionality
 USE_HOOKS = get_bool_env('USE_HOOKS', 'False')
+# Statements matching a hook are queued and sent together, HOOK_DELIVERY_WINDOW
+# seconds after the first one or once HOOK_DELIVERY_BATCH_SIZE are waiting
+HOOK_DELIVERY_WINDOW = int(os.environ.get('HOOK_DELIVERY_WINDOW', '5'))
+HOOK_DELIVERY_BATCH_SIZE = int(os.environ.get('HOOK_DELIVERY_BATCH_SIZE', '100'))
+# Requests a worker sends to one endpoint at once and seconds each can take
+HOOK_ENDPOINT_CONCURRENCY = int(os.environ.get('HOOK_ENDPOINT_CONCURRENCY', '4'))
+HOOK_DELIVERY_TIMEOUT = int(os.environ.get('HOOK_DELIVERY_TIMEOUT', '10'))
+# Failed deliveries are retried after HOOK_DELIVERY_RETRY_DELAY seconds, doubled
+# every attempt up to HOOK_DELIVERY_MAX_RETRY_DELAY, and dead lettered after
+# HOOK_DELIVERY_MAX_ATTEMPTS
+HOOK_DELIVERY_RETRY_DELAY = int(os.environ.get('HOOK_DELIVERY_RETRY_DELAY', '30'))
+HOOK_DELIVERY_MAX_RETRY_DELAY = int(os.environ.get('HOOK_DELIVERY_MAX_RETRY_DELAY', '3600'))
+HOOK_DELIVERY_MAX_ATTEMPTS = int(os.environ.get('HOOK_DELIVERY_MAX_ATTEMPTS', '8'))
 
 # Newer versions of Django recommend specifying a default auto field here
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
@@ -108,6 +121,10 @@ OAUTH_ENABLED = get_bool_env('OAUTH_ENABLED', 'False')
 OAUTH_AUTHORIZE_VIEW = 'oauth_provider.views.authorize_client'
 OAUTH_CALLBACK_VIEW = 'oauth_provider.views.callback_view'
 OAUTH_SIGNATURE_METHODS = ['plaintext', 'hmac-sha1', 'rsa-sha1']
+# Seconds an OAuth timestamp stays valid, nonces are only kept that long and
+# swept from the database every OAUTH_NONCE_SWEEP_INTERVAL seconds
+OAUTH_NONCE_VALID_PERIOD = int(os.environ.get('OAUTH_NONCE_VALID_PERIOD', '600'))
+OAUTH_NONCE_SWEEP_INTERVAL = int(os.environ.get('OAUTH_NONCE_SWEEP_INTERVAL', '60'))
 
 AUTH_USER_MODEL = "auth.User"
 AUTH_PASSWORD_VALIDATORS = [
@@ -156,26 +173,108 @@ CELERY_IGNORE_RESULT = True
 # Limit on number of statements the server will return
 SERVER_STMT_LIMIT = int(os.environ.get('SERVER_STMT_LIMIT', '100'))
 
+# Limits on following StatementRefs to statements that match a query - how
+# many refs deep and how many statements in total
+STMT_REF_MAX_DEPTH = int(os.environ.get('STMT_REF_MAX_DEPTH', '10'))
+STMT_REF_MAX_STATEMENTS = int(os.environ.get('STMT_REF_MAX_STATEMENTS', '100000'))
+
+# Pages of more statements than this are streamed with chunked transfer
+# instead of being built in memory, reading and encoding this many statements
+# at a time
+STATEMENT_STREAM_LIMIT = int(os.environ.get('STATEMENT_STREAM_LIMIT', '1000'))
+STATEMENT_STREAM_CHUNK_SIZE = int(os.environ.get('STATEMENT_STREAM_CHUNK_SIZE', '500'))
+
+# Attachment parts of a multipart request are kept in memory up to this many
+# bytes, larger ones are spooled to a temporary file
+ATTACHMENT_SPOOL_SIZE = int(os.environ.get('ATTACHMENT_SPOOL_SIZE', str(1024 * 1024)))
+# Largest multipart request and largest single part of one accepted, bigger
+# ones get a 413. Multipart bodies are streamed so DATA_UPLOAD_MAX_MEMORY_SIZE
+# doesn't apply to them
+MULTIPART_MAX_BODY_SIZE = int(os.environ.get('MULTIPART_MAX_BODY_SIZE', str(512 * 1024 * 1024)))
+MULTIPART_MAX_PART_SIZE = int(os.environ.get('MULTIPART_MAX_PART_SIZE', str(256 * 1024 * 1024)))
+
 # Celery task timeouts
 CELERYD_TASK_SOFT_TIME_LIMIT = 15
 
+# Statement IDs for the background tasks are sent to the broker in batches by a
+# thread in each process, every TASK_DISPATCH_INTERVAL seconds (0 sends them as
+# soon as the request commits) or once TASK_DISPATCH_BATCH_SIZE are waiting.
+# When the broker can't be reached they run on TASK_DISPATCH_FALLBACK_WORKERS
+# threads of the process, and the broker is tried again after
+# TASK_DISPATCH_RETRY_INTERVAL seconds
+TASK_DISPATCH_INTERVAL = float(os.environ.get('TASK_DISPATCH_INTERVAL', '0.5'))
+TASK_DISPATCH_BATCH_SIZE = int(os.environ.get('TASK_DISPATCH_BATCH_SIZE', '500'))
+TASK_DISPATCH_FALLBACK_WORKERS = int(os.environ.get('TASK_DISPATCH_FALLBACK_WORKERS', '2'))
+TASK_DISPATCH_RETRY_INTERVAL = int(os.environ.get('TASK_DISPATCH_RETRY_INTERVAL', '30'))
+
 # ActivityID resolve timeout (seconds)
 ACTIVITY_ID_RESOLVE_TIMEOUT = 0.2
+# Seconds before the metadata of an activity ID is fetched again, for IDs that
+# gave a JSON document and for ones that didn't, and how many are fetched at once
+ACTIVITY_METADATA_TTL = int(os.environ.get('ACTIVITY_METADATA_TTL', '3600'))
+ACTIVITY_METADATA_FAILURE_TTL = int(os.environ.get('ACTIVITY_METADATA_FAILURE_TTL', '600'))
+ACTIVITY_METADATA_WORKERS = int(os.environ.get('ACTIVITY_METADATA_WORKERS', '8'))
 
-# Caches for /more endpoint and attachments
+# Shared cache, the cache of statement renders and of activity metadata
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
         'LOCATION': 'cache_statement_list',
         'TIMEOUT': 86400,
     },
-    'attachment_cache': {
-        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-        'LOCATION': 'attachment_cache',
-        'TIMEOUT': 86400,
+    # Canonical and ids renderings of statements - an in-process LRU in front
+    # of the database, large renders are spooled to local disk instead
+    'render_cache': {
+        'BACKEND': 'lrs.utils.tiered_cache.TieredCache',
+        'LOCATION': 'render_cache',
+        'TIMEOUT': int(os.environ.get('STATEMENT_RENDER_CACHE_TIMEOUT', '3600')),
+        'OPTIONS': {
+            'SHARED': 'render_cache_shared',
+            'SPOOL': 'render_cache_spool',
+            'SPOOL_THRESHOLD': int(os.environ.get('RENDER_CACHE_SPOOL_THRESHOLD', str(256 * 1024))),
+            'LOCAL_MAX_SIZE': int(os.environ.get('RENDER_CACHE_LOCAL_SIZE', str(32 * 1024 * 1024))),
+            'LOCAL_TIMEOUT': int(os.environ.get('RENDER_CACHE_LOCAL_TIMEOUT', '300')),
+        },
+    },
+    # The tier every worker shares is the database by default, the one store
+    # every deployment has. Most reads are served by the in-process tier, a
+    # page that isn't costs one read here and its new renders one upsert.
+    # Any other shared backend, like memcached, can be set instead
+    'render_cache_shared': {
+        'BACKEND': os.environ.get('RENDER_CACHE_SHARED_BACKEND', 'lrs.utils.db_cache.BatchedDatabaseCache'),
+        'LOCATION': os.environ.get('RENDER_CACHE_SHARED_LOCATION', 'render_cache'),
+        'TIMEOUT': int(os.environ.get('STATEMENT_RENDER_CACHE_TIMEOUT', '3600')),
+    },
+    # When the metadata of each activity ID was fetched, with its validators
+    'activity_metadata': {
+        'BACKEND': 'lrs.utils.db_cache.BatchedDatabaseCache',
+        'LOCATION': 'activity_metadata_cache',
+        'TIMEOUT': int(os.environ.get('ACTIVITY_METADATA_CACHE_TIMEOUT', str(7 * 86400))),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('ACTIVITY_METADATA_CACHE_SIZE', '100000')),
+        },
+    },
+    'render_cache_spool': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('RENDER_CACHE_SPOOL_DIR', os.path.join(PROJECT_ROOT, 'cache', 'render_spool')),
+        'TIMEOUT': int(os.environ.get('STATEMENT_RENDER_CACHE_TIMEOUT', '3600')),
     },
 }
 
+# Per-process cache of verb, activity and agent lookups made while storing
+# statements - max entries, seconds an entry lives and seconds between checks
+# for changes made by other processes
+LOOKUP_CACHE_SIZE = int(os.environ.get('LOOKUP_CACHE_SIZE', '10000'))
+LOOKUP_CACHE_TIMEOUT = int(os.environ.get('LOOKUP_CACHE_TIMEOUT', '300'))
+LOOKUP_CACHE_SYNC_INTERVAL = int(os.environ.get('LOOKUP_CACHE_SYNC_INTERVAL', '5'))
+
+# Per-process cache of HTTP Basic credentials that were verified, and of OAuth
+# consumers and tokens - max entries and seconds before the password is
+# checked again. Unlike the lookup caches they check for changes made by other
+# processes on every request, so a changed user or revoked token is never used
+CREDENTIAL_CACHE_SIZE = int(os.environ.get('CREDENTIAL_CACHE_SIZE', '1000'))
+CREDENTIAL_CACHE_TIMEOUT = int(os.environ.get('CREDENTIAL_CACHE_TIMEOUT', '60'))
+
 # Static files finders
 STATICFILES_FINDERS = (
     'django.contrib.staticfiles.finders.FileSystemFinder',
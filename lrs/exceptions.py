@@ -34,6 +34,10 @@ class PreconditionFail(Exception):
     pass
 
 
+class RequestEntityTooLarge(Exception):
+    pass
+
+
 class OauthUnauthorized(Exception):
     pass
 
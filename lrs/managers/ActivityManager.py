@@ -1,15 +1,42 @@
+import copy
+import uuid
+
 from django.db import IntegrityError
 
 from ..models import Activity
+from ..utils.lookup_cache import activity_cache
 
 
 class ActivityManager():
 
-    def __init__(self, data, auth=None, define=True):
+    def __init__(self, data, auth=None, define=True, activity=None, act_created=False):
         self.auth = auth
         self.define_permission = define
-        self.activity = None
-        self.populate(data)
+        self.activity = activity
+        # Activity was already retrieved (or created) by the caller, only merge
+        # the incoming definition - the caller is responsible for saving it
+        if activity is not None:
+            self.merge_definition(data, act_created, self.get_define_permission(act_created))
+        else:
+            self.populate(data)
+
+    def get_define_permission(self, act_created):
+        # If activity was just created, user defines it if they have define
+        # permissions
+        if act_created:
+            return self.define_permission
+        # If activity already exists and have define
+        if self.define_permission:
+            # Act exists but it was created by someone who didn't have define permissions so it's up for grabs
+            # for first user with define permission or...
+            # Act exists - if it has same auth set it, else do nothing
+            if (not self.activity.authority_id) or \
+               (self.auth and self.activity.authority_id == self.auth.pk) or \
+               (self.activity.authority.objectType == 'Group' and self.auth in self.activity.authority.member.all()) or \
+               (self.auth.objectType == 'Group' and self.activity.authority in self.auth.member.all()):
+                return True
+        # activity already exists but do not have define
+        return False
 
     def update_language_maps(self, incoming_act_def):
 
@@ -78,9 +105,13 @@ class ActivityManager():
     def populate(self, data):
         activity_id = data['id']
         can_define = False
+        authority_changed = False
         # Try to get activity
         try:
-            self.activity = Activity.objects.get(activity_id=activity_id)
+            self.activity = activity_cache.get_instance(Activity, activity_id)
+            if self.activity is None:
+                self.activity = Activity.objects.get(activity_id=activity_id)
+                activity_cache.set_instance(activity_id, self.activity)
             act_created = False
         # Activity DNE
         except Activity.DoesNotExist:
@@ -105,25 +136,39 @@ class ActivityManager():
             # permissions, user becomes authority over activity
             if not act_created and can_define and not self.activity.authority:
                 self.activity.authority = self.auth
+                authority_changed = True
         # Activity already exists
         else:
-            # If activity already exists and have define
-            if self.define_permission:
-                # Act exists but it was created by someone who didn't have define permissions so it's up for grabs
-                # for first user with define permission or...
-                # Act exists - if it has same auth set it, else do nothing
-                if (not self.activity.authority) or \
-                   (self.activity.authority == self.auth) or \
-                   (self.activity.authority.objectType == 'Group' and self.auth in self.activity.authority.member.all()) or \
-                   (self.auth.objectType == 'Group' and self.activity.authority in self.auth.member.all()):
-                    can_define = True
-                else:
-                    can_define = False
-            # activity already exists but do not have define
+            can_define = self.get_define_permission(act_created)
+        changed = self.merge_changed(data, act_created, can_define)
+        if (changed or authority_changed) and not act_created:
+            # The merge was worked out on a copy that can be out of date, it is
+            # redone on the locked row so another worker's update isn't lost
+            self.activity = Activity.objects.select_for_update().get(pk=self.activity.pk)
+            if authority_changed:
+                authority_changed = not self.activity.authority_id
+                if authority_changed:
+                    self.activity.authority = self.auth
             else:
-                can_define = False
+                can_define = self.get_define_permission(act_created)
+            changed = self.merge_changed(data, act_created, can_define)
+        # Only write the activity if its definition or authority changed
+        if authority_changed or changed:
+            if changed:
+                self.activity.canonical_version = uuid.uuid4()
+            self.activity.save()
+            activity_cache.record_writes()
+        else:
+            activity_cache.record_writes(written=0, skipped=1)
+
+    def merge_changed(self, data, act_created, can_define):
+        stored = copy.deepcopy(self.activity.canonical_data)
+        self.merge_definition(data, act_created, can_define)
+        return self.activity.canonical_data != stored
+
+    def merge_definition(self, data, act_created, can_define):
         # Set id and objectType regardless
-        self.activity.canonical_data['id'] = activity_id
+        self.activity.canonical_data['id'] = data['id']
         self.activity.canonical_data['objectType'] = 'Activity'
         incoming_act_def = data.get('definition', None)
         # If activity existed, and the user has define privileges - update
@@ -135,4 +180,3 @@ class ActivityManager():
             # If there is an incoming definition
             if incoming_act_def:
                 self.activity.canonical_data['definition'] = incoming_act_def
-        self.activity.save()
@@ -0,0 +1,353 @@
+import copy
+import uuid
+
+from django.db import connection
+from django.db.models import Q
+
+from .ActivityManager import ActivityManager
+from .StatementManager import StatementManager, SubStatementManager
+from ..models import Verb, StatementActivity, StatementAttachment, StatementAgent, SubStatement, \
+    Agent, Activity, AttachmentPayload, get_payload_path
+from ..utils.lookup_cache import verb_cache, activity_cache, agent_cache, get_ifp_key, get_agent_ifp_keys
+
+
+def get_agent_key(agent_data):
+    # Only identified agents are resolved in bulk - groups (and their members)
+    # still go through Agent.objects.retrieve_or_create
+    if agent_data.get('objectType', None) == 'Group':
+        return None
+    return get_ifp_key(agent_data)
+
+
+def get_agent_kwargs(agent_data):
+    kwargs = dict(agent_data)
+    if get_agent_key(kwargs)[0] == 'account':
+        kwargs['account_homePage'] = kwargs['account']['homePage']
+        kwargs['account_name'] = kwargs['account']['name']
+        del kwargs['account']
+    return kwargs
+
+
+class StatementBatchManager():
+
+    def __init__(self, stmts, auth_info, payloads):
+        # auth_info contains define, endpoint, user, and request authority
+        # Only batched when the request has an authority, so it is the same
+        # for every statement and only has to be rendered once
+        self.auth_info = auth_info
+        self.authority = auth_info['agent'].to_dict()
+        self.verbs = {}
+        self.activities = {}
+        self.agents = {}
+        # Activities created by this batch - the first statement that uses one
+        # defines it, every other statement updates its language maps
+        self.created_activity_ids = set()
+        # Only verbs and activities whose canonical data changed get written
+        # Rows inserted by this batch, nobody else can have them cached yet
+        self.new_verb_ids = set()
+        self.new_activity_ids = set()
+        self.dirty_verbs = {}
+        self.dirty_activities = {}
+        # Every merge made into each verb and activity, redone on the locked
+        # rows before the dirty ones are written
+        self.verb_merges = {}
+        self.activity_merges = {}
+        self.substatements = []
+        self.statements = []
+        self.context_activities = []
+        self.agent_index = []
+        self.activity_index = []
+        self.attachments = []
+        self.payloads = payloads
+        # Attachments in the batch using each payload
+        self.payload_counts = {}
+
+        self.resolve(stmts)
+        self.model_objects = [BatchedStatementManager(stmt, auth_info, payloads, self).model_object
+                              for stmt in stmts]
+        self.save()
+
+    def collect(self, stmt_data, verb_ids, activity_ids, agent_data):
+        verb_ids.append(stmt_data['verb']['id'])
+        stmt_object = stmt_data['object']
+        object_type = stmt_object.get('objectType', 'Activity')
+        if object_type == 'Activity':
+            activity_ids.append(stmt_object['id'])
+        elif object_type in ['Agent', 'Group']:
+            agent_data.append(stmt_object)
+        elif object_type == 'SubStatement':
+            self.collect(stmt_object, verb_ids, activity_ids, agent_data)
+        agent_data.append(stmt_data['actor'])
+
+        context = stmt_data.get('context', {})
+        if 'instructor' in context:
+            agent_data.append(context['instructor'])
+        if 'team' in context:
+            agent_data.append(context['team'])
+        for con_acts in context.get('contextActivities', {}).values():
+            if not isinstance(con_acts, list):
+                con_acts = [con_acts]
+            activity_ids.extend(con_act['id'] for con_act in con_acts)
+
+    def resolve(self, stmts):
+        verb_ids, activity_ids, agent_data = [], [], []
+        for stmt in stmts:
+            self.collect(stmt, verb_ids, activity_ids, agent_data)
+        # Rows get created in the same order the statements reference them
+        self.resolve_verbs(list(dict.fromkeys(verb_ids)))
+        self.resolve_activities(list(dict.fromkeys(activity_ids)))
+        self.resolve_agents(agent_data)
+
+    def get_cached(self, lookup_cache, model, keys):
+        # Split keys into the ones this process already has and the ones that
+        # still have to be queried
+        found = {}
+        for key in keys:
+            instance = lookup_cache.get_instance(model, key)
+            if instance is not None:
+                found[key] = instance
+        return found, [k for k in keys if k not in found]
+
+    def resolve_verbs(self, verb_ids):
+        self.verbs, uncached = self.get_cached(verb_cache, Verb, verb_ids)
+        if not uncached:
+            return
+        self.verbs.update((v.verb_id, v) for v in Verb.objects.filter(verb_id__in=uncached))
+        missing = [v for v in uncached if v not in self.verbs]
+        if missing:
+            # Ignore conflicts in case another request created them in the meantime
+            Verb.objects.bulk_create([Verb(verb_id=v) for v in missing], ignore_conflicts=True)
+            self.verbs.update((v.verb_id, v) for v in Verb.objects.filter(verb_id__in=missing))
+            self.new_verb_ids = set(missing)
+        for verb_id in uncached:
+            verb_cache.set_instance(verb_id, self.verbs[verb_id])
+
+    def resolve_activities(self, activity_ids):
+        self.activities, uncached = self.get_cached(activity_cache, Activity, activity_ids)
+        if not uncached:
+            return
+        activities = Activity.objects.select_related('authority')
+        self.activities.update((a.activity_id, a) for a in activities.filter(activity_id__in=uncached))
+        missing = [a for a in uncached if a not in self.activities]
+        if missing:
+            # If activity DNE and can define - create activity with auth
+            authority = self.auth_info['agent'] if self.auth_info['define'] else None
+            Activity.objects.bulk_create([Activity(activity_id=a, authority=authority) for a in missing],
+                                         ignore_conflicts=True)
+            self.activities.update((a.activity_id, a) for a in activities.filter(activity_id__in=missing))
+            self.created_activity_ids = set(missing)
+            self.new_activity_ids = set(missing)
+        for activity_id in uncached:
+            activity_cache.set_instance(activity_id, self.activities[activity_id])
+
+    def resolve_agents(self, agent_data):
+        # Keep the first occurrence of every IFP, that is the one the agent
+        # would have been created from
+        incoming = {}
+        for data in agent_data:
+            key = get_agent_key(data)
+            if key and key not in incoming:
+                incoming[key] = data
+        if not incoming:
+            return
+
+        self.agents, uncached = self.get_cached(agent_cache, Agent, list(incoming))
+        if not uncached:
+            return
+        self.agents.update(self.retrieve_agents(uncached))
+        missing = [k for k in uncached if k not in self.agents]
+        if missing:
+            Agent.objects.bulk_create([Agent(**get_agent_kwargs(incoming[k])) for k in missing],
+                                      ignore_conflicts=True)
+            self.agents.update(self.retrieve_agents(missing))
+        for key in uncached:
+            for agent_key in get_agent_ifp_keys(self.agents[key]):
+                agent_cache.set_instance(agent_key, self.agents[key])
+
+    def retrieve_agents(self, keys):
+        ifpQ = Q()
+        values = {}
+        for key in keys:
+            if key[0] == 'account':
+                ifpQ = ifpQ | Q(account_homePage=key[1], account_name=key[2])
+            else:
+                values.setdefault(key[0], []).append(key[1])
+        for ifp, ifp_values in values.items():
+            ifpQ = ifpQ | Q(**{ifp + '__in': ifp_values})
+
+        keys = set(keys)
+        agents = {}
+        for agent in Agent.objects.filter(ifpQ):
+            for key in get_agent_ifp_keys(agent):
+                if key in keys:
+                    agents[key] = agent
+        return agents
+
+    def add_context_activity(self, stmt, con_act_type, act):
+        if con_act_type not in ['parent', 'grouping', 'category']:
+            con_act_type = 'other'
+        self.context_activities.append((stmt, 'context_ca_' + con_act_type, act))
+
+    def insert(self, model_objects):
+        # Primary keys are needed for the context activity and attachment rows,
+        # backends that can't return them from a bulk insert save one by one
+        if connection.features.can_return_rows_from_bulk_insert:
+            type(model_objects[0]).objects.bulk_create(model_objects)
+        else:
+            for model_object in model_objects:
+                model_object.save(force_insert=True)
+
+    def save_context_activities(self):
+        through_rows = {}
+        for stmt, relation, act in self.context_activities:
+            field = getattr(type(stmt), relation).field
+            rows = through_rows.setdefault(field, {})
+            # Same as .add(), adding an activity twice to a relation is a no-op
+            rows.setdefault((stmt.pk, act.pk), None)
+        for field, rows in through_rows.items():
+            through = field.remote_field.through
+            through.objects.bulk_create([through(**{field.m2m_column_name(): stmt_pk, field.m2m_reverse_name(): act_pk})
+                                         for stmt_pk, act_pk in rows])
+
+    def save_verbs(self):
+        # The merges were worked out on copies that can be out of date, they
+        # are redone on the locked rows so another worker's update isn't lost
+        locked = Verb.objects.select_for_update().in_bulk([v.pk for v in self.dirty_verbs.values()])
+        verbs = []
+        for verb_id, verb in self.dirty_verbs.items():
+            verb = locked[verb.pk]
+            stored = copy.deepcopy(verb.canonical_data)
+            for incoming_verb in self.verb_merges[verb_id]:
+                StatementManager.merge_verb(verb, incoming_verb)
+            if verb.canonical_data != stored:
+                verb.canonical_version = uuid.uuid4()
+                verbs.append(verb)
+        Verb.objects.bulk_update(verbs, ['canonical_data', 'canonical_version'])
+        # bulk_update doesn't send post_save so the lookup cache is updated here
+        for verb in verbs:
+            verb_cache.update_instance([verb.verb_id], verb, verb.verb_id in self.new_verb_ids)
+        return len(verbs)
+
+    def save_activities(self):
+        # Same as the verbs, the define permission is checked again against
+        # the locked row's authority
+        locked = Activity.objects.select_for_update(of=('self',)).select_related('authority').in_bulk(
+            [a.pk for a in self.dirty_activities.values()])
+        activities = []
+        for activity_id, activity in self.dirty_activities.items():
+            activity = locked[activity.pk]
+            stored = copy.deepcopy(activity.canonical_data)
+            for act_data, act_created in self.activity_merges[activity_id]:
+                ActivityManager(act_data, auth=self.auth_info['agent'], define=self.auth_info['define'],
+                                activity=activity, act_created=act_created)
+            if activity.canonical_data != stored:
+                activity.canonical_version = uuid.uuid4()
+                activities.append(activity)
+        Activity.objects.bulk_update(activities, ['canonical_data', 'canonical_version'])
+        for activity in activities:
+            activity_cache.update_instance([activity.activity_id], activity,
+                                           activity.activity_id in self.new_activity_ids)
+        return len(activities)
+
+    def save(self):
+        verbs_written = self.save_verbs() if self.dirty_verbs else 0
+        verb_cache.record_writes(verbs_written, len(self.verbs) - verbs_written)
+        activities_written = self.save_activities() if self.dirty_activities else 0
+        activity_cache.record_writes(activities_written, len(self.activities) - activities_written)
+        # Substatements first since statements point to them
+        if self.substatements:
+            self.insert(self.substatements)
+        if self.statements:
+            self.insert(self.statements)
+        if self.context_activities:
+            self.save_context_activities()
+        if self.agent_index:
+            StatementAgent.objects.bulk_create(self.agent_index)
+        if self.activity_index:
+            StatementActivity.objects.bulk_create(self.activity_index)
+        if self.payload_counts:
+            AttachmentPayload.objects.store(self.payloads, self.payload_counts)
+        if self.attachments:
+            StatementAttachment.objects.bulk_create(self.attachments)
+
+
+class BatchedStatementMixin():
+    # Looks up verbs, agents and activities already resolved by the batch and
+    # hands the model objects to it instead of saving them one at a time
+
+    batch: StatementBatchManager
+
+    def set_authority(self, auth_info, stmt_data):
+        stmt_data['authority'] = auth_info['agent']
+        stmt_data['full_statement']['authority'] = self.batch.authority
+
+    def build_agent(self, agent_data):
+        key = get_agent_key(agent_data)
+        if key in self.batch.agents:
+            return self.batch.agents[key]
+        return super().build_agent(agent_data)
+
+    def build_activity(self, auth_info, act_data):
+        activity_id = act_data['id']
+        act_created = activity_id in self.batch.created_activity_ids
+        self.batch.created_activity_ids.discard(activity_id)
+        activity = self.batch.activities[activity_id]
+        self.batch.activity_merges.setdefault(activity_id, []).append((act_data, act_created))
+        stored = copy.deepcopy(activity.canonical_data)
+        ActivityManager(act_data, auth=auth_info['agent'], define=auth_info['define'],
+                        activity=activity, act_created=act_created)
+        if activity.canonical_data != stored:
+            self.batch.dirty_activities[activity_id] = activity
+        return activity
+
+    def build_verb(self, stmt_data):
+        verb_object = self.batch.verbs[stmt_data['verb']['id']]
+        self.batch.verb_merges.setdefault(verb_object.verb_id, []).append(stmt_data['verb'])
+        stored = copy.deepcopy(verb_object.canonical_data)
+        self.merge_verb(verb_object, stmt_data['verb'])
+        if verb_object.canonical_data != stored:
+            self.batch.dirty_verbs[verb_object.verb_id] = verb_object
+        stmt_data['verb'] = verb_object
+
+    def build_substatement_manager(self, auth_info, substmt_data):
+        return BatchedSubStatementManager(substmt_data, auth_info, self.batch)
+
+    def add_context_activity(self, stmt, con_act_type, act):
+        self.batch.add_context_activity(stmt, con_act_type, act)
+
+    def build_index(self, stmt):
+        self.batch.agent_index.extend(StatementAgent.for_statement(stmt))
+        self.batch.activity_index.extend(StatementActivity.for_statement(
+            stmt, self.context_activities, self.substatement_context_activities))
+
+    def create_model_object(self, model, stmt_data):
+        model_object = model(**stmt_data)
+        if model is SubStatement:
+            self.batch.substatements.append(model_object)
+        else:
+            self.batch.statements.append(model_object)
+        return model_object
+
+    def build_attachments(self, user_info, attachment_data, payloads):
+        for attach in attachment_data:
+            sha2 = attach.get('sha2', None)
+            attachment = StatementAttachment(canonical_data=attach, statement=self.model_object)
+            if sha2:
+                if payloads and sha2 in payloads:
+                    self.batch.payload_counts[sha2] = self.batch.payload_counts.get(sha2, 0) + 1
+                    attachment.payload.name = get_payload_path(sha2)
+            self.batch.attachments.append(attachment)
+
+
+class BatchedStatementManager(BatchedStatementMixin, StatementManager):
+
+    def __init__(self, stmt_data, auth_info, payloads, batch):
+        self.batch = batch
+        StatementManager.__init__(self, stmt_data, auth_info, payloads)
+
+
+class BatchedSubStatementManager(BatchedStatementMixin, SubStatementManager):
+
+    def __init__(self, substmt_data, auth_info, batch):
+        self.batch = batch
+        SubStatementManager.__init__(self, substmt_data, auth_info)
@@ -1,26 +1,25 @@
-from django.core.files.base import ContentFile
+import copy
 import uuid
 
-from django.core.cache import caches
-
 from .ActivityManager import ActivityManager
-from ..models import Verb, Statement, StatementAttachment, SubStatement, Agent
+from ..models import Verb, Statement, StatementActivity, StatementAttachment, StatementAgent, SubStatement, Agent, \
+    AttachmentPayload, get_payload_path
 from ..utils import convert_to_datetime_object
-
-att_cache = caches['attachment_cache']
+from ..utils.lookup_cache import verb_cache
 
 
 class StatementManager():
 
     model_object: Statement
+    is_substatement = False
 
-    def __init__(self, stmt_data, auth_info, payload_sha2s):
+    def __init__(self, stmt_data, auth_info, payloads):
         # auth_info contains define, endpoint, user, and request authority
-        if self.__class__.__name__ == 'StatementManager':
+        if not self.is_substatement:
             # Full statement is for a statement only, same with authority
             self.set_authority(auth_info, stmt_data)
         
-        self.populate(auth_info, stmt_data, payload_sha2s)
+        self.populate(auth_info, stmt_data, payloads)
 
     def set_authority(self, auth_info, stmt_data):
         # Could still have no authority in stmt if HTTP_AUTH and OAUTH are disabled
@@ -36,46 +35,47 @@ class StatementManager():
         else:
             # If authority is given in statement
             if 'authority' in stmt_data:
-                auth_info['agent'] = stmt_data['authority'] = Agent.objects.retrieve_or_create(
-                    **stmt_data['full_statement']['authority'])[0]
+                auth_info['agent'] = stmt_data['authority'] = self.build_agent(
+                    stmt_data['full_statement']['authority'])
             # Empty auth in request or statement
             else:
                 auth_info['agent'] = None
 
+    def build_agent(self, agent_data):
+        return Agent.objects.retrieve_or_create(**agent_data)[0]
+
+    def build_activity(self, auth_info, act_data):
+        return ActivityManager(act_data, auth=auth_info['agent'], define=auth_info['define']).activity
+
+    def add_context_activity(self, stmt, con_act_type, act):
+        if con_act_type == 'parent':
+            stmt.context_ca_parent.add(act)
+        elif con_act_type == 'grouping':
+            stmt.context_ca_grouping.add(act)
+        elif con_act_type == 'category':
+            stmt.context_ca_category.add(act)
+        else:
+            stmt.context_ca_other.add(act)
+
     def build_context_activities(self, stmt, auth_info, con_act_data):
-        for con_act_group in list(con_act_data.items()):
+        for con_act_type, con_acts in list(con_act_data.items()):
             # Incoming contextActivities can either be a list or dict
-            if isinstance(con_act_group[1], list):
-                for con_act in con_act_group[1]:
-                    act = ActivityManager(con_act, auth=auth_info[
-                                          'agent'], define=auth_info['define']).activity
-                    if con_act_group[0] == 'parent':
-                        stmt.context_ca_parent.add(act)
-                    elif con_act_group[0] == 'grouping':
-                        stmt.context_ca_grouping.add(act)
-                    elif con_act_group[0] == 'category':
-                        stmt.context_ca_category.add(act)
-                    else:
-                        stmt.context_ca_other.add(act)
-            else:
-                act = ActivityManager(con_act_group[1], auth=auth_info[
-                                      'agent'], define=auth_info['define']).activity
-                if con_act_group[0] == 'parent':
-                    stmt.context_ca_parent.add(act)
-                elif con_act_group[0] == 'grouping':
-                    stmt.context_ca_grouping.add(act)
-                elif con_act_group[0] == 'category':
-                    stmt.context_ca_category.add(act)
-                else:
-                    stmt.context_ca_other.add(act)
-        stmt.save()
+            if not isinstance(con_acts, list):
+                con_acts = [con_acts]
+            for con_act in con_acts:
+                act = self.build_activity(auth_info, con_act)
+                self.add_context_activity(stmt, con_act_type, act)
+                self.context_activities.append((con_act_type, act))
+
+    def create_model_object(self, model, stmt_data):
+        return model.objects.create(**stmt_data)
 
     def build_substatement(self, auth_info, stmt_data):
         # Pop off any context activities
         con_act_data = stmt_data.pop('context_contextActivities', {})
         # Delete objectType since it is not a field in the model
         del stmt_data['objectType']
-        sub = SubStatement.objects.create(**stmt_data)
+        sub = self.create_model_object(SubStatement, stmt_data)
         if con_act_data:
             self.build_context_activities(sub, auth_info, con_act_data)
         return sub
@@ -90,11 +90,17 @@ class StatementManager():
             stmt_data['statement_id'] = stmt_data['id']
             del stmt_data['id']
         # Try to create statement
-        stmt = Statement.objects.create(**stmt_data)
+        stmt = self.create_model_object(Statement, stmt_data)
         if con_act_data:
             self.build_context_activities(stmt, auth_info, con_act_data)
+        self.build_index(stmt)
         return stmt
 
+    def build_index(self, stmt):
+        StatementAgent.objects.bulk_create(StatementAgent.for_statement(stmt))
+        StatementActivity.objects.bulk_create(StatementActivity.for_statement(
+            stmt, self.context_activities, self.substatement_context_activities))
+
     def build_result(self, stmt_data):
         if 'result' in stmt_data:
             result = stmt_data['result']
@@ -107,20 +113,18 @@ class StatementManager():
                 del stmt_data['result_score']
             del stmt_data['result']
 
-    def build_attachments(self, user_info, attachment_data, payload_sha2s):
+    def build_attachments(self, user_info, attachment_data, payloads):
         # Iterate through each attachment
         for attach in attachment_data:
             sha2 = attach.get('sha2', None)
             attachment = StatementAttachment.objects.create(
                 canonical_data=attach)
             if sha2:
-                if payload_sha2s and sha2 in payload_sha2s:
-                    raw_payload = att_cache.get(sha2)
-                    try:
-                        payload = ContentFile(raw_payload)
-                    except Exception as e:
-                        raise e
-                    attachment.payload.save(sha2, payload)
+                if payloads and sha2 in payloads:
+                    # The payload is the part's spooled file, the store keeps
+                    # one copy per sha2 however many attachments use it
+                    AttachmentPayload.objects.store(payloads, {sha2: 1})
+                    attachment.payload.name = get_payload_path(sha2)
             attachment.statement = self.model_object
             attachment.save()
 
@@ -130,11 +134,11 @@ class StatementManager():
             for k, v in context.items():
                 stmt_data['context_' + k] = v
             if 'context_instructor' in stmt_data:
-                stmt_data['context_instructor'] = Agent.objects.retrieve_or_create(
-                    **stmt_data['context_instructor'])[0]
+                stmt_data['context_instructor'] = self.build_agent(
+                    stmt_data['context_instructor'])
             if 'context_team' in stmt_data:
-                stmt_data['context_team'] = Agent.objects.retrieve_or_create(
-                    **stmt_data['context_team'])[0]
+                stmt_data['context_team'] = self.build_agent(
+                    stmt_data['context_team'])
             if 'context_statement' in stmt_data:
                 stmt_data['context_statement'] = stmt_data[
                     'context_statement']['id']
@@ -142,23 +146,42 @@ class StatementManager():
 
     def build_verb(self, stmt_data):
         incoming_verb = stmt_data['verb']
-        verb_id = incoming_verb['id']
         # Get or create the verb
-        verb_object, created = Verb.objects.get_or_create(verb_id=verb_id)
+        verb_object = verb_cache.get_instance(Verb, incoming_verb['id'])
+        if verb_object is None:
+            verb_object, created = Verb.objects.get_or_create(verb_id=incoming_verb['id'])
+            verb_cache.set_instance(verb_object.verb_id, verb_object)
+        changed = self.merge_verb_changed(verb_object, incoming_verb)
+        if changed:
+            # Merged again on the locked row, the cached copy can be out of date
+            verb_object = Verb.objects.select_for_update().get(pk=verb_object.pk)
+            changed = self.merge_verb_changed(verb_object, incoming_verb)
+        # Only write the verb if a display language was added or changed
+        if changed:
+            verb_object.canonical_version = uuid.uuid4()
+            verb_object.save(update_fields=['canonical_data', 'canonical_version'])
+            verb_cache.record_writes()
+        else:
+            verb_cache.record_writes(written=0, skipped=1)
+        stmt_data['verb'] = verb_object
+
+    @classmethod
+    def merge_verb_changed(cls, verb_object, incoming_verb):
+        stored = copy.deepcopy(verb_object.canonical_data)
+        cls.merge_verb(verb_object, incoming_verb)
+        return verb_object.canonical_data != stored
+
+    @staticmethod
+    def merge_verb(verb_object, incoming_verb):
         # If existing, get existing keys
-        existing_lang_maps = {}
-        if not created:
-            if 'display' in verb_object.canonical_data:
-                existing_lang_maps = verb_object.canonical_data['display']
+        existing_lang_maps = verb_object.canonical_data.get('display', {})
 
         # Save verb displays
         if 'display' in incoming_verb:
             verb_object.canonical_data['display'] = dict(
                 list(existing_lang_maps.items()) + list(incoming_verb['display'].items()))
 
-        verb_object.canonical_data['id'] = verb_id
-        verb_object.save()
-        stmt_data['verb'] = verb_object
+        verb_object.canonical_data['id'] = incoming_verb['id']
 
     def build_statement_object(self, auth_info, stmt_data):
         statement_object_data = stmt_data['object']
@@ -166,30 +189,34 @@ class StatementManager():
         # If not specified, the object is assumed to be an activity
         if 'objectType' not in statement_object_data or statement_object_data['objectType'] == 'Activity':
             statement_object_data['objectType'] = 'Activity'
-            stmt_data['object_activity'] = ActivityManager(statement_object_data, auth=auth_info['agent'],
-                                                           define=auth_info['define']).activity
+            stmt_data['object_activity'] = self.build_activity(auth_info, statement_object_data)
         elif statement_object_data['objectType'] in valid_agent_objects:
-            stmt_data['object_agent'] = Agent.objects.retrieve_or_create(
-                **statement_object_data)[0]
+            stmt_data['object_agent'] = self.build_agent(statement_object_data)
         elif statement_object_data['objectType'] == 'SubStatement':
-            stmt_data['object_substatement'] = SubStatementManager(
-                statement_object_data, auth_info).model_object
+            sub_manager = self.build_substatement_manager(auth_info, statement_object_data)
+            stmt_data['object_substatement'] = sub_manager.model_object
+            self.substatement_context_activities = sub_manager.context_activities
         elif statement_object_data['objectType'] == 'StatementRef':
             stmt_data['object_statementref'] = uuid.UUID(
                 statement_object_data['id'])
         del stmt_data['object']
 
+    def build_substatement_manager(self, auth_info, substmt_data):
+        return SubStatementManager(substmt_data, auth_info)
+
     def build_model_object(self, auth_info, stmt_data) -> Statement:
         return self.build_statement(auth_info, stmt_data)
 
-    def populate(self, auth_info, stmt_data, payload_sha2s):
-        if self.__class__.__name__ == 'StatementManager':
+    def populate(self, auth_info, stmt_data, payloads):
+        if not self.is_substatement:
             stmt_data['voided'] = False
+        # (type, activity) pairs for the statement activity index
+        self.context_activities = []
+        self.substatement_context_activities = []
 
         self.build_verb(stmt_data)
         self.build_statement_object(auth_info, stmt_data)
-        stmt_data['actor'] = Agent.objects.retrieve_or_create(
-            **stmt_data['actor'])[0]
+        stmt_data['actor'] = self.build_agent(stmt_data['actor'])
         self.build_context(stmt_data)
         self.build_result(stmt_data)
         # Substatement could not have timestamp
@@ -207,12 +234,13 @@ class StatementManager():
         self.model_object = self.build_model_object(auth_info, stmt_data)
         
         if attachment_data:
-            self.build_attachments(auth_info, attachment_data, payload_sha2s)
+            self.build_attachments(auth_info, attachment_data, payloads)
 
 
 class SubStatementManager(StatementManager):
 
     model_object: SubStatement
+    is_substatement = True
 
     def __init__(self, substmt_data, auth_info):
         StatementManager.__init__(self, substmt_data, auth_info, None)
@@ -1,15 +1,19 @@
 import ast
+import hashlib
 import json
+import os
+import tempfile
 import uuid
 
 from typing import List
 from collections import OrderedDict
 
-from django.db import models, IntegrityError
-from django.db.models.signals import post_save
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 # from django.contrib.postgres.fields import JSONField
-from django.db.models import JSONField
+from django.db.models import F, JSONField
+from django.core.files import File
 from django.core.files.storage import FileSystemStorage
 from django.utils import timezone
 
@@ -17,6 +21,8 @@ from oauth_provider.consts import MAX_URL_LENGTH
 
 from .exceptions import BadRequest
 from .utils import get_lang
+from .utils.lookup_cache import verb_cache, activity_cache, agent_cache, credential_cache, oauth_cache, \
+    get_ifp_key, get_agent_ifp_keys
 
 AGENT_PROFILE_UPLOAD_TO = "agent_profile"
 ACTIVITY_STATE_UPLOAD_TO = "activity_state"
@@ -34,12 +40,42 @@ def attach_user(sender, **kwargs):
 
 post_save.connect(attach_user, sender=User)
 
+
+# Cached Basic auth credentials and OAuth tokens go whenever a user changes
+# (password, active flag), except for the last_login update made on every login
+def invalidate_user_credentials(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        credential_cache.invalidate()
+        oauth_cache.invalidate()
+
+post_save.connect(invalidate_user_credentials, sender=User)
+post_delete.connect(invalidate_user_credentials, sender=User)
+
+
+class RenderContext():
+    # Agents, verbs and activities already rendered for one response, most
+    # statements on a page share their actor, verb and parent activities
+    def __init__(self):
+        self.rendered = {}
+
+    def render(self, instance, lang, ids_only, render):
+        key = (type(instance), instance.pk, tuple(lang) if lang else None, ids_only)
+        if key not in self.rendered:
+            self.rendered[key] = render()
+        return self.rendered[key]
+
+
 class Verb(models.Model):
     verb_id = models.CharField(
         max_length=MAX_URL_LENGTH, db_index=True, unique=True)
     canonical_data = JSONField(default=dict)
+    # Changed every time canonical_data is saved, cached renderings of the
+    # statements that show the verb are only used while it matches
+    canonical_version = models.UUIDField(default=uuid.uuid4, editable=False)
 
-    def return_verb_with_lang(self, lang=None, ids_only=False):
+    def return_verb_with_lang(self, lang=None, ids_only=False, render_context=None):
+        if render_context is not None:
+            return render_context.render(self, lang, ids_only, lambda: self.return_verb_with_lang(lang, ids_only))
         if ids_only:
             return {'id': self.verb_id}
         ret = OrderedDict(self.canonical_data)
@@ -75,9 +111,13 @@ class AgentManager(models.Manager):
                 # Set ifp_dict and kwargs
                 ifp_dict['account_homePage'] = kwargs['account']['homePage']
                 ifp_dict['account_name'] = kwargs['account']['name']
+            agent = agent_cache.get_instance(Agent, get_ifp_key(kwargs))
+            if agent is not None:
+                return agent
             try:
                 # Try getting agent by IFP in ifp_dict
                 agent = Agent.objects.filter(**ifp_dict)[0]
+                agent_cache.set_instance(get_ifp_key(kwargs), agent)
                 return agent
             except IndexError:
                 return None
@@ -96,6 +136,12 @@ class AgentManager(models.Manager):
             member = kwargs.pop('member', None)
         # Create agent based on IFP
         if ifp_sent:
+            ifp_key = get_ifp_key(kwargs)
+            # Already looked up by this process - groups in the cache already
+            # exist so there are no members to add
+            agent = agent_cache.get_instance(Agent, ifp_key)
+            if agent is not None:
+                return agent, False
             # Get IFP
             ifp = ifp_sent[0]
             ifp_dict = {}
@@ -113,6 +159,7 @@ class AgentManager(models.Manager):
             try:
                 # Try getting agent by IFP in ifp_dict
                 agent = Agent.objects.filter(**ifp_dict)[0]
+                agent_cache.set_instance(ifp_key, agent)
                 created = False
             except IndexError:
                 # If DNE create the agent based off of kwargs (kwargs now
@@ -132,7 +179,6 @@ class AgentManager(models.Manager):
                 if created:
                     members = [self.retrieve_or_create(**a) for a in member]
                     agent.member.add(*(a for a, c in members))
-                    agent.save()
         # Only way it doesn't have IFP is if anonymous group
         else:
             agent, created = self.retrieve_or_create_anonymous_group(member, kwargs)
@@ -189,8 +235,13 @@ class AgentManager(models.Manager):
         return agent, created
 
     def oauth_group(self, **kwargs):
+        key = ('oauth_identifier', kwargs['oauth_identifier'])
+        g = agent_cache.get_instance(Agent, key)
+        if g is not None:
+            return g, False
         try:
             g = Agent.objects.get(oauth_identifier=kwargs['oauth_identifier'])
+            agent_cache.set_instance(key, g)
             return g, False
         except Agent.DoesNotExist:
             return Agent.objects.retrieve_or_create(**kwargs)
@@ -216,7 +267,9 @@ class Agent(models.Model):
     class Meta:
         unique_together = ("account_homePage", "account_name")
 
-    def to_dict(self, ids_only=False):
+    def to_dict(self, ids_only=False, render_context=None):
+        if render_context is not None:
+            return render_context.render(self, None, ids_only, lambda: self.to_dict(ids_only))
         ret = OrderedDict()
         if self.mbox:
             ret['mbox'] = self.mbox
@@ -233,9 +286,9 @@ class Agent(models.Model):
             # show members for groups if ids_only is false
             # show members' ids for anon groups if ids_only is true
             if not ids_only or not (set(['mbox', 'mbox_sha1sum', 'openid', 'account']) & set(ret.keys())):
-                if self.member.all():
-                    ret['member'] = [a.to_dict(ids_only)
-                                     for a in self.member.all()]
+                members = self.member.all()
+                if members:
+                    ret['member'] = [a.to_dict(ids_only) for a in members]
 
         ret['objectType'] = self.objectType
         if self.name and not ids_only:
@@ -332,9 +385,14 @@ class ContextGroup(models.Model):
 class Activity(models.Model):
     activity_id = models.CharField(max_length=MAX_URL_LENGTH, db_index=True, unique=True)
     canonical_data = JSONField(default=dict)
+    # Same as Verb.canonical_version
+    canonical_version = models.UUIDField(default=uuid.uuid4, editable=False)
     authority = models.ForeignKey(Agent, null=True, on_delete=models.CASCADE)
 
-    def return_activity_with_lang_format(self, lang=None, ids_only=False):
+    def return_activity_with_lang_format(self, lang=None, ids_only=False, render_context=None):
+        if render_context is not None:
+            return render_context.render(self, lang, ids_only,
+                                         lambda: self.return_activity_with_lang_format(lang, ids_only))
         if ids_only:
             return {'id': self.activity_id}
         
@@ -380,6 +438,42 @@ class Activity(models.Model):
         return json.dumps(self.canonical_data, sort_keys=False)
 
 
+# Keep the lookup caches in step with the rows they hold
+def update_verb_lookup(sender, instance, created, **kwargs):
+    verb_cache.update_instance([instance.verb_id], instance, created)
+
+def delete_verb_lookup(sender, instance, **kwargs):
+    verb_cache.delete_instance([instance.verb_id])
+
+def update_activity_lookup(sender, instance, created, **kwargs):
+    activity_cache.update_instance([instance.activity_id], instance, created)
+
+def delete_activity_lookup(sender, instance, **kwargs):
+    activity_cache.delete_instance([instance.activity_id])
+
+def update_agent_lookup(sender, instance, created, **kwargs):
+    agent_cache.update_instance(get_agent_ifp_keys(instance), instance, created)
+
+def delete_agent_lookup(sender, instance, **kwargs):
+    agent_cache.delete_instance(get_agent_ifp_keys(instance))
+
+post_save.connect(update_verb_lookup, sender=Verb)
+post_delete.connect(delete_verb_lookup, sender=Verb)
+post_save.connect(update_activity_lookup, sender=Activity)
+post_delete.connect(delete_activity_lookup, sender=Activity)
+post_save.connect(update_agent_lookup, sender=Agent)
+post_delete.connect(delete_agent_lookup, sender=Agent)
+
+
+# The credential cache holds the agent of each user too
+def invalidate_agent_credentials(sender, instance, **kwargs):
+    if instance.user_id:
+        credential_cache.invalidate()
+
+post_save.connect(invalidate_agent_credentials, sender=Agent)
+post_delete.connect(invalidate_agent_credentials, sender=Agent)
+
+
 class SubStatement(models.Model):
     object_agent = models.ForeignKey(
         Agent, related_name="object_of_substatement", on_delete=models.SET_NULL, null=True, db_index=True)
@@ -425,20 +519,20 @@ class SubStatement(models.Model):
     # context also has a stmt field which is a statementref
     context_statement = models.CharField(max_length=40, blank=True)
 
-    def to_dict(self, lang=None, ids_only=False):
+    def to_dict(self, lang=None, ids_only=False, render_context=None):
         ret = OrderedDict()
 
         assert isinstance(self.actor, Agent)
         assert isinstance(self.verb, Verb)
 
-        ret['actor'] = self.actor.to_dict(ids_only)
-        ret['verb'] = self.verb.return_verb_with_lang(lang, ids_only)
+        ret['actor'] = self.actor.to_dict(ids_only, render_context)
+        ret['verb'] = self.verb.return_verb_with_lang(lang, ids_only, render_context)
 
         if self.object_agent:
-            ret['object'] = self.object_agent.to_dict(ids_only)
+            ret['object'] = self.object_agent.to_dict(ids_only, render_context)
         elif self.object_activity:
             ret['object'] = self.object_activity.return_activity_with_lang_format(
-                lang, ids_only)
+                lang, ids_only, render_context)
         else:
             ret['object'] = {
                 'id': str(self.object_statementref), 'objectType': 'StatementRef'}
@@ -476,9 +570,9 @@ class SubStatement(models.Model):
             ret['context']['registration'] = self.context_registration
         if self.context_instructor:
             ret['context'][
-                'instructor'] = self.context_instructor.to_dict(ids_only)
+                'instructor'] = self.context_instructor.to_dict(ids_only, render_context)
         if self.context_team:
-            ret['context']['team'] = self.context_team.to_dict(ids_only)
+            ret['context']['team'] = self.context_team.to_dict(ids_only, render_context)
         if self.context_revision:
             ret['context']['revision'] = self.context_revision
         if self.context_platform:
@@ -490,18 +584,22 @@ class SubStatement(models.Model):
                 'id': self.context_statement, 'objectType': 'StatementRef'}
 
         ret['context']['contextActivities'] = OrderedDict()
-        if self.context_ca_parent.all():
+        parent_activities = self.context_ca_parent.all()
+        if parent_activities:
             ret['context']['contextActivities']['parent'] = [cap.return_activity_with_lang_format(
-                lang, ids_only) for cap in self.context_ca_parent.all()]
-        if self.context_ca_grouping.all():
+                lang, ids_only, render_context) for cap in parent_activities]
+        grouping_activities = self.context_ca_grouping.all()
+        if grouping_activities:
             ret['context']['contextActivities']['grouping'] = [cag.return_activity_with_lang_format(
-                lang, ids_only) for cag in self.context_ca_grouping.all()]
-        if self.context_ca_category.all():
+                lang, ids_only, render_context) for cag in grouping_activities]
+        category_activities = self.context_ca_category.all()
+        if category_activities:
             ret['context']['contextActivities']['category'] = [cac.return_activity_with_lang_format(
-                lang, ids_only) for cac in self.context_ca_category.all()]
-        if self.context_ca_other.all():
+                lang, ids_only, render_context) for cac in category_activities]
+        other_activities = self.context_ca_other.all()
+        if other_activities:
             ret['context']['contextActivities']['other'] = [cao.return_activity_with_lang_format(
-                lang, ids_only) for cao in self.context_ca_other.all()]
+                lang, ids_only, render_context) for cao in other_activities]
         if self.context_extensions:
             ret['context']['extensions'] = self.context_extensions
         if not ret['context']['contextActivities']:
@@ -598,7 +696,11 @@ class Statement(models.Model):
                              db_index=True, on_delete=models.SET_NULL)
     full_statement = JSONField()
 
-    def to_dict(self, lang=None, ret_format='exact'):
+    class Meta:
+        # Order statements/more pages are read in
+        indexes = [models.Index(fields=['stored', 'id'])]
+
+    def to_dict(self, lang=None, ret_format='exact', render_context=None):
         ret = OrderedDict()
         if ret_format == 'exact':
             return self.full_statement
@@ -609,16 +711,16 @@ class Statement(models.Model):
         assert isinstance(self.actor, Agent)
         assert isinstance(self.verb, Verb)
 
-        ret['actor'] = self.actor.to_dict(ids_only)
-        ret['verb'] = self.verb.return_verb_with_lang(lang, ids_only)
+        ret['actor'] = self.actor.to_dict(ids_only, render_context)
+        ret['verb'] = self.verb.return_verb_with_lang(lang, ids_only, render_context)
 
         if self.object_agent:
-            ret['object'] = self.object_agent.to_dict(ids_only)
+            ret['object'] = self.object_agent.to_dict(ids_only, render_context)
         elif self.object_activity:
             ret['object'] = self.object_activity.return_activity_with_lang_format(
-                lang, ids_only)
+                lang, ids_only, render_context)
         elif self.object_substatement:
-            ret['object'] = self.object_substatement.to_dict(lang, ids_only)
+            ret['object'] = self.object_substatement.to_dict(lang, ids_only, render_context)
         else:
             ret['object'] = {
                 'id': str(self.object_statementref), 'objectType': 'StatementRef'}
@@ -655,9 +757,9 @@ class Statement(models.Model):
             ret['context']['registration'] = self.context_registration
         if self.context_instructor:
             ret['context'][
-                'instructor'] = self.context_instructor.to_dict(ids_only)
+                'instructor'] = self.context_instructor.to_dict(ids_only, render_context)
         if self.context_team:
-            ret['context']['team'] = self.context_team.to_dict(ids_only)
+            ret['context']['team'] = self.context_team.to_dict(ids_only, render_context)
         if self.context_revision:
             ret['context']['revision'] = self.context_revision
         if self.context_platform:
@@ -670,21 +772,25 @@ class Statement(models.Model):
 
         ret['context']['contextActivities'] = OrderedDict()
         
-        if self.context_ca_parent.all():
+        parent_activities = self.context_ca_parent.all()
+        if parent_activities:
             ret['context']['contextActivities']['parent'] = [cap.return_activity_with_lang_format(
-                lang, ids_only) for cap in self.context_ca_parent.all()]
+                lang, ids_only, render_context) for cap in parent_activities]
         
-        if self.context_ca_grouping.all():
+        grouping_activities = self.context_ca_grouping.all()
+        if grouping_activities:
             ret['context']['contextActivities']['grouping'] = [cag.return_activity_with_lang_format(
-                lang, ids_only) for cag in self.context_ca_grouping.all()]
+                lang, ids_only, render_context) for cag in grouping_activities]
         
-        if self.context_ca_category.all():
+        category_activities = self.context_ca_category.all()
+        if category_activities:
             ret['context']['contextActivities']['category'] = [cac.return_activity_with_lang_format(
-                lang, ids_only) for cac in self.context_ca_category.all()]
+                lang, ids_only, render_context) for cac in category_activities]
         
-        if self.context_ca_other.all():
+        other_activities = self.context_ca_other.all()
+        if other_activities:
             ret['context']['contextActivities']['other'] = [cao.return_activity_with_lang_format(
-                lang, ids_only) for cao in self.context_ca_other.all()]
+                lang, ids_only, render_context) for cao in other_activities]
         
         if self.context_extensions:
             ret['context']['extensions'] = self.context_extensions
@@ -705,7 +811,7 @@ class Statement(models.Model):
         ret['version'] = self.version
         
         if self.authority is not None:
-            ret['authority'] = self.authority.to_dict(ids_only)
+            ret['authority'] = self.authority.to_dict(ids_only, render_context)
         
         attachments_relation = getattr(self, "stmt_attachments", None)
         if (attachments_relation is not None):
@@ -733,24 +839,152 @@ class Statement(models.Model):
         return json.dumps(self.to_dict(), sort_keys=False)
 
 
+class StatementAgent(models.Model):
+    # Every agent a statement refers to and in what role, written when the
+    # statement is stored so agent filters are a single indexed lookup
+    DIRECT_ROLES = ['actor', 'object']
+    RELATED_ROLES = DIRECT_ROLES + ['authority', 'instructor', 'team', 'substatement_actor', 'substatement_object',
+                                    'substatement_instructor', 'substatement_team']
+
+    statement = models.ForeignKey(Statement, related_name="agent_index", on_delete=models.CASCADE)
+    agent = models.ForeignKey(Agent, related_name="statement_index", on_delete=models.CASCADE)
+    role = models.CharField(max_length=24)
+
+    class Meta:
+        unique_together = ("statement", "agent", "role")
+        indexes = [models.Index(fields=['agent', 'role', 'statement'])]
+
+    @classmethod
+    def for_statement(cls, stmt):
+        roles = [('actor', stmt.actor_id), ('object', stmt.object_agent_id), ('authority', stmt.authority_id),
+                 ('instructor', stmt.context_instructor_id), ('team', stmt.context_team_id)]
+        sub = stmt.object_substatement
+        if sub:
+            roles += [('substatement_actor', sub.actor_id), ('substatement_object', sub.object_agent_id),
+                      ('substatement_instructor', sub.context_instructor_id),
+                      ('substatement_team', sub.context_team_id)]
+        return [cls(statement=stmt, agent_id=agent_id, role=role) for role, agent_id in roles if agent_id]
+
+
+class StatementActivity(models.Model):
+    # Every activity a statement refers to and how, written when the statement
+    # is stored so activity filters are a single indexed lookup
+    CONTEXT_RELATIONS = ['parent', 'grouping', 'category', 'other']
+    RELATED_RELATIONS = ['object'] + CONTEXT_RELATIONS + ['substatement_' + r for r in ['object'] + CONTEXT_RELATIONS]
+
+    statement = models.ForeignKey(Statement, related_name="activity_index", on_delete=models.CASCADE)
+    activity = models.ForeignKey(Activity, related_name="statement_index", on_delete=models.CASCADE)
+    relation = models.CharField(max_length=24)
+
+    class Meta:
+        unique_together = ("statement", "activity", "relation")
+        indexes = [models.Index(fields=['activity', 'relation', 'statement'])]
+
+    @classmethod
+    def for_statement(cls, stmt, context_activities, substatement_context_activities):
+        # Context activities are (relation, activity) pairs
+        relations = [('object', stmt.object_activity_id)] + [(r, a.pk) for r, a in context_activities]
+        sub = stmt.object_substatement
+        if sub:
+            relations += [('substatement_object', sub.object_activity_id)] + \
+                [('substatement_' + r, a.pk) for r, a in substatement_context_activities]
+        # An activity can be listed more than once under the same relation
+        return [cls(statement=stmt, activity_id=activity_id, relation=relation)
+                for relation, activity_id in dict.fromkeys(relations) if activity_id]
+
+
+def get_payload_path(sha2):
+    # Payloads are named by their sha2 and sharded on its first four hex
+    # digits, e.g. attachment_payloads/ab/cd/<sha2>, so no one directory ends
+    # up holding every payload
+    return '%s/%s/%s/%s' % (STATEMENT_ATTACHMENT_UPLOAD_TO, sha2[:2], sha2[2:4], sha2)
+
+
+def get_payload_upload_to(instance, filename):
+    return get_payload_path(filename)
+
+
 class AttachmentFileSystemStorage(FileSystemStorage):
 
     def get_available_name(self, name, max_length=None):
         return name
 
-    def save(self, name: str, content, max_length=None):
-        if self.exists(name):
-            # if the file exists, do not call the superclasses _save method
+    def _save(self, name, content):
+        full_path = self.path(name)
+        # Same name means same content, only the first copy is written
+        if os.path.exists(full_path):
             return name
-        
-        # if the file is new, DO call it
-        return super(FileSystemStorage, self).save(name, content, max_length=max_length)
+
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        # Written under a temporary name and moved into place once the hash
+        # checks out so a reader never sees a partial payload
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            sha256 = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    sha256.update(chunk)
+                    f.write(chunk)
+            if sha256.hexdigest() != os.path.basename(name):
+                raise BadRequest("Attachment payload did not match its sha2 %s" % os.path.basename(name))
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            os.replace(tmp_path, full_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return name
+
+
+attachment_storage = AttachmentFileSystemStorage()
+
+
+class AttachmentPayloadManager(models.Manager):
+
+    def store(self, payloads, counts):
+        # payloads maps sha2 to an open file and counts how many new
+        # attachments reference it. References are taken with the rows locked
+        # before the files are written. The gc deletes a file while holding
+        # its row, so a payload that is about to be reused is either left
+        # alone or already gone, in which case the row is created again and
+        # the file written again
+        now = timezone.now()
+        with transaction.atomic():
+            missing = list(counts)
+            while missing:
+                self.bulk_create([self.model(sha2=sha2, size=File(payloads[sha2]).size, updated=now)
+                                  for sha2 in missing], ignore_conflicts=True)
+                locked = set(self.select_for_update().filter(sha2__in=missing).values_list('sha2', flat=True))
+                missing = [sha2 for sha2 in missing if sha2 not in locked]
+            for count in set(counts.values()):
+                self.filter(sha2__in=[sha2 for sha2, c in counts.items() if c == count]) \
+                    .update(ref_count=F('ref_count') + count, updated=now)
+            for sha2 in counts:
+                attachment_storage.save(get_payload_path(sha2), File(payloads[sha2]))
+
+    def release(self, sha2):
+        # Unreferenced payloads are left for gc_attachment_payloads
+        self.filter(sha2=sha2, ref_count__gt=0).update(ref_count=F('ref_count') - 1, updated=timezone.now())
+
+
+class AttachmentPayload(models.Model):
+    # One row per stored payload file, counting the attachments that use it
+    sha2 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0, db_index=True)
+    updated = models.DateTimeField(default=timezone.now)
+    objects = AttachmentPayloadManager()
+
+    def __unicode__(self):
+        return self.sha2
 
 
 class StatementAttachment(models.Model):
     canonical_data = JSONField(default=dict)
-    payload = models.FileField(max_length=400, upload_to=STATEMENT_ATTACHMENT_UPLOAD_TO,
-                               storage=AttachmentFileSystemStorage(), null=True)
+    payload = models.FileField(max_length=400, upload_to=get_payload_upload_to,
+                               storage=attachment_storage, null=True)
     statement = models.ForeignKey(
         Statement, related_name="stmt_attachments", null=True, on_delete=models.CASCADE)
 
@@ -767,6 +1001,14 @@ class StatementAttachment(models.Model):
         return json.dumps(self.canonical_data, sort_keys=False)
 
 
+# Deleting a statement deletes its attachments, which gives up their payloads
+def release_attachment_payload(sender, instance, **kwargs):
+    if instance.payload:
+        AttachmentPayload.objects.release(os.path.basename(instance.payload.name))
+
+post_delete.connect(release_attachment_payload, sender=StatementAttachment)
+
+
 class ActivityState(models.Model):
     state_id = models.CharField(max_length=MAX_URL_LENGTH)
     updated = models.DateTimeField(auto_now_add=True, blank=True, db_index=True)
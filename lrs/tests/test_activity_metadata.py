@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..models import Activity
+from ..tasks import resolve_activity_metadata
+from ..utils.activity_metadata import get_metadata_key, is_resolvable
+from ..utils.lookup_cache import clear_lookup_caches
+
+
+class ActivityServer(HTTPServer):
+    # Serves the documents set by the tests and records the requests
+
+    def __init__(self):
+        super(ActivityServer, self).__init__(('127.0.0.1', 0), ActivityHandler)
+        self.documents = {}
+        self.requests = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_port
+
+
+class ActivityHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        document = self.server.documents.get(self.path, None)
+        if document is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body, etag = document
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(ACTIVITY_ID_RESOLVE_TIMEOUT=5, ACTIVITY_METADATA_TTL=3600, ACTIVITY_METADATA_FAILURE_TTL=600)
+class ActivityMetadataTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        caches['activity_metadata'].clear()
+        self.server = ActivityServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.now = time.time()
+
+    def add_activity(self, path):
+        act_id = self.server.url + path
+        return Activity.objects.create(activity_id=act_id, canonical_data={'id': act_id, 'objectType': 'Activity'})
+
+    def resolve(self, activities, after=0):
+        # As if it ran the given seconds after the first time
+        with mock.patch('lrs.utils.activity_metadata.time') as clock:
+            clock.time.return_value = self.now + after
+            resolve_activity_metadata([act.activity_id for act in activities])
+        for act in activities:
+            act.refresh_from_db()
+
+    def test_ttl(self):
+        act = self.add_activity("/found")
+        missing = self.add_activity("/missing")
+        self.server.documents["/found"] = ({"name": {"en-US": "found"}}, None)
+        self.resolve([act, missing])
+        self.assertEqual(act.canonical_data['definition'], {"name": {"en-US": "found"}})
+        self.assertNotIn('definition', missing.canonical_data)
+        self.assertEqual(sorted(path for path, _ in self.server.requests), ["/found", "/missing"])
+
+        # Neither is fetched again while fresh, the missing one is sooner
+        self.resolve([act, missing], 599)
+        self.assertEqual(len(self.server.requests), 2)
+        self.resolve([act, missing], 601)
+        self.assertEqual([path for path, _ in self.server.requests[2:]], ["/missing"])
+        self.resolve([act, missing], 3601)
+        self.assertEqual(sorted(path for path, _ in self.server.requests[3:]), ["/found", "/missing"])
+
+    def test_revalidation(self):
+        act = self.add_activity("/etag")
+        self.server.documents["/etag"] = ({"name": {"en-US": "v1"}}, '"v1"')
+        self.resolve([act])
+        version = act.canonical_version
+        self.assertNotIn('If-None-Match', self.server.requests[0][1])
+
+        # Unchanged, a 304 leaves the activity alone and keeps it fresh
+        self.resolve([act], 3601)
+        headers = self.server.requests[1][1]
+        self.assertEqual((headers['If-None-Match'], headers['If-Modified-Since']),
+                         ('"v1"', 'Mon, 01 Jan 2024 00:00:00 GMT'))
+        self.assertEqual(act.canonical_version, version)
+        entry = caches['activity_metadata'].get(get_metadata_key(act.activity_id))
+        self.assertEqual((entry['resolved'], entry['etag'], entry['fresh_until']),
+                         (True, '"v1"', self.now + 3601 + 3600))
+
+        self.server.documents["/etag"] = ({"name": {"en-US": "v2"}}, '"v2"')
+        self.resolve([act], 7202)
+        self.assertEqual(act.canonical_data['definition'], {"name": {"en-US": "v2"}})
+        self.assertNotEqual(act.canonical_version, version)
+        self.assertEqual(caches['activity_metadata'].get(get_metadata_key(act.activity_id))['etag'], '"v2"')
+
+    def test_canonical_version(self):
+        act = self.add_activity("/doc")
+        self.server.documents["/doc"] = ({"name": {"en-US": "doc"}}, None)
+        self.resolve([act])
+        version = act.canonical_version
+        # The same document again doesn't throw away cached renders
+        self.resolve([act], 3601)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(act.canonical_version, version)
+
+        self.server.documents["/doc"] = ({"name": {"en-US": "doc"}, "description": {"en-US": "new"}}, None)
+        self.resolve([act], 7202)
+        self.assertEqual(act.canonical_data['definition']['description'], {"en-US": "new"})
+        self.assertNotEqual(act.canonical_version, version)
+
+    def test_invalid_document(self):
+        act = self.add_activity("/invalid")
+        self.server.documents["/invalid"] = ({"name": "not a language map"}, None)
+        version = act.canonical_version
+        self.resolve([act])
+        self.assertNotIn('definition', act.canonical_data)
+        self.assertEqual(act.canonical_version, version)
+
+    def test_resolvable(self):
+        self.assertTrue(is_resolvable("HTTPS://example.com/activity"))
+        for act_id in ["file:///etc/passwd", "ftp://example.com/activity", "urn:example:activity", "tag:a,2024:b"]:
+            self.assertFalse(is_resolvable(act_id), act_id)
@@ -0,0 +1,155 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from ..models import AttachmentPayload, Statement, attachment_storage, get_payload_path
+from ..utils.lookup_cache import clear_lookup_caches
+from ..utils.multipart import parse_multipart
+
+
+class AttachmentTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        self.media_root = tempfile.mkdtemp()
+        self.media = override_settings(MEDIA_ROOT=self.media_root)
+        self.media.enable()
+        self.username = "tom"
+        self.password = "1234"
+        self.auth = "Basic %s" % base64.b64encode(
+            ("%s:%s" % (self.username, self.password)).encode()).decode()
+        User.objects.create_user(self.username, "tom@example.com", self.password)
+
+    def tearDown(self):
+        self.media.disable()
+        shutil.rmtree(self.media_root)
+
+    def post_with_attachment(self, stmt, payload, line_break=b"\r\n", closing=True):
+        sha2 = hashlib.sha256(payload).hexdigest()
+        stmt['attachments'] = [{"usageType": "http://example.com/attachment-usage/test",
+                                "display": {"en-US": "A test attachment"},
+                                "contentType": "text/plain", "length": len(payload), "sha2": sha2}]
+        body = line_break.join([b"--boundary", b"Content-Type: application/json", b"", json.dumps(stmt).encode(),
+                             b"--boundary", b"Content-Type: text/plain", b"Content-Transfer-Encoding: binary",
+                             b"X-Experience-API-Hash: " + sha2.encode(), b"", payload]
+                                 + ([b"--boundary--"] if closing else []))
+        return self.client.post(reverse('lrs:statements'), body, content_type='multipart/mixed; boundary=boundary',
+                                Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+
+    def get_body(self, params):
+        resp = self.client.get(reverse('lrs:statements'), params, Authorization=self.auth,
+                               X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 200)
+        body = b"".join(resp.streaming_content)
+        self.assertEqual(len(body), int(resp['Content-Length']))
+        return body
+
+    def test_mixed_case_statement_id(self):
+        # The exact format keeps the ID as it was sent
+        stmt_id = "3C2E4E0B-9D4B-4C2A-8A55-0A7C1E5B6F3D"
+        payload = b"howdy.. this is a text attachment"
+        resp = self.post_with_attachment({"id": stmt_id, "actor": {"mbox": "mailto:tom@example.com"},
+                                          "verb": {"id": "http://example.com/verbs/attached"},
+                                          "object": {"id": "act:test/attachment"}}, payload)
+        self.assertEqual(resp.status_code, 200)
+
+        for params in [{"statementId": stmt_id, "attachments": "true", "format": "exact"},
+                       {"attachments": "true", "format": "exact"},
+                       {"statementId": stmt_id.lower(), "attachments": "true"}]:
+            body = self.get_body(params)
+            self.assertIn(stmt_id.lower(), body.decode().lower())
+            self.assertIn(b"\r\n" + payload + b"\r\n", body)
+
+    def test_lf_line_breaks(self):
+        payload = b"attachment sent with bare LF line breaks"
+        resp = self.post_with_attachment({"actor": {"mbox": "mailto:tom@example.com"},
+                                          "verb": {"id": "http://example.com/verbs/attached"},
+                                          "object": {"id": "act:test/attachment"}}, payload, b"\n")
+        self.assertEqual(resp.status_code, 200)
+        stmt_id = json.loads(resp.content)[0]
+        self.assertIn(b"\r\n" + payload + b"\r\n", self.get_body({"statementId": stmt_id, "attachments": "true"}))
+
+    def test_too_large(self):
+        stmt = {"actor": {"mbox": "mailto:tom@example.com"}, "verb": {"id": "http://example.com/verbs/attached"},
+                "object": {"id": "act:test/attachment"}}
+        with self.settings(MULTIPART_MAX_BODY_SIZE=2048):
+            self.assertEqual(self.post_with_attachment(dict(stmt), b"x" * 4096).status_code, 413)
+        with self.settings(MULTIPART_MAX_PART_SIZE=1024):
+            self.assertEqual(self.post_with_attachment(dict(stmt), b"x" * 2048).status_code, 413)
+            self.assertEqual(self.post_with_attachment(dict(stmt), b"x" * 512).status_code, 200)
+
+    def test_missing_closing_boundary(self):
+        resp = self.post_with_attachment({"actor": {"mbox": "mailto:tom@example.com"},
+                                          "verb": {"id": "http://example.com/verbs/attached"},
+                                          "object": {"id": "act:test/attachment"}}, b"cut short", closing=False)
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(Statement.objects.exists())
+
+    def test_response_parts(self):
+        payloads = [b"first payload", b"second payload", b"first payload"]
+        for payload in payloads:
+            self.assertEqual(self.post_with_attachment({"actor": {"mbox": "mailto:tom@example.com"},
+                                                        "verb": {"id": "http://example.com/verbs/attached"},
+                                                        "object": {"id": "act:test/attachment"}},
+                                                       payload).status_code, 200)
+        resp = self.client.get(reverse('lrs:statements'), {"attachments": "true", "ascending": "true"},
+                               Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        body = b"".join(resp.streaming_content)
+        self.assertEqual(len(body), int(resp['Content-Length']))
+        parts = parse_multipart(io.BytesIO(body), resp['Content-Type'])
+        self.assertEqual(len(json.loads(parts[0].read())['statements']), 3)
+        # A payload is sent for every attachment, in statement order
+        self.assertEqual([part.read() for part in parts[1:]], payloads)
+        for part in parts[1:]:
+            self.assertEqual(part['Content-Type'], "text/plain")
+            self.assertEqual(part['X-Experience-API-Hash'], part.hexdigest())
+
+    def test_release_on_delete(self):
+        payload = b"payload released by each statement"
+        sha2 = hashlib.sha256(payload).hexdigest()
+        stmt = {"actor": {"mbox": "mailto:tom@example.com"}, "verb": {"id": "http://example.com/verbs/attached"},
+                "object": {"id": "act:test/attachment"}}
+        stmt_ids = [json.loads(self.post_with_attachment(dict(stmt), payload).content)[0] for _ in range(2)]
+        self.assertEqual(AttachmentPayload.objects.get(sha2=sha2).ref_count, 2)
+        Statement.objects.filter(statement_id=stmt_ids[0]).delete()
+        self.assertEqual(AttachmentPayload.objects.get(sha2=sha2).ref_count, 1)
+        # Still in use, the gc keeps it
+        call_command('gc_attachment_payloads', min_age=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(attachment_storage.path(get_payload_path(sha2))))
+        self.assertIn(b"\r\n" + payload + b"\r\n", self.get_body({"statementId": stmt_ids[1], "attachments": "true"}))
+        Statement.objects.filter(statement_id=stmt_ids[1]).delete()
+        self.assertEqual(AttachmentPayload.objects.get(sha2=sha2).ref_count, 0)
+
+    def test_payload_reuse_and_gc(self):
+        payload = b"payload shared by two statements"
+        sha2 = hashlib.sha256(payload).hexdigest()
+        path = attachment_storage.path(get_payload_path(sha2))
+        stmt = {"actor": {"mbox": "mailto:tom@example.com"}, "verb": {"id": "http://example.com/verbs/attached"},
+                "object": {"id": "act:test/attachment"}}
+        self.assertEqual(self.post_with_attachment(dict(stmt), payload).status_code, 200)
+        # A file gone while its row was left is written again when reused
+        os.remove(path)
+        self.assertEqual(self.post_with_attachment(dict(stmt), payload).status_code, 200)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(AttachmentPayload.objects.get(sha2=sha2).ref_count, 2)
+
+        call_command('gc_attachment_payloads', min_age=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(path))
+        Statement.objects.all().delete()
+        self.assertEqual(AttachmentPayload.objects.get(sha2=sha2).ref_count, 0)
+        call_command('gc_attachment_payloads', min_age=0, stdout=StringIO())
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(AttachmentPayload.objects.filter(sha2=sha2).exists())
@@ -0,0 +1,43 @@
+import base64
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+
+from ..utils.lookup_cache import clear_lookup_caches, credential_cache
+
+
+class CredentialCacheTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        self.user = User.objects.create_user("tom", "tom@example.com", "1234")
+
+    def get_status(self, password):
+        auth = "Basic %s" % base64.b64encode(("tom:%s" % password).encode()).decode()
+        return self.client.get(reverse('lrs:statements'), Authorization=auth,
+                               X_Experience_API_Version=settings.XAPI_VERSION).status_code
+
+    def test_change_by_other_worker(self):
+        self.assertEqual(self.get_status("1234"), 200)
+        hits = credential_cache.stats()['hits']
+        self.assertEqual(self.get_status("1234"), 200)
+        self.assertEqual(credential_cache.stats()['hits'], hits + 1)
+
+        # Another worker changes the password, which only reaches this one
+        # through the shared generation
+        User.objects.filter(pk=self.user.pk).update(password=make_password("5678"))
+        cache.set(credential_cache.generation_key, uuid.uuid4().hex, None)
+        self.assertEqual(self.get_status("1234"), 401)
+        self.assertEqual(self.get_status("5678"), 200)
+
+    def test_deactivated_user(self):
+        self.assertEqual(self.get_status("1234"), 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get_status("1234"), 401)
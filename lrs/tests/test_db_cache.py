@@ -0,0 +1,35 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from ..utils.db_cache import BatchedDatabaseCache
+
+
+class BatchedDatabaseCacheTests(TestCase):
+
+    def setUp(self):
+        # Same table as the activity metadata cache, created for the tests
+        self.cache = BatchedDatabaseCache('activity_metadata_cache', {})
+        self.cache.clear()
+
+    def test_set_many_replaces_values(self):
+        self.cache.set('b', 'old')
+        self.assertEqual(self.cache.set_many({'a': 1, 'b': {'new': True}}), [])
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': {'new': True}})
+
+    def test_set_many_queries(self):
+        counts = []
+        for size in [5, 50]:
+            with CaptureQueriesContext(connection) as ctx:
+                self.cache.set_many({'key-%d-%d' % (size, i): i for i in range(size)})
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(self.cache.get('key-50-49'), 49)
+
+    def test_set_many_culls(self):
+        cache = BatchedDatabaseCache('activity_metadata_cache', {'OPTIONS': {'MAX_ENTRIES': 10}})
+        for start in range(0, 24, 8):
+            cache.set_many({'key-%d' % i: i for i in range(start, start + 8)})
+        # Culled like DatabaseCache, before the last batch was written
+        self.assertLess(len(cache.get_many(['key-%d' % i for i in range(24)])), 24)
+        self.assertEqual(cache.get('key-23'), 23)
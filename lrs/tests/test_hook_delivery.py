@@ -0,0 +1,51 @@
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+
+from adl_lrs.models import Hook, HookDelivery
+
+from ..utils import hook_delivery
+
+
+class HookDeliveryTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user("tom", "tom@example.com", "1234")
+        self.hook = Hook.objects.create(name="hook", user=user, config={"endpoint": "http://example.com/hook"},
+                                        filters={"verb": [{"id": "http://example.com/verbs/attended"}]})
+        cache.delete(hook_delivery.PENDING_KEY % self.hook.hook_id)
+        self.post = mock.patch.object(hook_delivery.endpoint_pool, 'post',
+                                      return_value=mock.Mock(status_code=200)).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_window(self):
+        self.assertEqual(hook_delivery.enqueue(self.hook.hook_id, [{"id": "1"}]), settings.HOOK_DELIVERY_WINDOW)
+        # Later statements of the window go with the delivery already coming
+        self.assertIsNone(hook_delivery.enqueue(self.hook.hook_id, [{"id": "2"}]))
+        self.assertIsNone(hook_delivery.deliver(self.hook.hook_id))
+        self.assertEqual(self.post.call_count, 1)
+        self.assertFalse(HookDelivery.objects.exists())
+        # The delivery ended the window
+        self.assertEqual(hook_delivery.enqueue(self.hook.hook_id, [{"id": "3"}]), settings.HOOK_DELIVERY_WINDOW)
+
+    def test_queued_while_delivering(self):
+        hook_delivery.enqueue(self.hook.hook_id, [{"id": "1"}])
+        claim = hook_delivery.claim
+        queued = []
+
+        def claim_and_queue(hook_id):
+            # Statements queued once the delivery found nothing left, before
+            # the window ran out
+            deliveries = claim(hook_id)
+            if not deliveries and not queued:
+                queued.append(hook_delivery.enqueue(hook_id, [{"id": "2"}]))
+            return deliveries
+
+        with mock.patch.object(hook_delivery, 'claim', claim_and_queue):
+            self.assertIsNone(hook_delivery.deliver(self.hook.hook_id))
+        self.assertEqual(queued, [None])
+        self.assertEqual(self.post.call_count, 2)
+        self.assertFalse(HookDelivery.objects.exists())
@@ -0,0 +1,182 @@
+import base64
+import copy
+import json
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Q
+from django.test import TestCase
+from django.urls import reverse
+
+from adl_lrs.models import Hook
+
+from ..models import Agent, Statement
+from ..utils.hook_matcher import CompiledHooks, GENERATION_KEY, hook_matcher
+from ..utils.lookup_cache import clear_lookup_caches
+
+ACTIVITY = "http://example.com/activities/%d"
+VERB = "http://example.com/verbs/%d"
+
+
+def agent(name):
+    return {"mbox": "mailto:%s@example.com" % name}
+
+
+def activity(i):
+    return {"id": ACTIVITY % i}
+
+
+def verb(i):
+    return {"id": VERB % i}
+
+
+GROUP = {"objectType": "Group", "mbox": "mailto:group@example.com", "member": [agent("a"), agent("d")]}
+
+STATEMENTS = [
+    {"actor": agent("a"), "verb": verb(1), "object": activity(1)},
+    {"actor": agent("b"), "verb": verb(2), "object": activity(2),
+     "context": {"instructor": agent("c"), "contextActivities": {"parent": [activity(1)]}}},
+    {"actor": agent("a"), "verb": verb(2), "object": dict(agent("b"), objectType="Agent")},
+    {"actor": GROUP, "verb": verb(1),
+     "object": {"objectType": "SubStatement", "actor": agent("c"), "verb": verb(3), "object": activity(3),
+                "context": {"contextActivities": {"grouping": [activity(4)]}}}},
+    {"actor": agent("b"), "verb": verb(1), "object": activity(5),
+     "context": {"team": GROUP, "contextActivities": {"category": [activity(3)], "other": [activity(2)]}}},
+    {"actor": agent("a"), "verb": verb(3), "object": activity(4)},
+]
+
+FILTERS = [
+    None,
+    {},
+    {"actor": [agent("a")]},
+    {"actor": [agent("a"), agent("b")]},
+    {"verb": [verb(1)]},
+    {"verb": [verb(1), verb(2)]},
+    # Only the statement's own object, not a substatement's
+    {"object": [activity(1), activity(3)]},
+    {"actor": [agent("a")], "verb": [verb(2), verb(3)]},
+    {"verb": [verb(1)], "object": [activity(1), activity(5)]},
+    {"related": [activity(1)]},
+    {"related": [activity(3)]},
+    {"related": [agent("c")]},
+    {"related": [agent("b")]},
+    {"related": [GROUP]},
+    {"related": [agent("tom")]},
+    {"related": [activity(1), agent("c")]},
+    {"related": [activity(4), activity(5)]},
+    {"related": [{"and": [activity(2), agent("b")]}]},
+    {"related": [{"and": [activity(3), {"or": [agent("c"), agent("a")]}]}]},
+    {"related": [{"or": [activity(4), agent("a")]}, activity(5)]},
+    {"related": [{"and": [activity(1)]}, {"and": [agent("c")]}]},
+    {"verb": [verb(1)], "related": [{"and": [GROUP, activity(4)]}]},
+    {"actor": [agent("a")], "related": [{"or": [activity(4), activity(1)]}]},
+]
+
+
+def old_filter(filters):
+    # The Q the hooks task filtered the new statements with before they were
+    # matched in memory
+    actorQ, verbQ, objectQ, filterQ = Q(), Q(), Q(), Q()
+    if isinstance(filters, dict):
+        for a in filters.get('actor', []):
+            actorQ = actorQ | Q(actor=Agent.objects.retrieve(**a))
+        for v in filters.get('verb', []):
+            verbQ = verbQ | Q(verb__verb_id=v['id'])
+        for o in filters.get('object', []):
+            objectQ = objectQ | Q(object_activity__activity_id=o['id'])
+        filterQ = actorQ & verbQ & objectQ
+        if 'related' in filters:
+            filterQ = filterQ & old_related_filter(filters['related'], True)
+    return filterQ
+
+
+def old_related_filter(related, or_operand):
+    innerQ = Q()
+    objectQ = Q()
+    act_list = []
+    for ob in related:
+        if 'or' in ob:
+            innerQ = innerQ | old_related_filter(ob['or'], True)
+        elif 'and' in ob:
+            innerQ = innerQ & old_related_filter(ob['and'], False)
+        elif 'id' in ob:
+            act_list.append(ob['id'])
+        else:
+            objectQ = combine(objectQ, related_agent_q(Agent.objects.retrieve(**ob)), or_operand)
+    if act_list:
+        objectQ = combine(objectQ, related_activity_q(act_list), or_operand)
+    return objectQ | innerQ if or_operand else objectQ & innerQ
+
+
+def combine(q, other, or_operand):
+    return q | other if or_operand else q & other
+
+
+def related_activity_q(act_list):
+    q = Q()
+    for prefix in ["", "object_substatement__"]:
+        for field in ["object_activity", "context_ca_parent", "context_ca_grouping", "context_ca_category",
+                      "context_ca_other"]:
+            q = q | Q(**{prefix + field + "__activity_id__in": act_list})
+    return q
+
+
+def related_agent_q(agent_row):
+    # The contextAgents and contextGroups clauses compared the JSON columns
+    # with an Agent row, so they are left out
+    q = Q(actor=agent_row) | Q(object_agent=agent_row) | Q(authority=agent_row)
+    for field in ["context_instructor", "context_team", "object_substatement__actor",
+                  "object_substatement__object_agent", "object_substatement__context_instructor",
+                  "object_substatement__context_team"]:
+        q = q | Q(**{field: agent_row})
+    return q
+
+
+class HookMatcherTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        self.user = User.objects.create_user("tom", "tom@example.com", "1234")
+        resp = self.client.post(reverse('lrs:statements'), json.dumps(STATEMENTS), content_type="application/json",
+                                Authorization="Basic %s" % base64.b64encode(b"tom:1234").decode(),
+                                X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 200)
+        self.ids = json.loads(resp.content)
+
+    def test_old_filters(self):
+        statements = list(Statement.objects.order_by('pk').values_list('full_statement', flat=True))
+        config = {"endpoint": "http://example.com/hook"}
+        # Every hook compiled together, so they share the index
+        matches = {hook_id: [stmt['id'] for stmt in found] for hook_id, _, found in
+                   CompiledHooks([(i, copy.deepcopy(f), config) for i, f in enumerate(FILTERS)]).match(statements)}
+        for i, filters in enumerate(FILTERS):
+            with self.subTest(filters=filters):
+                expected = Statement.objects.filter(old_filter(filters), statement_id__in=self.ids).distinct()
+                self.assertEqual(sorted(matches.get(i, [])),
+                                 sorted(str(st_id) for st_id in expected.values_list('statement_id', flat=True)))
+
+    def test_invalidation(self):
+        hook = Hook.objects.create(name="hook", user=self.user, config={"endpoint": "http://example.com/hook"},
+                                   filters={"verb": [verb(1)]})
+        hooks = hook_matcher.get_hooks()
+        compiles = hook_matcher.compiles
+        self.assertIs(hook_matcher.get_hooks(), hooks)
+        self.assertEqual(hook_matcher.compiles, compiles)
+
+        hook.filters = {"verb": [verb(3)]}
+        hook.save()
+        hooks = hook_matcher.get_hooks()
+        self.assertEqual(hook_matcher.compiles, compiles + 1)
+        self.assertEqual([stmt['verb']['id'] for _, _, found in hooks.match(STATEMENTS) for stmt in found],
+                         [VERB % 3])
+
+        # Only reaches this worker through the shared generation
+        Hook.objects.filter(pk=hook.pk).update(filters={"verb": [verb(2)]})
+        cache.set(GENERATION_KEY, "other worker", None)
+        self.assertEqual(len(hook_matcher.get_hooks().match(STATEMENTS)[0][2]), 2)
+
+        hook.delete()
+        self.assertEqual(hook_matcher.get_hooks().hooks, [])
+        self.assertEqual(hook_matcher.compiles, compiles + 3)
@@ -0,0 +1,89 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from ..exceptions import BadRequest, RequestEntityTooLarge
+from ..models import attachment_storage, get_payload_path
+from ..utils.multipart import parse_multipart
+
+CONTENT_TYPE = 'multipart/mixed; boundary="abc"'
+
+
+def get_body(parts, line_break=b"\r\n", closing=True):
+    lines = [b"preamble"]
+    for headers, payload in parts:
+        lines += [b"--abc"] + headers + [b"", payload]
+    if closing:
+        lines.append(b"--abc--")
+    return line_break.join(lines) + line_break
+
+
+class MultipartTests(SimpleTestCase):
+
+    def setUp(self):
+        # Small reads so delimiters and headers are split across them
+        read_size = mock.patch('lrs.utils.multipart.READ_SIZE', 5)
+        read_size.start()
+        self.addCleanup(read_size.stop)
+
+    def parse(self, body):
+        return parse_multipart(io.BytesIO(body), CONTENT_TYPE)
+
+    def test_parts(self):
+        # Only a line starting with the boundary is a delimiter
+        payload = b"--ab\r\n-- abc and x--abc are inside the payload\n\r\n"
+        for line_break in [b"\r\n", b"\n"]:
+            with self.subTest(line_break=line_break):
+                parts = self.parse(get_body([([b"Content-Type: application/json"], b"{}"),
+                                             ([b"content-type: text/plain",
+                                               b"X-Experience-API-Hash: " + hashlib.sha256(payload).hexdigest()
+                                               .encode()], payload)], line_break))
+                self.assertEqual([part.read() for part in parts], [b"{}", payload])
+                self.assertEqual(parts[1]['Content-Type'], "text/plain")
+                self.assertEqual(parts[1].hexdigest(), hashlib.sha256(payload).hexdigest())
+                self.assertEqual(parts[1].size, len(payload))
+
+    def test_missing_closing_boundary(self):
+        for body in [get_body([([b"Content-Type: text/plain"], b"payload")], closing=False),
+                     get_body([([b"Content-Type: text/plain"], b"payload")])[:-len(b"--abc--\r\n")],
+                     b"--abc\r\nContent-Type: text/plain", b"no boundary at all"]:
+            with self.subTest(body=body), self.assertRaises(BadRequest):
+                self.parse(body)
+
+    def test_too_large(self):
+        body = get_body([([b"Content-Type: text/plain"], b"x" * 100)])
+        with self.settings(MULTIPART_MAX_PART_SIZE=99), self.assertRaises(RequestEntityTooLarge):
+            self.parse(body)
+        with self.settings(MULTIPART_MAX_BODY_SIZE=50), self.assertRaises(RequestEntityTooLarge):
+            self.parse(body)
+        with self.settings(MULTIPART_MAX_PART_SIZE=100, MULTIPART_MAX_BODY_SIZE=len(body)):
+            self.assertEqual(self.parse(body)[0].read(), b"x" * 100)
+
+
+class AttachmentStorageTests(SimpleTestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def test_sha2_mismatch(self):
+        name = get_payload_path(hashlib.sha256(b"expected").hexdigest())
+        with self.assertRaises(BadRequest):
+            attachment_storage.save(name, ContentFile(b"something else"))
+        # Neither the payload nor the temporary file are left behind
+        self.assertFalse(attachment_storage.exists(name))
+        self.assertEqual(os.listdir(os.path.dirname(attachment_storage.path(name))), [])
+
+        self.assertEqual(attachment_storage.save(name, ContentFile(b"expected")), name)
+        with attachment_storage.open(name) as f:
+            self.assertEqual(f.read(), b"expected")
@@ -0,0 +1,89 @@
+import time
+import uuid
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+
+from oauth_provider.consts import ACCEPTED
+from oauth_provider.models import Consumer, Nonce, Token
+from oauth_provider.store import InvalidConsumerError, InvalidTokenError
+from oauth_provider.store.db import ModelStore, NonceStore
+
+from ..utils.lookup_cache import clear_lookup_caches, oauth_cache
+
+
+class OauthStoreTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        self.store = ModelStore()
+        self.user = User.objects.create_user("tom", "tom@example.com", "1234")
+        self.consumer = Consumer.objects.create(name="app", user=self.user, status=ACCEPTED)
+        self.consumer.generate_random_codes()
+        self.token = Token.objects.create(key=uuid.uuid4().hex, secret="secret", token_type=Token.ACCESS,
+                                          is_approved=True, user=self.user, consumer=self.consumer,
+                                          timestamp=int(time.time()))
+
+    def check_nonce(self, nonce, timestamp, token_key=None):
+        oauth_request = {'oauth_consumer_key': self.consumer.key, 'oauth_token': token_key or self.token.key}
+        return self.store.check_nonce(None, oauth_request, nonce, timestamp)
+
+    def test_nonce_replay(self):
+        nonce = uuid.uuid4().hex
+        now = int(time.time())
+        self.assertTrue(self.check_nonce(nonce, now))
+        # Turned away by this process without a query
+        with self.assertNumQueries(0):
+            self.assertFalse(self.check_nonce(nonce, now))
+        # And by the table in another one
+        with mock.patch('oauth_provider.store.db.nonce_store', NonceStore(600, 60)):
+            self.assertFalse(self.check_nonce(nonce, now))
+            self.assertTrue(self.check_nonce(nonce, now, token_key="other"))
+        self.assertEqual(Nonce.objects.filter(key=nonce).count(), 2)
+
+    def test_nonce_window(self):
+        nonce_store = NonceStore(600, 60)
+        now = int(time.time())
+        with mock.patch('oauth_provider.store.db.nonce_store', nonce_store):
+            for timestamp in [now - 601, now + 601]:
+                self.assertFalse(self.check_nonce(uuid.uuid4().hex, timestamp))
+            # Nothing is kept past the period
+            self.assertEqual((nonce_store._heap, Nonce.objects.count()), ([], 0))
+            self.assertTrue(self.check_nonce(uuid.uuid4().hex, now + 30))
+        self.assertEqual([expiry for expiry, _ in nonce_store._heap], [now + 630])
+
+    def get_token(self):
+        return self.store.get_access_token(None, None, None, self.token.key)
+
+    def test_revoked_token(self):
+        self.assertEqual(self.get_token().pk, self.token.pk)
+        hits = oauth_cache.stats()['hits']
+        self.assertEqual(self.get_token().user.username, "tom")
+        self.assertEqual(oauth_cache.stats()['hits'], hits + 1)
+
+        self.client.login(username="tom", password="1234")
+        resp = self.client.delete("%s?id=%s-%s-%s" % (reverse('delete_token'), self.token.key[:10],
+                                                      self.consumer.pk, self.token.timestamp))
+        self.assertEqual(resp.status_code, 204)
+        with self.assertRaises(InvalidTokenError):
+            self.get_token()
+
+    def test_token_revoked_by_other_worker(self):
+        self.get_token()
+        # Only reaches this worker through the shared generation
+        Token.objects.filter(pk=self.token.pk).update(is_approved=False)
+        cache.set(oauth_cache.generation_key, uuid.uuid4().hex, None)
+        with self.assertRaises(InvalidTokenError):
+            self.get_token()
+
+    def test_rejected_consumer(self):
+        self.assertEqual(self.store.get_consumer(None, None, self.consumer.key).pk, self.consumer.pk)
+        self.client.login(username="tom", password="1234")
+        resp = self.client.get(reverse('my_app_status'), {"app_name": "app", "status": "Rejected"})
+        self.assertEqual(resp.json()['status'], "Rejected")
+        with self.assertRaises(InvalidConsumerError):
+            self.store.get_consumer(None, None, self.consumer.key)
@@ -0,0 +1,48 @@
+import base64
+import json
+from unittest import mock
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.http import HttpRequest
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+
+from ..exceptions import BadRequest
+from ..utils.req_parse import parse
+
+AUTH = "Basic %s" % base64.b64encode(b"tom:1234").decode()
+STATEMENT = {"actor": {"mbox": "mailto:tom@example.com"}, "verb": {"id": "http://example.com/verbs/passed"},
+             "object": {"id": "act:test"}}
+
+
+class ReqParseTests(TestCase):
+
+    def post(self, body, content_type, **extra):
+        return RequestFactory().post(reverse('lrs:statements'), body, content_type=content_type,
+                                     X_Experience_API_Version=settings.XAPI_VERSION, **extra)
+
+    def test_form_authorization(self):
+        # Cross origin requests can only send the authorization in the body
+        for key in ["Authorization", "HTTP_AUTHORIZATION"]:
+            with self.subTest(key=key):
+                body = urlencode({key: AUTH, "content": json.dumps(STATEMENT)})
+                r_dict = parse(self.post(body, "application/x-www-form-urlencoded"))
+                self.assertEqual(r_dict['headers']['Authorization'], AUTH)
+                self.assertEqual(r_dict['auth']['type'], 'http')
+
+    def test_header_authorization(self):
+        r_dict = parse(self.post(json.dumps(STATEMENT), "application/json", Authorization=AUTH))
+        self.assertEqual(r_dict['headers']['Authorization'], AUTH)
+        self.assertEqual(r_dict['body'], STATEMENT)
+
+    def test_no_authorization(self):
+        # Only a form-encoded body is read for the authorization
+        for body, content_type in [(json.dumps(dict(STATEMENT, Authorization=AUTH)), "application/json"),
+                                   ("--abc\r\nAuthorization: %s\r\n\r\n--abc--\r\n" % AUTH,
+                                    'multipart/mixed; boundary="abc"')]:
+            with self.subTest(content_type=content_type):
+                with mock.patch.object(HttpRequest, 'body', new_callable=mock.PropertyMock) as read_body, \
+                        self.assertRaises(BadRequest):
+                    parse(self.post(body, content_type))
+                read_body.assert_not_called()
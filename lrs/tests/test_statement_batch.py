@@ -0,0 +1,181 @@
+import base64
+import json
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import TestCase
+from django.urls import reverse
+
+from ..managers.StatementBatchManager import StatementBatchManager
+from ..managers.StatementManager import StatementManager
+from ..models import Verb, Agent, Activity, Statement, SubStatement, StatementAgent, StatementActivity, \
+    StatementAttachment
+from ..utils.lookup_cache import clear_lookup_caches
+
+
+class StatementsOneAtATime():
+    # What process_body does for requests without an authority, with the
+    # request's authority kept so the rows can be compared
+
+    def __init__(self, stmts, auth_info, payloads):
+        self.model_objects = [StatementManager(stmt, auth_info, payloads).model_object for stmt in stmts]
+
+
+class StatementBatchTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        User.objects.create_user("tom", "tom@example.com", "1234")
+        User.objects.create_user("bob", "bob@example.com", "1234")
+
+    def post(self, username, stmts):
+        auth = "Basic %s" % base64.b64encode(("%s:1234" % username).encode()).decode()
+        resp = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                Authorization=auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 200, resp.content)
+
+    def agent_key(self, agent):
+        return json.dumps([agent.objectType, agent.name, agent.mbox, agent.mbox_sha1sum, agent.openid,
+                           agent.account_homePage, agent.account_name])
+
+    def natural_key(self, obj):
+        if isinstance(obj, Agent):
+            # member is symmetrical, only a group's own members are listed
+            members = obj.member.all() if obj.objectType == 'Group' else []
+            return [self.agent_key(obj), sorted(self.agent_key(m) for m in members)]
+        if isinstance(obj, SubStatement):
+            return self.row(obj)
+        if isinstance(obj, Statement):
+            return str(obj.statement_id)
+        if isinstance(obj, Activity):
+            return obj.activity_id
+        if isinstance(obj, Verb):
+            return obj.verb_id
+        if isinstance(obj, User):
+            return obj.username
+        return str(obj)
+
+    def row(self, obj):
+        # Field values with related rows replaced by what identifies them,
+        # the stored time and canonical versions differ between runs
+        data = {}
+        for field in obj._meta.concrete_fields:
+            if field.primary_key or field.name in ['stored', 'canonical_version']:
+                continue
+            value = getattr(obj, field.name)
+            if field.is_relation and value is not None:
+                value = self.natural_key(value)
+            data[field.name] = value
+        for field in obj._meta.many_to_many:
+            data[field.name] = sorted(self.natural_key(related) for related in getattr(obj, field.name).all())
+        if 'full_statement' in data:
+            data['full_statement'] = dict(data['full_statement'], stored=None)
+        return json.dumps(data, sort_keys=True, default=str)
+
+    def snapshot(self):
+        return {model.__name__: sorted(self.row(obj) for obj in model.objects.all())
+                for model in [Verb, Agent, Activity, Statement, SubStatement, StatementAgent, StatementActivity,
+                              StatementAttachment]}
+
+    def store(self, batch_manager):
+        # Each run starts from the same rows and is rolled back afterwards
+        with transaction.atomic():
+            self.post("bob", self.existing)
+            with mock.patch('lrs.utils.req_process.StatementBatchManager', batch_manager):
+                self.post("tom", self.batch)
+            snapshot = self.snapshot()
+            transaction.set_rollback(True)
+        clear_lookup_caches()
+        return snapshot
+
+    def test_batch_matches_one_at_a_time(self):
+        tom = {"mbox": "mailto:tom@example.com"}
+        group = {"objectType": "Group", "name": "team",
+                 "member": [{"mbox": "mailto:ann@example.com"}, {"account": {"homePage": "http://example.com",
+                                                                              "name": "joe"}}]}
+        timestamp = "2024-01-01T00:00:00+00:00"
+        self.existing = [
+            {"id": "a2e8f6a6-7d3c-4f64-9d4b-8f0f1c6b2a01", "actor": tom, "timestamp": timestamp,
+             "verb": {"id": "http://example.com/verbs/passed"}, "object": {"id": "act:test/first"}},
+            {"actor": {"mbox": "mailto:bob@example.com"}, "timestamp": timestamp,
+             "verb": {"id": "http://example.com/verbs/defined", "display": {"en-US": "defined"}},
+             "object": {"id": "act:test/shared", "definition": {"name": {"en-US": "shared"}}}}]
+        self.batch = [
+            {"id": "b7c1d2e3-0000-4000-8000-000000000001", "actor": tom, "timestamp": timestamp,
+             "verb": {"id": "http://example.com/verbs/attended", "display": {"en-US": "attended"}},
+             "object": {"id": "act:test/new", "definition": {"name": {"en-US": "new"}}},
+             "result": {"score": {"raw": 5}, "success": True},
+             "context": {"registration": "c3f1a0b2-9d4e-4f6a-8b7c-1d2e3f4a5b6c", "instructor": group, "team": group,
+                         "contextActivities": {"parent": {"id": "act:test/shared"},
+                                               "grouping": [{"id": "act:test/new"}, {"id": "act:test/other"}],
+                                               "category": [{"id": "act:test/category"}],
+                                               "other": [{"id": "act:test/other"}]}},
+             "attachments": [{"usageType": "http://example.com/attachment-usage/test",
+                              "display": {"en-US": "A linked attachment"}, "contentType": "text/plain",
+                              "length": 10, "sha2": "0" * 64, "fileUrl": "http://example.com/file.txt"}]},
+            # Later statements add languages to the verb and the activity
+            # the batch created, bob's activity is his to define
+            {"actor": group, "timestamp": timestamp,
+             "verb": {"id": "http://example.com/verbs/attended", "display": {"fr-FR": "a assisté"}},
+             "object": {"id": "act:test/new", "definition": {"name": {"fr-FR": "nouveau"}}}},
+            {"actor": {"account": {"homePage": "http://example.com", "name": "joe"}}, "timestamp": timestamp,
+             "verb": {"id": "http://example.com/verbs/defined", "display": {"de-DE": "definiert"}},
+             "object": {"id": "act:test/shared", "definition": {"name": {"fr-FR": "partagé"}}}},
+            {"actor": tom, "timestamp": timestamp, "verb": {"id": "http://example.com/verbs/mentored"},
+             "object": {"objectType": "Group", "member": [tom, {"mbox": "mailto:ann@example.com"}]}},
+            {"actor": tom, "timestamp": timestamp, "verb": {"id": "http://example.com/verbs/planned"},
+             "object": {"objectType": "SubStatement", "actor": {"mbox": "mailto:sue@example.com"},
+                        "verb": {"id": "http://example.com/verbs/attended"},
+                        "object": {"id": "act:test/sub", "definition": {"name": {"en-US": "sub"}}},
+                        "context": {"contextActivities": {"parent": [{"id": "act:test/new"}],
+                                                          "other": [{"id": "act:test/sub-other"}]}}}},
+            {"actor": tom, "timestamp": timestamp, "verb": {"id": "http://example.com/verbs/liked"},
+             "object": {"objectType": "StatementRef", "id": "b7c1d2e3-0000-4000-8000-000000000001"}},
+            {"actor": tom, "timestamp": timestamp, "verb": {"id": "http://adlnet.gov/expapi/verbs/voided"},
+             "object": {"objectType": "StatementRef", "id": "a2e8f6a6-7d3c-4f64-9d4b-8f0f1c6b2a01"}}]
+        # Statements without IDs get new ones on every run
+        for i, stmt in enumerate(self.batch + self.existing):
+            stmt.setdefault("id", "d0d0d0d0-0000-4000-8000-%012d" % i)
+
+        one_at_a_time = self.store(StatementsOneAtATime)
+        batched = self.store(StatementBatchManager)
+        self.assertEqual(batched, one_at_a_time)
+        # The scenarios above are all there
+        self.assertEqual(len(batched['Statement']), 9)
+        self.assertEqual(len(batched['SubStatement']), 1)
+        self.assertEqual(len(batched['StatementAttachment']), 1)
+        self.assertEqual(sum('"voided": true' in row for row in batched['Statement']), 1)
+        self.assertTrue(any('"fr-FR": "nouveau"' in row for row in batched['Activity']))
+        self.assertFalse(any('partag' in row for row in batched['Activity']))
+
+    def test_keeps_updates_from_other_workers(self):
+        verb_id, activity_id = "http://example.com/verbs/attended", "act:test/updated"
+        for batch_manager in [StatementsOneAtATime, StatementBatchManager]:
+            with self.subTest(batch_manager=batch_manager.__name__), transaction.atomic():
+                with mock.patch('lrs.utils.req_process.StatementBatchManager', batch_manager):
+                    self.post("tom", [{"actor": {"mbox": "mailto:tom@example.com"},
+                                       "verb": {"id": verb_id, "display": {"en-US": "attended"}},
+                                       "object": {"id": activity_id,
+                                                  "definition": {"name": {"en-US": "updated"}}}}])
+                    # Another worker adds a language to the rows this one has
+                    # cached, without this one syncing
+                    verb = Verb.objects.get(verb_id=verb_id)
+                    verb.canonical_data['display']['fr-FR'] = "a assisté"
+                    Verb.objects.filter(pk=verb.pk).update(canonical_data=verb.canonical_data)
+                    activity = Activity.objects.get(activity_id=activity_id)
+                    activity.canonical_data['definition']['name']['fr-FR'] = "mis à jour"
+                    Activity.objects.filter(pk=activity.pk).update(canonical_data=activity.canonical_data)
+
+                    self.post("tom", [{"actor": {"mbox": "mailto:tom@example.com"},
+                                       "verb": {"id": verb_id, "display": {"de-DE": "besucht"}},
+                                       "object": {"id": activity_id,
+                                                  "definition": {"name": {"de-DE": "aktualisiert"}}}}])
+                self.assertEqual(sorted(Verb.objects.get(verb_id=verb_id).canonical_data['display']),
+                                 ['de-DE', 'en-US', 'fr-FR'])
+                self.assertEqual(sorted(Activity.objects.get(activity_id=activity_id)
+                                        .canonical_data['definition']['name']), ['de-DE', 'en-US', 'fr-FR'])
+                transaction.set_rollback(True)
+            clear_lookup_caches()
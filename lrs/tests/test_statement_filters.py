@@ -0,0 +1,83 @@
+import base64
+import json
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse
+
+from ..utils.lookup_cache import clear_lookup_caches
+
+
+class StatementFilterTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        self.username = "tom"
+        self.password = "1234"
+        self.auth = "Basic %s" % base64.b64encode(
+            ("%s:%s" % (self.username, self.password)).encode()).decode()
+        User.objects.create_user(self.username, "tom@example.com", self.password)
+
+        alice = {"mbox": "mailto:alice@example.com"}
+        bob = {"mbox": "mailto:bob@example.com"}
+        verb = {"id": "http://example.com/verbs/attended"}
+        self.stmts = {
+            'actor': {"actor": bob, "verb": verb, "object": {"id": "act:a"}},
+            'object': {"actor": alice, "verb": verb, "object": dict(bob, objectType="Agent")},
+            'group': {"actor": {"objectType": "Group", "mbox": "mailto:team@example.com", "member": [bob]},
+                      "verb": verb, "object": {"id": "act:b"}},
+            'context': {"actor": alice, "verb": verb, "object": {"id": "act:b"},
+                        "context": {"instructor": bob, "contextActivities": {"parent": [{"id": "act:a"}]}}},
+            'grouping': {"actor": alice, "verb": verb, "object": {"id": "act:b"},
+                         "context": {"contextActivities": {"grouping": [{"id": "act:a"}]}}},
+            'substatement': {"actor": alice, "verb": verb, "object": {
+                "objectType": "SubStatement", "actor": bob, "verb": verb, "object": {"id": "act:c"},
+                "context": {"contextActivities": {"category": [{"id": "act:a"}]}}}},
+        }
+        self.ids = {}
+        for name, stmt in self.stmts.items():
+            self.ids[name] = str(uuid.uuid4())
+            resp = self.client.put(reverse('lrs:statements') + "?statementId=" + self.ids[name], json.dumps(stmt),
+                                   content_type="application/json", Authorization=self.auth,
+                                   X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(resp.status_code, 204)
+
+    def get_matches(self, params):
+        resp = self.client.get(reverse('lrs:statements'), params, Authorization=self.auth,
+                               X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 200)
+        found = set(stmt['id'] for stmt in json.loads(resp.content)['statements'])
+        return sorted(name for name, stmt_id in self.ids.items() if stmt_id in found)
+
+    def test_agent_filter(self):
+        # Groups the agent is a member of match as well
+        agent = json.dumps({"mbox": "mailto:bob@example.com"})
+        self.assertEqual(self.get_matches({"agent": agent}), ['actor', 'group', 'object'])
+
+    def test_related_agents_filter(self):
+        agent = json.dumps({"mbox": "mailto:bob@example.com"})
+        self.assertEqual(self.get_matches({"agent": agent, "related_agents": "true"}),
+                         ['actor', 'context', 'group', 'object', 'substatement'])
+
+    def test_group_agent_filter(self):
+        group = json.dumps({"objectType": "Group", "mbox": "mailto:team@example.com"})
+        self.assertEqual(self.get_matches({"agent": group}), ['group'])
+
+    def test_activity_filter(self):
+        self.assertEqual(self.get_matches({"activity": "act:a"}), ['actor'])
+        self.assertEqual(self.get_matches({"activity": "act:c"}), [])
+
+    def test_related_activities_filter(self):
+        self.assertEqual(self.get_matches({"activity": "act:a", "related_activities": "true"}),
+                         ['actor', 'context', 'grouping', 'substatement'])
+
+    def test_substatement_members(self):
+        # The substatement's actor and object are only related to the statement
+        self.assertEqual(self.get_matches({"activity": "act:c", "related_activities": "true"}),
+                         ['substatement'])
+        agent = json.dumps({"mbox": "mailto:bob@example.com"})
+        self.assertIn('substatement', self.get_matches({"agent": agent, "related_agents": "true"}))
+        self.assertNotIn('substatement', self.get_matches({"agent": agent}))
@@ -0,0 +1,95 @@
+import base64
+import json
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import resolve, reverse
+
+from ..models import Statement
+from ..utils.lookup_cache import clear_lookup_caches
+from ..utils.retrieve_statement import get_more_url
+
+
+class StatementPagingTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        self.auth = "Basic %s" % base64.b64encode(b"tom:1234").decode()
+        User.objects.create_user("tom", "tom@example.com", "1234")
+
+    def post_statements(self, count):
+        stmts = [{"actor": {"mbox": "mailto:tom@example.com"}, "verb": {"id": "http://example.com/verbs/passed"},
+                  "object": {"id": "act:test/%s" % i}} for i in range(count)]
+        resp = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(resp.content)
+
+    def get(self, url, params=None):
+        return self.client.get(url, params, Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+
+    def get_pages(self, params):
+        # IDs of every page, following the more URLs
+        pages = []
+        result = json.loads(self.get(reverse('lrs:statements'), params).content)
+        while True:
+            pages.append([stmt['id'] for stmt in result['statements']])
+            if not result['more']:
+                return pages
+            resp = self.get(result['more'])
+            self.assertEqual(resp.status_code, 200)
+            result = json.loads(resp.content)
+
+    def test_same_stored_across_pages(self):
+        ids = self.post_statements(7)
+        Statement.objects.update(stored=datetime(2024, 1, 1, tzinfo=timezone.utc))
+        # Ties on stored are ordered by the row's id
+        order = [str(st_id) for st_id in Statement.objects.order_by('id').values_list('statement_id', flat=True)]
+        self.assertEqual(sorted(order), sorted(ids))
+        for ascending in ["true", "false"]:
+            for stmt_format in ["exact", "ids", "canonical"]:
+                pages = self.get_pages({"limit": 3, "ascending": ascending, "format": stmt_format})
+                self.assertEqual([len(page) for page in pages], [3, 3, 1])
+                expected = order if ascending == "true" else order[::-1]
+                self.assertEqual(sum(pages, []), expected)
+
+    def test_snapshot(self):
+        first = self.post_statements(3)
+        result = json.loads(self.get(reverse('lrs:statements'), {"limit": 2, "ascending": "true"}).content)
+        # Stored after the first page was returned, left out of the later ones
+        later = self.post_statements(2)
+        pages = [[stmt['id'] for stmt in result['statements']]]
+        result = json.loads(self.get(result['more']).content)
+        pages.append([stmt['id'] for stmt in result['statements']])
+        self.assertEqual(result['more'], "")
+        self.assertEqual(sorted(sum(pages, [])), sorted(first))
+        # A new first page has them
+        self.assertEqual(sorted(sum(self.get_pages({"limit": 2}), [])), sorted(first + later))
+
+    def test_bad_cursor(self):
+        self.post_statements(3)
+        more = json.loads(self.get(reverse('lrs:statements'), {"limit": 1}).content)['more']
+        prefix, more_id = more.rsplit('/', 1)
+        payload, signature = more_id.rsplit(':', 1)
+        # Another position with the old signature
+        tampered = payload[:-1] + ("A" if payload[-1] != "A" else "B")
+        for bad_id in [tampered + ":" + signature, payload + ":" + signature[::-1], "garbage",
+                       "a:b:c", "." + more_id, more_id[1:], more_id + "!"]:
+            self.assertEqual(self.get(prefix + "/" + bad_id).status_code, 404, bad_id)
+        self.assertEqual(self.get(more).status_code, 200)
+
+    def test_more_url_pattern(self):
+        stored = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        short = {'params': {}, 'position': None}
+        # Compressed cursors start with a dot
+        long = {'params': {'activity': "http://example.com/activities/" + "a" * 200}, 'position': None}
+        for cursor in [short, long]:
+            url = get_more_url(cursor, stored, 12)
+            match = resolve(url)
+            self.assertEqual(match.url_name, 'statements_more')
+            self.assertEqual(url, "%s/%s" % (reverse('lrs:statements_more_placeholder').lower(),
+                                             match.kwargs['more_id']))
+        self.assertTrue(match.kwargs['more_id'].startswith('.'))
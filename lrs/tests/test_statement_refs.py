@@ -0,0 +1,78 @@
+import base64
+import json
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from ..models import Statement
+from ..utils.lookup_cache import clear_lookup_caches
+from ..utils.retrieve_statement import stmt_ref_search, stmt_ref_search_cte
+
+
+class StatementRefTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        self.username = "tom"
+        self.password = "1234"
+        self.auth = "Basic %s" % base64.b64encode(
+            ("%s:%s" % (self.username, self.password)).encode()).decode()
+        User.objects.create_user(self.username, "tom@example.com", self.password)
+
+    def post_statement(self, stmt):
+        stmt_id = str(uuid.uuid4())
+        resp = self.client.put(reverse('lrs:statements') + "?statementId=" + stmt_id, json.dumps(stmt),
+                               content_type="application/json", Authorization=self.auth,
+                               X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 204)
+        return stmt_id
+
+    def post_statements(self):
+        # Three statements with the verb filtered on and one statement
+        # targeting each of them
+        direct = [self.post_statement({"actor": {"mbox": "mailto:tom@example.com"},
+                                       "verb": {"id": "http://example.com/verbs/passed"},
+                                       "object": {"id": "act:test/%s" % i}}) for i in range(3)]
+        referring = [self.post_statement({"actor": {"mbox": "mailto:tom@example.com"},
+                                          "verb": {"id": "http://example.com/verbs/voided"},
+                                          "object": {"objectType": "StatementRef", "id": stmt_id}})
+                     for stmt_id in direct]
+        return direct, referring
+
+    def found_ids(self, search):
+        # Postgres returns the search as a subquery, other databases as a list
+        return [str(st_id) for st_id in Statement.objects.filter(statement_id__in=search)
+                .values_list('statement_id', flat=True)]
+
+    @override_settings(STMT_REF_MAX_STATEMENTS=2)
+    def test_get_keeps_direct_matches(self):
+        direct, referring = self.post_statements()
+        resp = self.client.get(reverse('lrs:statements'), {"verb": "http://example.com/verbs/passed"},
+                               Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 200)
+        ids = [stmt['id'] for stmt in json.loads(resp.content)['statements']]
+        self.assertEqual(len(ids), 5)
+        self.assertTrue(set(direct).issubset(ids))
+        self.assertEqual(len(set(referring).intersection(ids)), 2)
+
+    @override_settings(STMT_REF_MAX_STATEMENTS=2)
+    def test_search_caps_referring_statements(self):
+        direct, referring = self.post_statements()
+        stmtset = Statement.objects.filter(verb__verb_id="http://example.com/verbs/passed")
+        for search in [stmt_ref_search, stmt_ref_search_cte]:
+            ids = self.found_ids(search(stmtset, None, None))
+            self.assertEqual(len(ids), 5)
+            self.assertTrue(set(direct).issubset(ids))
+            self.assertEqual(len(set(referring).intersection(ids)), 2)
+
+    @override_settings(STMT_REF_MAX_STATEMENTS=0)
+    def test_search_without_referring_statements(self):
+        direct, _ = self.post_statements()
+        stmtset = Statement.objects.filter(verb__verb_id="http://example.com/verbs/passed")
+        for search in [stmt_ref_search, stmt_ref_search_cte]:
+            self.assertEqual(sorted(self.found_ids(search(stmtset, None, None))), sorted(direct))
@@ -0,0 +1,104 @@
+import base64
+import json
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from ..models import Statement
+from ..utils.lookup_cache import clear_lookup_caches
+from ..utils.render_cache import get_render_key
+from ..utils.req_process import build_response
+from ..utils.retrieve_statement import complex_get
+
+ACTIVITIES = "http://example.com/activities/render/"
+
+
+def group(i):
+    return {"objectType": "Group", "name": "Group %d" % i,
+            "member": [{"mbox": "mailto:member%d-%d@example.com" % (i, m)} for m in range(2)]}
+
+
+def context(i):
+    return {"instructor": group(i + 1), "team": group(i + 2),
+            "contextActivities": {key: [{"id": ACTIVITIES + "%s/%d" % (key, i)}]
+                                  for key in ["parent", "grouping", "category", "other"]}}
+
+
+class StatementRenderTests(TestCase):
+    # A page takes the same number of queries however many statements it has
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        self.render_cache = caches['render_cache']
+        self.addCleanup(self.render_cache.clear_local)
+        User.objects.create_user("tom", "tom@example.com", "1234")
+        self.registration = str(uuid.uuid4())
+        attachment = {"usageType": "http://example.com/attachment", "display": {"en-US": "attachment"},
+                      "contentType": "text/plain", "length": 1, "sha2": "a" * 64,
+                      "fileUrl": "http://example.com/attachment.txt"}
+        stmts = [{"actor": group(i), "verb": {"id": "http://example.com/verbs/%d" % i, "display": {"en-US": "v"}},
+                  "object": {"objectType": "SubStatement", "actor": group(i + 3),
+                             "verb": {"id": "http://example.com/verbs/sub/%d" % i},
+                             "object": group(i + 4), "context": context(i + 5)},
+                  "context": dict(context(i), registration=self.registration), "attachments": [attachment]}
+                 for i in range(50)]
+        resp = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                Authorization="Basic %s" % base64.b64encode(b"tom:1234").decode(),
+                                X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 200)
+        self.ids = json.loads(resp.content)
+
+    def get_page(self, size, stmt_format):
+        result = complex_get({"registration": self.registration}, size, [settings.LANGUAGE_CODE], stmt_format, False)
+        self.assertEqual(len(result['statements']), size)
+        return result
+
+    def clear_renders(self, stmt_format):
+        self.render_cache.delete_many([get_render_key(st_id, [settings.LANGUAGE_CODE], stmt_format)
+                                       for st_id in self.ids])
+        self.render_cache.clear_local()
+
+    def test_rendered(self):
+        # The page, the prefetches for the context activities and group
+        # members, the attachments and writing the renders to the shared cache
+        for stmt_format, queries in [("canonical", 25), ("ids", 25)]:
+            for size in [5, 50]:
+                self.clear_renders(stmt_format)
+                with self.subTest(stmt_format=stmt_format, size=size), self.assertNumQueries(queries):
+                    self.get_page(size, stmt_format)
+
+    def test_cached(self):
+        # Only in the cache every worker shares, read in one query and checked
+        # against the verb and activity versions
+        for stmt_format, queries in [("canonical", 5), ("ids", 5)]:
+            for size in [5, 50]:
+                self.clear_renders(stmt_format)
+                self.get_page(size, stmt_format)
+                self.render_cache.clear_local()
+                with self.subTest(stmt_format=stmt_format, size=size), self.assertNumQueries(queries):
+                    self.get_page(size, stmt_format)
+
+    def test_cache_setting(self):
+        # The cache is looked up on each page, so a test can replace it
+        caches_setting = dict(settings.CACHES, render_cache={
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache'})
+        self.clear_renders("ids")
+        with override_settings(CACHES=caches_setting):
+            # Rendered every time, without the cache's reads and writes
+            for _ in range(2):
+                with self.assertNumQueries(20):
+                    self.get_page(5, "ids")
+        self.assertEqual(self.render_cache.get_many([get_render_key(st_id, [settings.LANGUAGE_CODE], "ids")
+                                                     for st_id in self.ids]), {})
+
+    def test_attachments(self):
+        for size in [5, 50]:
+            statements = [stmt.to_dict() for stmt in Statement.objects.order_by('id')[:size].only('full_statement')]
+            with self.subTest(size=size), self.assertNumQueries(1):
+                build_response({"statements": statements, "more": ""})
@@ -0,0 +1,55 @@
+import base64
+import json
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from ..utils.lookup_cache import clear_lookup_caches
+
+
+@override_settings(STATEMENT_STREAM_CHUNK_SIZE=2)
+class StatementStreamTests(TestCase):
+
+    def setUp(self):
+        # Rows cached by an earlier test were rolled back
+        clear_lookup_caches()
+        self.auth = "Basic %s" % base64.b64encode(b"tom:1234").decode()
+        User.objects.create_user("tom", "tom@example.com", "1234")
+        stmts = [{"actor": {"mbox": "mailto:tom@example.com"},
+                  "verb": {"id": "http://example.com/verbs/passed", "display": {"en-US": "passed"}},
+                  "object": {"id": "act:test/%s" % i, "definition": {"name": {"en-US": "test %s" % i}}},
+                  "context": {"contextActivities": {"parent": [{"id": "act:test/parent"}]}}} for i in range(7)]
+        resp = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 200)
+
+    def get(self, url, params, stream):
+        # Pages over the limit are streamed
+        with self.settings(STATEMENT_STREAM_LIMIT=1 if stream else 1000):
+            resp = self.client.get(url, params, Authorization=self.auth,
+                                   X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.streaming, stream)
+            body = b"".join(resp.streaming_content) if stream else resp.content
+        # The more URLs hold the time of their own first page
+        more = json.loads(body)['more']
+        return body.replace(json.dumps(more).encode(), b'""'), more
+
+    def test_same_body(self):
+        for stmt_format in ["exact", "ids", "canonical"]:
+            # Chunks of 2 make the pages end on a full chunk, part of one and
+            # after the last statement
+            for limit in [4, 5, 10]:
+                with self.subTest(stmt_format=stmt_format, limit=limit):
+                    params = {"format": stmt_format, "limit": limit}
+                    streamed, streamed_more = self.get(reverse('lrs:statements'), params, True)
+                    body, more = self.get(reverse('lrs:statements'), params, False)
+                    self.assertEqual(streamed, body)
+                    self.assertEqual(len(json.loads(body)['statements']), min(limit, 7))
+                    self.assertEqual(bool(streamed_more), bool(more))
+                    self.assertEqual(bool(more), limit < 7)
+                    if more:
+                        self.assertEqual(self.get(streamed_more, None, True)[0], self.get(more, None, False)[0])
@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from ..utils.task_dispatch import TaskDispatcher
+
+
+class BrokerDownTask():
+    name = 'lrs.tasks.test_task'
+
+    def __init__(self):
+        self.calls = []
+
+    def delay(self, ids):
+        raise ConnectionError("Broker is down")
+
+    def __call__(self, ids):
+        self.calls.append(ids)
+
+
+@override_settings(TASK_DISPATCH_INTERVAL=60, TASK_DISPATCH_BATCH_SIZE=2)
+@mock.patch('lrs.utils.task_dispatch.connections')
+class TaskDispatcherTests(SimpleTestCase):
+
+    def test_exit_with_broker_down(self, connections):
+        # The fallback pool is shut down by the time exit runs, the IDs still
+        # buffered run in this thread
+        dispatcher = TaskDispatcher()
+        task = BrokerDownTask()
+        dispatcher.add(task, ['1', '2', '3'])
+        dispatcher.exit()
+        self.assertEqual(task.calls, [['1', '2'], ['3']])
+        self.assertEqual(dispatcher.stats(), {'pending': 0, 'published': 0, 'ran_locally': 2})
+
+    def test_pool_shut_down(self, connections):
+        dispatcher = TaskDispatcher()
+        dispatcher.pool = ThreadPoolExecutor(max_workers=1)
+        dispatcher.pool.shutdown()
+        task = BrokerDownTask()
+        dispatcher.send(task, ['1'])
+        self.assertEqual(task.calls, [['1']])
@@ -0,0 +1,139 @@
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered-default'},
+    'tiered': {
+        'BACKEND': 'lrs.utils.tiered_cache.TieredCache',
+        'LOCATION': 'tiered-test',
+        'OPTIONS': {'SHARED': 'shared', 'SPOOL': 'spool', 'SPOOL_THRESHOLD': 100, 'LOCAL_MAX_SIZE': 1000,
+                    'LOCAL_TIMEOUT': 60},
+    },
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered-shared'},
+    'spool': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered-spool'},
+}
+
+SMALL = "small"
+LARGE = "large" * 40
+
+
+@override_settings(CACHES=CACHES)
+class TieredCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = caches['tiered']
+        self.shared = caches['shared']
+        self.spool = caches['spool']
+        self.cache.clear()
+        self.counts = self.cache.stats()
+
+    def get_counts(self):
+        # Counts since setUp, the LRU is shared with every earlier instance
+        stats = self.cache.stats()
+        return {name: stats[name] - self.counts[name]
+                for name in ['local_hits', 'shared_hits', 'spool_hits', 'misses', 'evictions', 'spooled']}
+
+    def test_tiers(self):
+        self.cache.set('small', SMALL)
+        self.cache.set('large', LARGE)
+        self.assertEqual((self.shared.get('small'), self.spool.get('small')), (SMALL, None))
+        self.assertEqual((self.shared.get('large'), self.spool.get('large')), (None, LARGE))
+        # Spooled values aren't held in process
+        self.assertEqual(self.cache.stats()['local_entries'], 1)
+
+        self.assertEqual(self.cache.get('small'), SMALL)
+        self.cache.clear_local()
+        self.assertEqual(self.cache.get('small'), SMALL)
+        self.assertEqual(self.cache.get('small'), SMALL)
+        self.assertEqual(self.cache.get('large'), LARGE)
+        self.assertIsNone(self.cache.get('missing'))
+        self.assertEqual(self.get_counts(), {'local_hits': 2, 'shared_hits': 1, 'spool_hits': 1, 'misses': 1,
+                                             'evictions': 0, 'spooled': 1})
+
+    def test_moved(self):
+        self.cache.set('key', SMALL)
+        self.cache.set('key', LARGE)
+        # The shared copy would be read before the spooled one
+        self.assertIsNone(self.shared.get('key'))
+        self.cache.clear_local()
+        self.assertEqual(self.cache.get('key'), LARGE)
+
+        self.cache.set('key', SMALL)
+        self.cache.clear_local()
+        self.assertEqual(self.cache.get('key'), SMALL)
+
+        self.cache.set_many({'key': LARGE})
+        self.assertIsNone(self.shared.get('key'))
+        self.cache.clear_local()
+        self.assertEqual(self.cache.get_many(['key']), {'key': LARGE})
+
+    def test_set_many(self):
+        with mock.patch.object(self.shared, 'delete_many') as shared_delete, \
+                mock.patch.object(self.spool, 'delete_many') as spool_delete:
+            self.assertEqual(self.cache.set_many({'a': SMALL, 'b': SMALL}), [])
+            # Nothing was spooled, so nothing is deleted
+            self.assertFalse(shared_delete.called)
+            self.cache.set_many({'c': SMALL, 'd': LARGE})
+            shared_delete.assert_called_once_with(['d'], version=None)
+            self.assertFalse(spool_delete.called)
+
+        self.cache.clear_local()
+        # One read of each tier for the values the LRU doesn't have
+        with mock.patch.object(self.shared, 'get_many', wraps=self.shared.get_many) as shared_get, \
+                mock.patch.object(self.spool, 'get_many', wraps=self.spool.get_many) as spool_get:
+            self.assertEqual(self.cache.get_many(['a', 'b', 'c', 'd', 'e']),
+                             {'a': SMALL, 'b': SMALL, 'c': SMALL, 'd': LARGE})
+            self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'a': SMALL, 'b': SMALL, 'c': SMALL})
+        self.assertEqual(shared_get.call_count, 1)
+        self.assertEqual(spool_get.call_args_list, [mock.call(['d', 'e'], version=None)])
+
+    def test_local_size(self):
+        for i in range(50):
+            self.cache.set('key-%d' % i, "value %d" % i)
+            # The first key is kept as the most recently used
+            self.cache.get('key-0')
+        stats = self.cache.stats()
+        self.assertLessEqual(stats['local_size'], 1000)
+        self.assertGreater(self.get_counts()['evictions'], 0)
+        local_hits = stats['local_hits']
+        self.assertEqual(self.cache.get('key-0'), "value 0")
+        self.assertEqual(self.cache.get('key-1'), "value 1")
+        self.assertEqual(self.cache.stats()['local_hits'], local_hits + 1)
+
+    def test_local_timeout(self):
+        self.cache.set('key', SMALL)
+        self.cache.get('key')
+        now = time.monotonic()
+        with mock.patch('lrs.utils.tiered_cache.time.monotonic', return_value=now + 61):
+            self.assertEqual(self.cache.get('key'), SMALL)
+        self.assertEqual(self.get_counts()['local_hits'], 1)
+        self.assertEqual(self.get_counts()['shared_hits'], 1)
+
+    def test_threads(self):
+        # Every thread has its own instance, sharing the process's LRU
+        self.cache.set('key', SMALL)
+        found = []
+        thread = threading.Thread(target=lambda: found.append((caches['tiered'], caches['tiered'].get('key'))))
+        thread.start()
+        thread.join()
+        self.assertIsNot(found[0][0], self.cache)
+        self.assertEqual(found[0][1], SMALL)
+        self.assertEqual(self.get_counts()['local_hits'], 1)
+
+    def test_delete(self):
+        self.cache.set_many({'small': SMALL, 'large': LARGE})
+        self.assertTrue(self.cache.delete('small'))
+        self.cache.delete_many(['large'])
+        self.assertEqual(self.cache.get_many(['small', 'large']), {})
+        self.assertEqual((self.shared.get('small'), self.spool.get('large')), (None, None))
+        self.assertFalse(self.cache.delete('small'))
+
+    def test_add(self):
+        self.assertTrue(self.cache.add('key', LARGE))
+        self.assertFalse(self.cache.add('key', SMALL))
+        self.assertEqual(self.cache.get('key'), LARGE)
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import caches
+
+METADATA_KEY = "activity_metadata:%s"
+
+
+def get_metadata_key(activity_id):
+    # Activity IDs are IRIs of any length, hashed to keep the key safe for
+    # any cache backend
+    return METADATA_KEY % hashlib.sha1(activity_id.encode('utf-8')).hexdigest()
+
+
+def is_resolvable(activity_id):
+    # Only http(s) IDs are fetched. urlopen would also open file: and ftp:
+    # URLs, reading the server's own files into activity definitions, and
+    # IRIs like urn: or tag: never resolved
+    return activity_id.lower().startswith(('http://', 'https://'))
+
+
+def get_stale_entries(activity_ids):
+    # Cache entries of the ids due to be fetched again, None for ids that
+    # were never fetched
+    keys = {get_metadata_key(act_id): act_id for act_id in activity_ids if is_resolvable(act_id)}
+    entries = caches['activity_metadata'].get_many(list(keys))
+    now = time.time()
+    return {act_id: entries.get(key, None) for key, act_id in keys.items()
+            if key not in entries or entries[key]['fresh_until'] <= now}
+
+
+def fetch_metadata(activity_id, entry):
+    # Runs on a pool thread so no database access here. Returns the cache
+    # entry to keep and the parsed JSON document if there was a new one
+    req = urllib.request.Request(activity_id)
+    req.add_header('Accept', 'application/json, */*')
+    # Ask only for a changed document if it resolved before
+    if entry and entry['resolved']:
+        if entry['etag']:
+            req.add_header('If-None-Match', entry['etag'])
+        if entry['last_modified']:
+            req.add_header('If-Modified-Since', entry['last_modified'])
+    now = time.time()
+    try:
+        resp = urllib.request.urlopen(req, timeout=settings.ACTIVITY_ID_RESOLVE_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return dict(entry, fresh_until=now + settings.ACTIVITY_METADATA_TTL), None
+        return get_entry(False, now), None
+    except Exception:
+        # Doesn't resolve - hopefully data is in payload
+        return get_entry(False, now), None
+
+    with resp:
+        try:
+            data = json.loads(resp.read())
+        except Exception:
+            # Resolves but no data to retrieve - this is OK
+            data = None
+        headers = resp.headers
+    if not data:
+        return get_entry(False, now), None
+    return get_entry(True, now, headers.get('ETag', None), headers.get('Last-Modified', None)), data
+
+
+def get_entry(resolved, now, etag=None, last_modified=None):
+    # IDs that didn't give a JSON document are tried again sooner
+    ttl = settings.ACTIVITY_METADATA_TTL if resolved else settings.ACTIVITY_METADATA_FAILURE_TTL
+    return {'resolved': resolved, 'etag': etag, 'last_modified': last_modified, 'fresh_until': now + ttl}
+
+
+def fetch_stale_metadata(activity_ids):
+    # Fetches the metadata of the ids that aren't fresh in the cache side by
+    # side, returning (activity_id, document) for every new JSON document
+    stale = get_stale_entries(activity_ids)
+    if not stale:
+        return []
+    workers = min(settings.ACTIVITY_METADATA_WORKERS, len(stale))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(zip(stale, pool.map(fetch_metadata, stale, stale.values())))
+    caches['activity_metadata'].set_many({get_metadata_key(act_id): entry for act_id, (entry, _) in results})
+    return [(act_id, data) for act_id, (_, data) in results if data]
@@ -8,11 +8,11 @@ from django.urls import reverse
 
 from ..exceptions import Unauthorized, BadRequest, Forbidden, OauthUnauthorized, OauthBadRequest
 from ..models import Agent
+from .lookup_cache import credential_cache
 
 from oauth_provider.models import Consumer
 from oauth_provider.utils import get_oauth_request, require_params
 from oauth_provider.decorators import CheckOauth
-from oauth_provider.store import store
 
 # A decorator, that can be used to authenticate some requests at the site.
 
@@ -64,11 +64,7 @@ def non_xapi_auth(func):
                         else:
                             raise OauthBadRequest(error)
                     # Consumer and token should be clean by now
-                    consumer = store.get_consumer(
-                        request, oauth_request, oauth_request['oauth_consumer_key'])
-                    token = store.get_access_token(
-                        request, oauth_request, consumer, oauth_request.get_parameter('oauth_token'))
-                    request.META['lrs-user'] = token.user
+                    request.META['lrs-user'] = request.oauth_token.user
                 else:
                     auth = auth.split()
                     if len(auth) == 2:
@@ -204,24 +200,29 @@ def http_auth_helper(request):
                     request['auth']['user'] = None
                     request['auth']['agent'] = None
                 elif uname or passwd:
-                    user = authenticate(username=uname, password=passwd)
-                    if user:
-                        # If the user successfully logged in, then add/overwrite
-                        # the user object of this request.
-                        request['auth']['user'] = user
-                        try:
-                            request['auth']['agent'] = user.agent    
-                        except Exception:
-                            # Gets here if for some reason the agent is deleted
-                            agent = Agent.objects.retrieve_or_create(
-                                **{'name': user.username, 'mbox': 'mailto:%s' % user.email, \
-                                'objectType': 'Agent'})[0]
-                            agent.user = user
-                            agent.save()
-                            request['auth']['agent'] = user.agent
+                    credentials = credential_cache.get_credentials(User, Agent, uname, passwd)
+                    if credentials:
+                        request['auth']['user'], request['auth']['agent'] = credentials
                     else:
-                        raise Unauthorized(
-                            "Authorization failed, please verify your username and password")
+                        user = authenticate(username=uname, password=passwd)
+                        if user:
+                            # If the user successfully logged in, then add/overwrite
+                            # the user object of this request.
+                            request['auth']['user'] = user
+                            try:
+                                request['auth']['agent'] = user.agent    
+                            except Exception:
+                                # Gets here if for some reason the agent is deleted
+                                agent = Agent.objects.retrieve_or_create(
+                                    **{'name': user.username, 'mbox': 'mailto:%s' % user.email, \
+                                    'objectType': 'Agent'})[0]
+                                agent.user = user
+                                agent.save()
+                                request['auth']['agent'] = user.agent
+                            credential_cache.set_credentials(uname, passwd, user, request['auth']['agent'])
+                        else:
+                            raise Unauthorized(
+                                "Authorization failed, please verify your username and password")
                 request['auth']['define'] = True
             else:
                 raise Unauthorized(
@@ -265,5 +266,7 @@ def oauth_helper(request):
     # create/get oauth group and set in dictionary
     oauth_group, created = Agent.objects.oauth_group(**kwargs)
     request['auth']['agent'] = oauth_group
-    request['auth']['user'] = get_user_from_auth(oauth_group)
+    # The user get_user_from_auth finds through the group's account member,
+    # without the queries
+    request['auth']['user'] = consumer.user
     validate_oauth_scope(request)
@@ -0,0 +1,215 @@
+import hmac
+import json
+import threading
+import time
+from datetime import timedelta
+from hashlib import sha1
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from celery.utils.log import get_task_logger
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+celery_logger = get_task_logger('celery-task')
+
+PENDING_KEY = "hook_delivery:pending:%s"
+
+
+def enqueue(hook_id, statements):
+    # Queues the statements for the hook, returning the countdown to schedule
+    # a delivery with, None if one is already coming
+    from adl_lrs.models import HookDelivery
+    HookDelivery.objects.create(hook_id=hook_id, statements=statements)
+    key = PENDING_KEY % hook_id
+    # The first statements of a window schedule the delivery at its end
+    if cache.add(key, len(statements), settings.HOOK_DELIVERY_WINDOW):
+        pending, countdown = len(statements), settings.HOOK_DELIVERY_WINDOW
+    else:
+        try:
+            pending, countdown = cache.incr(key, len(statements)), None
+        except ValueError:
+            # The window ended in between, these start the next one
+            cache.add(key, len(statements), settings.HOOK_DELIVERY_WINDOW)
+            pending, countdown = len(statements), settings.HOOK_DELIVERY_WINDOW
+    if pending >= settings.HOOK_DELIVERY_BATCH_SIZE:
+        # A full batch goes right away and the next statements start a new window
+        cache.delete(key)
+        return 0
+    return countdown
+
+
+def get_retry_delay(attempts):
+    return min(settings.HOOK_DELIVERY_RETRY_DELAY * 2 ** (attempts - 1), settings.HOOK_DELIVERY_MAX_RETRY_DELAY)
+
+
+def get_payload(hook_id, config, statements):
+    data = '{"statements": [%s], "id": "%s"}' % (",".join(json.dumps(stmt) for stmt in statements), str(hook_id))
+    if config['content_type'] == 'json':
+        headers = {'Content-Type': 'application/json'}
+    else:
+        data = 'payload=' + data
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    secret = config['secret'] if 'secret' in config else False
+    if secret:
+        headers['X-LRS-Signature'] = hmac.new(
+            str(secret).encode('utf-8'), data.encode('utf-8'), sha1).hexdigest()
+    return data, headers
+
+
+class EndpointPool(object):
+    """
+    A keep-alive requests.Session per endpoint origin, with connections and
+    requests in flight capped at HOOK_ENDPOINT_CONCURRENCY in this process.
+    Also counts the deliveries made and their latency.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.slots = {}
+        self.delivered = 0
+        self.delivered_statements = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        # Seconds spent in requests and from queueing to delivery
+        self.request_time = 0.0
+        self.queue_time = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, endpoint):
+        parts = urlsplit(endpoint)
+        origin = (parts.scheme, parts.netloc)
+        with self._lock:
+            if origin not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.HOOK_ENDPOINT_CONCURRENCY,
+                                      pool_block=True)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[origin] = session
+                self.slots[origin] = threading.BoundedSemaphore(settings.HOOK_ENDPOINT_CONCURRENCY)
+            return self.sessions[origin], self.slots[origin]
+
+    def post(self, endpoint, data, headers):
+        session, slot = self.get(endpoint)
+        with slot:
+            return session.post(endpoint, data=data, headers=headers, verify=False,
+                                timeout=settings.HOOK_DELIVERY_TIMEOUT)
+
+    def record(self, statements=0, request_time=0.0, queue_time=0.0, failed=0, dead_lettered=0):
+        with self._lock:
+            if statements:
+                self.delivered += 1
+                self.delivered_statements += statements
+            self.request_time += request_time
+            self.queue_time += queue_time
+            self.failed += failed
+            self.dead_lettered += dead_lettered
+
+    def stats(self):
+        with self._lock:
+            return {'endpoints': len(self.sessions), 'delivered': self.delivered,
+                    'delivered_statements': self.delivered_statements, 'failed': self.failed,
+                    'dead_lettered': self.dead_lettered, 'request_time': self.request_time,
+                    'queue_time': self.queue_time}
+
+
+endpoint_pool = EndpointPool()
+
+
+def claim(hook_id):
+    # Due deliveries of the hook making up one batch, hidden from other
+    # workers until the request is done
+    from adl_lrs.models import HookDelivery
+    now = timezone.now()
+    with transaction.atomic():
+        due = HookDelivery.objects.select_for_update(skip_locked=True).filter(
+            hook_id=hook_id, next_attempt__lte=now).order_by('pk')[:settings.HOOK_DELIVERY_BATCH_SIZE]
+        claimed = []
+        size = 0
+        for delivery in due:
+            if claimed and size + len(delivery.statements) > settings.HOOK_DELIVERY_BATCH_SIZE:
+                break
+            claimed.append(delivery)
+            size += len(delivery.statements)
+        HookDelivery.objects.filter(pk__in=[d.pk for d in claimed]).update(
+            next_attempt=now + timedelta(seconds=settings.HOOK_DELIVERY_TIMEOUT * 3))
+    return claimed
+
+
+def deliver(hook_id):
+    # Sends the hook's due deliveries a batch at a time until none are left
+    # or one fails, returning the countdown to retry after if one did
+    from adl_lrs.models import Hook
+    try:
+        hook = Hook.objects.get(hook_id=hook_id)
+    except Hook.DoesNotExist:
+        return None
+    window_ended = False
+    while True:
+        deliveries = claim(hook_id)
+        if not deliveries:
+            if window_ended:
+                return None
+            # Statements queued from now on start a new window with its own
+            # delivery, the ones queued before it ended are claimed once more
+            cache.delete(PENDING_KEY % hook_id)
+            window_ended = True
+            continue
+        retry = send(hook, deliveries)
+        if retry is not None:
+            return retry
+
+
+def send(hook, deliveries):
+    from adl_lrs.models import HookDelivery
+    endpoint = str(hook.config['endpoint'])
+    statements = [stmt for d in deliveries for stmt in d.statements]
+    data, headers = get_payload(hook.hook_id, hook.config, statements)
+    started = time.monotonic()
+    try:
+        celery_logger.info("Sending %d statements to hook endpoint %s" % (len(statements), endpoint))
+        resp = endpoint_pool.post(endpoint, data, headers)
+        if resp.status_code >= 300:
+            raise Exception("HTTP %s - %s" % (resp.status_code, resp.content[:200]))
+    except Exception as e:
+        return fail(hook, deliveries, str(e))
+
+    request_time = time.monotonic() - started
+    queue_time = (timezone.now() - min(d.created_at for d in deliveries)).total_seconds()
+    HookDelivery.objects.filter(pk__in=[d.pk for d in deliveries]).delete()
+    endpoint_pool.record(statements=len(statements), request_time=request_time, queue_time=queue_time)
+    celery_logger.info("Delivered %d statements to hook endpoint %s in %.3fs, %.3fs after queueing" % (
+        len(statements), endpoint, request_time, queue_time))
+    return None
+
+
+def fail(hook, deliveries, error):
+    from adl_lrs.models import HookDelivery, HookDeadLetter
+    celery_logger.warning("Could not send statements to hook %s: %s" % (str(hook.config['endpoint']), error))
+    now = timezone.now()
+    retry = None
+    dead = []
+    with transaction.atomic():
+        for delivery in deliveries:
+            delivery.attempts += 1
+            delivery.last_error = error
+            if delivery.attempts >= settings.HOOK_DELIVERY_MAX_ATTEMPTS:
+                dead.append(delivery)
+                continue
+            delay = get_retry_delay(delivery.attempts)
+            delivery.next_attempt = now + timedelta(seconds=delay)
+            delivery.save(update_fields=['attempts', 'last_error', 'next_attempt'])
+            retry = delay if retry is None else min(retry, delay)
+        if dead:
+            HookDeadLetter.objects.bulk_create([HookDeadLetter(
+                hook_id=d.hook_id, statements=d.statements, attempts=d.attempts, last_error=error,
+                created_at=d.created_at) for d in dead])
+            HookDelivery.objects.filter(pk__in=[d.pk for d in dead]).delete()
+    endpoint_pool.record(failed=1, dead_lettered=len(dead))
+    return retry
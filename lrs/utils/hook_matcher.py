@@ -0,0 +1,241 @@
+import threading
+import uuid
+
+from celery.utils.log import get_task_logger
+
+from django.core.cache import cache
+
+from .lookup_cache import get_ifp_key
+
+celery_logger = get_task_logger('celery-task')
+
+GENERATION_KEY = "hook_matcher:generation"
+
+# Kind of index key each leaf of a compiled filter is found by - the object
+# activity and the actor are also related ones
+INDEX_KINDS = {'verb': 'verb', 'object': 'activity', 'activity': 'activity', 'actor': 'agent', 'agent': 'agent'}
+
+
+def combine(op, left, right):
+    # Same as combining Q objects, an empty filter (None) leaves the other
+    # side as it is
+    if left is None:
+        return right
+    if right is None:
+        return left
+    children = []
+    for node in (left, right):
+        children.extend(node[1] if node[0] == op else [node])
+    return (op, children)
+
+
+def get_filter_agent_key(agent_data):
+    try:
+        return get_ifp_key(agent_data)
+    except Exception:
+        celery_logger.exception("Agent data was invalid for agent filter")
+        return None
+
+
+def compile_filter(filters):
+    # Predicate tree of a hook's filters, None if every statement matches
+    if not isinstance(filters, dict):
+        return None
+    node = None
+    actors = filters.get('actor', None)
+    if isinstance(actors, list):
+        keys = [get_filter_agent_key(a) for a in actors if isinstance(a, dict)]
+        keys = frozenset(k for k in keys if k is not None)
+        if keys:
+            node = combine('and', node, ('actor', keys))
+    verbs = filters.get('verb', None)
+    if isinstance(verbs, list):
+        ids = frozenset(v['id'] for v in verbs if isinstance(v, dict) and 'id' in v)
+        if ids:
+            node = combine('and', node, ('verb', ids))
+    objects = filters.get('object', None)
+    if isinstance(objects, list):
+        ids = frozenset(o['id'] for o in objects if isinstance(o, dict) and 'id' in o)
+        if ids:
+            node = combine('and', node, ('object', ids))
+    related = filters.get('related', None)
+    if isinstance(related, list):
+        node = combine('and', node, compile_related_filter(related, True))
+    return node
+
+
+def compile_related_filter(related, or_operand):
+    op = 'or' if or_operand else 'and'
+    node, inner = None, None
+    act_list = []
+    for ob in related:
+        if not isinstance(ob, dict):
+            continue
+        # Any or/and values should be a list
+        if 'or' in ob:
+            if isinstance(ob['or'], list):
+                inner = combine('or', inner, compile_related_filter(ob['or'], True))
+        elif 'and' in ob:
+            if isinstance(ob['and'], list):
+                inner = combine('and', inner, compile_related_filter(ob['and'], False))
+        # Any other values will be an object
+        elif 'id' in ob:
+            act_list.append(ob['id'])
+        else:
+            key = get_filter_agent_key(ob)
+            if key is not None:
+                node = combine(op, node, ('agent', frozenset([key])))
+    # The activities match if the statement has any of them
+    if act_list:
+        node = combine(op, node, ('activity', frozenset(act_list)))
+    return combine(op, node, inner)
+
+
+def get_index_keys(node):
+    # Keys a statement needs at least one of to match, None if any can
+    if node is None:
+        return None
+    kind, values = node
+    if kind == 'and':
+        keys = [k for k in (get_index_keys(n) for n in values) if k is not None]
+        return min(keys, key=len) if keys else None
+    if kind == 'or':
+        keys = [get_index_keys(n) for n in values]
+        if any(k is None for k in keys):
+            return None
+        return frozenset().union(*keys)
+    return frozenset((INDEX_KINDS[kind], v) for v in values)
+
+
+def evaluate(node, facts):
+    kind, values = node
+    if kind == 'and':
+        return all(evaluate(n, facts) for n in values)
+    if kind == 'or':
+        return any(evaluate(n, facts) for n in values)
+    if kind == 'verb':
+        return facts['verb'] in values
+    if kind == 'object':
+        return facts['object'] in values
+    if kind == 'actor':
+        return facts['actor'] in values
+    if kind == 'activity':
+        return not values.isdisjoint(facts['activities'])
+    return not values.isdisjoint(facts['agents'])
+
+
+def get_object_activity(stmt):
+    stmt_object = stmt['object']
+    if stmt_object.get('objectType', 'Activity') == 'Activity':
+        return stmt_object['id']
+    return None
+
+
+def add_related(stmt, activities, agents, roles):
+    # Same activities and agents as the StatementActivity and StatementAgent
+    # rows written for the statement
+    activity = get_object_activity(stmt)
+    if activity is not None:
+        activities.add(activity)
+    context = stmt.get('context', {})
+    for con_acts in context.get('contextActivities', {}).values():
+        if not isinstance(con_acts, list):
+            con_acts = [con_acts]
+        activities.update(con_act['id'] for con_act in con_acts)
+    agent_data = [stmt.get(r, None) for r in roles] + [context.get('instructor', None), context.get('team', None)]
+    if stmt['object'].get('objectType', None) in ['Agent', 'Group']:
+        agent_data.append(stmt['object'])
+    for data in agent_data:
+        key = get_ifp_key(data) if data else None
+        if key is not None:
+            agents.add(key)
+
+
+def get_statement_facts(stmt):
+    activities, agents = set(), set()
+    add_related(stmt, activities, agents, ['actor', 'authority'])
+    if stmt['object'].get('objectType', None) == 'SubStatement':
+        add_related(stmt['object'], activities, agents, ['actor'])
+    facts = {'verb': stmt['verb']['id'], 'object': get_object_activity(stmt),
+             'actor': get_ifp_key(stmt['actor']), 'activities': activities, 'agents': agents}
+    facts['index_keys'] = [('verb', facts['verb'])] + [('activity', a) for a in activities] + \
+        [('agent', k) for k in agents]
+    return facts
+
+
+class CompiledHooks(object):
+    """
+    Filters of every hook compiled to predicate trees over the statement
+    JSON, with an inverted index from verb ID, activity ID and agent IFP to
+    the hooks a statement with it could match.
+    """
+
+    def __init__(self, rows):
+        # (hook_id, config, predicate tree)
+        self.hooks = []
+        self.index = {}
+        self.unindexed = []
+        for hook_id, filters, config in rows:
+            try:
+                node = compile_filter(filters)
+            except Exception:
+                celery_logger.exception("Could not compile filters of hook %s" % hook_id)
+                continue
+            position = len(self.hooks)
+            self.hooks.append((hook_id, config, node))
+            keys = get_index_keys(node)
+            if keys is None:
+                self.unindexed.append(position)
+            else:
+                for key in keys:
+                    self.index.setdefault(key, []).append(position)
+
+    def match(self, statements):
+        # [(hook_id, config, [matching statements])], each in the order given
+        found = {}
+        for stmt in statements:
+            facts = get_statement_facts(stmt)
+            candidates = set(self.unindexed)
+            for key in facts['index_keys']:
+                candidates.update(self.index.get(key, ()))
+            for position in candidates:
+                node = self.hooks[position][2]
+                if node is None or evaluate(node, facts):
+                    found.setdefault(position, []).append(stmt)
+        return [self.hooks[p][:2] + (found[p],) for p in sorted(found)]
+
+
+class HookMatcher(object):
+    """
+    Compiled hooks of this process, compiled again only after a hook is
+    saved or deleted by any worker.
+    """
+
+    def __init__(self):
+        self.generation = None
+        self.compiled = None
+        self.compiles = 0
+        self._lock = threading.Lock()
+
+    def get_hooks(self):
+        from adl_lrs.models import Hook
+        # The generation is read first so a hook changed while loading gets
+        # picked up next time
+        generation = cache.get(GENERATION_KEY)
+        with self._lock:
+            if self.compiled is not None and generation == self.generation:
+                return self.compiled
+        compiled = CompiledHooks(Hook.objects.values_list('hook_id', 'filters', 'config'))
+        with self._lock:
+            self.compiled = compiled
+            self.generation = generation
+            self.compiles += 1
+        return compiled
+
+    def invalidate(self):
+        cache.set(GENERATION_KEY, uuid.uuid4().hex, None)
+        with self._lock:
+            self.compiled = None
+
+
+hook_matcher = HookMatcher()
@@ -0,0 +1,251 @@
+import copy
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+# Key in the shared cache that changes every time a cached row is updated or
+# deleted, so the other workers know to drop what they have
+GENERATION_KEY = "lookup_cache_generation:%s"
+
+
+def get_ifp_key(data):
+    # IFP tuple of incoming agent data, in the order AgentManager checks them
+    for ifp in ['mbox', 'mbox_sha1sum', 'account', 'openid']:
+        if data.get(ifp, None) is not None:
+            if ifp == 'account':
+                return (ifp, data['account']['homePage'], data['account']['name'])
+            return (ifp, data[ifp])
+    return None
+
+
+def get_agent_ifp_keys(agent):
+    # Every IFP tuple a saved agent can be looked up by, and the identifier
+    # of an OAuth group
+    keys = []
+    if agent.mbox:
+        keys.append(('mbox', agent.mbox))
+    if agent.mbox_sha1sum:
+        keys.append(('mbox_sha1sum', agent.mbox_sha1sum))
+    if agent.account_name:
+        keys.append(('account', agent.account_homePage, agent.account_name))
+    if agent.openid:
+        keys.append(('openid', agent.openid))
+    if agent.oauth_identifier:
+        keys.append(('oauth_identifier', agent.oauth_identifier))
+    return keys
+
+
+class LookupCache():
+    """
+    Process-local LRU cache mapping a natural key (verb_id, activity_id or
+    agent IFP tuple) to the column values of the row, bounded by size and TTL.
+
+    Rows changed or deleted in this worker are updated in place and the shared
+    generation key is changed, so every other worker flushes its copy the next
+    time it syncs. Until then a copy can be out of date, so it is only read:
+    a row about to be written is read again with select_for_update.
+    """
+
+    def __init__(self, name, max_size=None, timeout=None, sync_interval=None):
+        self.name = name
+        self.max_size = max_size if max_size is not None else settings.LOOKUP_CACHE_SIZE
+        self.timeout = timeout if timeout is not None else settings.LOOKUP_CACHE_TIMEOUT
+        self.sync_interval = sync_interval if sync_interval is not None else settings.LOOKUP_CACHE_SYNC_INTERVAL
+        self.generation_key = GENERATION_KEY % name
+        self.generation = None
+        self.last_sync = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Saves of the model made while storing statements, and the ones left
+        # out because nothing in the row changed
+        self.writes = 0
+        self.skipped_writes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        if self.last_sync is None or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def sync(self, generation=None):
+        # Drop everything if another worker changed a row since the last sync
+        if generation is None:
+            generation = cache.get(self.generation_key)
+        with self._lock:
+            if generation != self.generation:
+                self.clear()
+                self.generation = generation
+            self.last_sync = time.monotonic()
+
+    def bump_generation(self):
+        current = cache.get(self.generation_key)
+        generation = uuid.uuid4().hex
+        cache.set(self.generation_key, generation, None)
+        with self._lock:
+            # Somebody else changed a row since the last sync too
+            if current != self.generation:
+                self.clear()
+            self.generation = generation
+
+    def record_writes(self, written=1, skipped=0):
+        with self._lock:
+            self.writes += written
+            self.skipped_writes += skipped
+
+    def stats(self):
+        return {'name': self.name, 'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'writes': self.writes, 'skipped_writes': self.skipped_writes}
+
+    def get_instance(self, model, key):
+        values = self.get(key)
+        if values is None:
+            return None
+        return from_values(model, values)
+
+    def set_instance(self, key, instance):
+        self.set(key, get_values(instance))
+
+    def update_instance(self, keys, instance, created=False):
+        # Only tell the other workers if the row really changed - new rows
+        # can't be in anybody's cache yet
+        values = tuple(getattr(instance, f.attname) for f in instance._meta.concrete_fields)
+        changed = not created and any(self.peek(key) != values for key in keys)
+        for key in keys:
+            self.set(key, copy.deepcopy(values))
+        if changed:
+            self.bump_generation()
+
+    def delete_instance(self, keys):
+        for key in keys:
+            self.delete(key)
+        if keys:
+            self.bump_generation()
+
+    def peek(self, key):
+        # Get without touching the counters, LRU order or sync
+        with self._lock:
+            entry = self._entries.get(key, None)
+            return entry[0] if entry is not None else None
+
+
+class CredentialCache(LookupCache):
+    """
+    Users and their agents that passed HTTP Basic auth, keyed by an HMAC of
+    the username and password so the password hasher only runs on a miss.
+    Failed attempts are never cached.
+
+    Any change to a user or to an agent linked to one clears every worker's
+    copy, those are rare next to the auth checks. The generation is checked
+    on every lookup, so a changed password or a deactivated user is turned
+    away by every worker straight away.
+    """
+
+    def get_credentials(self, user_model, agent_model, username, password):
+        values = self.get(get_credential_key(username, password))
+        if values is None:
+            return None
+        return from_values(user_model, values[0]), from_values(agent_model, values[1])
+
+    def set_credentials(self, username, password, user, agent):
+        self.set(get_credential_key(username, password), (get_values(user), get_values(agent)))
+
+    def invalidate(self):
+        self.clear()
+        self.bump_generation()
+
+
+class OauthCache(CredentialCache):
+    """
+    Accepted OAuth consumers and approved access tokens by key, each with the
+    user it belongs to, so signed requests don't look them up every time.
+
+    Any change to a consumer, an access token or a user clears every worker's
+    copy, which covers status, approval and scope changes.
+    """
+
+    def get_with_user(self, model, user_model, key):
+        values = self.get(key)
+        if values is None:
+            return None
+        instance = from_values(model, values[0])
+        if values[1] is not None:
+            instance.user = from_values(user_model, values[1])
+        return instance
+
+    def set_with_user(self, key, instance):
+        self.set(key, (get_values(instance), get_values(instance.user) if instance.user_id else None))
+
+
+def get_values(instance):
+    # Column values of a row, copied so the cache doesn't share them
+    return copy.deepcopy(tuple(getattr(instance, f.attname) for f in instance._meta.concrete_fields))
+
+
+def from_values(model, values):
+    return model.from_db(DEFAULT_DB_ALIAS, [f.attname for f in model._meta.concrete_fields], copy.deepcopy(values))
+
+
+def get_credential_key(username, password):
+    # Only a keyed hash of the password is held in memory
+    message = ("%s\0%s" % (username, password)).encode('utf-8')
+    return hmac.new(settings.SECRET_KEY.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+verb_cache = LookupCache('verb')
+activity_cache = LookupCache('activity')
+agent_cache = LookupCache('agent')
+credential_cache = CredentialCache('credential', settings.CREDENTIAL_CACHE_SIZE, settings.CREDENTIAL_CACHE_TIMEOUT, 0)
+oauth_cache = OauthCache('oauth', settings.CREDENTIAL_CACHE_SIZE, settings.CREDENTIAL_CACHE_TIMEOUT, 0)
+lookup_caches = [verb_cache, activity_cache, agent_cache, credential_cache, oauth_cache]
+
+
+def sync_lookup_caches():
+    # One round trip to the shared cache for all of them
+    generations = cache.get_many([c.generation_key for c in lookup_caches])
+    for c in lookup_caches:
+        c.sync(generations.get(c.generation_key, None))
+
+
+def clear_lookup_caches():
+    for c in lookup_caches:
+        c.clear()
+
+
+def get_lookup_cache_stats():
+    return [c.stats() for c in lookup_caches]
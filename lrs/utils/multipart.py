@@ -0,0 +1,162 @@
+import hashlib
+import re
+import tempfile
+
+from django.conf import settings
+
+from ..exceptions import BadRequest, RequestEntityTooLarge
+
+# Bytes read from the request at a time
+READ_SIZE = 64 * 1024
+# Longest header block a part may have
+MAX_HEADER_SIZE = 16 * 1024
+# Blank line ending a part's headers, lines may end in CRLF or a bare LF
+HEADERS_END = re.compile(rb"\r?\n\r?\n")
+
+
+class MultipartPart():
+    """
+    One part of a multipart/mixed body. The payload is spooled to a temporary
+    file as it is read, moving to disk once it is larger than
+    ATTACHMENT_SPOOL_SIZE, and hashed on the way in.
+
+    Headers are looked up without regard to case like email.message.Message,
+    so part['Content-Type'] and part.get('X-Experience-API-Hash') work as
+    they did for the email parser.
+    """
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.file = tempfile.SpooledTemporaryFile(max_size=settings.ATTACHMENT_SPOOL_SIZE)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if data:
+            if self.size + len(data) > settings.MULTIPART_MAX_PART_SIZE:
+                raise RequestEntityTooLarge("Multipart part was larger than %d bytes"
+                                            % settings.MULTIPART_MAX_PART_SIZE)
+            self.file.write(data)
+            self.sha256.update(data)
+            self.size += len(data)
+
+    def finish(self):
+        self.file.seek(0)
+
+    def read(self):
+        # Whole payload, only used for the statement and signature parts
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(0)
+        return data
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def get(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return name.lower() in self.headers
+
+
+def get_boundary(content_type):
+    match = re.search(r'boundary=("(?P<quoted>[^"]+)"|(?P<token>[^;\s]+))', content_type or "")
+    if not match:
+        raise BadRequest("Could not find the boundary for the multipart content")
+    return (match.group('quoted') or match.group('token')).encode('latin-1')
+
+
+def parse_headers(block):
+    headers = {}
+    for line in block.decode('latin-1').splitlines():
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise BadRequest("Could not parse the multipart header: %s" % line)
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def parse_multipart(stream, content_type):
+    # Reads a multipart/mixed body from a file-like stream and returns its
+    # parts in order. Only the bytes between two delimiters are ever held in
+    # memory, payloads go straight to their part's spool file. Line breaks
+    # may be CRLF, as the RFC has it, or a bare LF
+    delimiter = b"\n--" + get_boundary(content_type)
+    # Treat the body as if it started with a line break so the first
+    # delimiter looks like every other one
+    buf = b"\r\n"
+    eof = False
+    read = 0
+    parts = []
+    part = None
+    state = 'preamble'
+
+    def fill():
+        nonlocal buf, eof, read
+        data = stream.read(READ_SIZE)
+        if not data:
+            eof = True
+        read += len(data)
+        if read > settings.MULTIPART_MAX_BODY_SIZE:
+            raise RequestEntityTooLarge("Multipart content was larger than %d bytes"
+                                        % settings.MULTIPART_MAX_BODY_SIZE)
+        buf += data
+
+    while True:
+        if state in ('preamble', 'body'):
+            idx = buf.find(delimiter)
+            if idx == -1:
+                if eof:
+                    raise BadRequest("Multipart content ended before its closing boundary")
+                # Keep enough of the end to find a delimiter split across
+                # reads, and the CR that may come before it
+                keep = len(delimiter)
+                if part is not None and len(buf) > keep:
+                    part.write(buf[:-keep])
+                buf = buf[-keep:] if len(buf) > keep else buf
+                fill()
+                continue
+            if part is not None:
+                # The line break before the delimiter belongs to it
+                part.write(buf[:idx - 1] if idx and buf[idx - 1:idx] == b"\r" else buf[:idx])
+                part.finish()
+            buf = buf[idx + len(delimiter):]
+            state = 'delimiter'
+        elif state == 'delimiter':
+            # The closing delimiter ends in --, any other is followed by
+            # optional whitespace and a line break
+            if len(buf) < 2 and not eof:
+                fill()
+                continue
+            line_end = buf.find(b"\n")
+            if buf.startswith(b"--"):
+                return parts
+            if line_end == -1:
+                if eof:
+                    raise BadRequest("Multipart content ended before its closing boundary")
+                if len(buf) > MAX_HEADER_SIZE:
+                    raise BadRequest("Multipart boundary line was too long")
+                fill()
+                continue
+            buf = buf[line_end + 1:]
+            state = 'headers'
+        elif state == 'headers':
+            # A part with no headers starts with the blank line right away
+            match = re.match(rb"\r?\n", buf) or HEADERS_END.search(buf)
+            if match is None:
+                if eof:
+                    raise BadRequest("Multipart content ended in the middle of a part's headers")
+                if len(buf) > MAX_HEADER_SIZE:
+                    raise BadRequest("Multipart part headers were too long")
+                fill()
+                continue
+            part = MultipartPart(parse_headers(buf[:match.start()]))
+            parts.append(part)
+            buf = buf[match.end():]
+            state = 'body'
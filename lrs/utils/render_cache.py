@@ -0,0 +1,66 @@
+import hashlib
+
+from django.core.cache import caches
+
+from ..models import Activity, RenderContext, Verb
+
+RENDER_KEY = "statement_render:%s:%s:%s"
+CONTEXT_ACTIVITY_FIELDS = ['context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other']
+
+
+def get_render_key(statement_id, language, stmt_format):
+    # Accept-Language order matters to get_lang, so only the spacing is
+    # normalized, hashed to keep the key safe for any cache backend
+    langs = ",".join(lang.strip() for lang in language) if language else ""
+    return RENDER_KEY % (stmt_format, hashlib.sha1(langs.encode('utf-8')).hexdigest(), statement_id)
+
+
+def get_render_stamps(stmt):
+    # canonical_version of every verb and activity the statement shows
+    verbs = [stmt.verb]
+    activities = [stmt.object_activity]
+    for st in [stmt, stmt.object_substatement]:
+        if st:
+            activities.extend(act for field in CONTEXT_ACTIVITY_FIELDS for act in getattr(st, field).all())
+    if stmt.object_substatement:
+        verbs.append(stmt.object_substatement.verb)
+        activities.append(stmt.object_substatement.object_activity)
+    return {'verbs': {v.pk: v.canonical_version for v in verbs if v},
+            'activities': {a.pk: a.canonical_version for a in activities if a}}
+
+
+def get_current_stamps(entries):
+    # One query per model for all the cached statements
+    verb_pks = set(pk for entry in entries for pk in entry['stamps']['verbs'])
+    activity_pks = set(pk for entry in entries for pk in entry['stamps']['activities'])
+    verbs = dict(Verb.objects.filter(pk__in=verb_pks).values_list('pk', 'canonical_version')) if verb_pks else {}
+    activities = dict(Activity.objects.filter(pk__in=activity_pks).values_list('pk', 'canonical_version')) \
+        if activity_pks else {}
+    return {'verbs': verbs, 'activities': activities}
+
+
+def is_current(stamps, current):
+    return all(current[model].get(pk, None) == version
+               for model in ['verbs', 'activities'] for pk, version in stamps[model].items())
+
+
+def get_rendered_statements(statement_ids, language, stmt_format, load):
+    # Renders of the statements in order, from the cache when none of the
+    # verbs and activities they show changed since, load gets the Statements
+    # for the ids that have to be rendered again
+    render_cache = caches['render_cache']
+    keys = [get_render_key(sid, language, stmt_format) for sid in statement_ids]
+    entries = render_cache.get_many(keys)
+    current = get_current_stamps(entries.values())
+    rendered = {key: entry['statement'] for key, entry in entries.items() if is_current(entry['stamps'], current)}
+
+    missing = [sid for sid, key in zip(statement_ids, keys) if key not in rendered]
+    if missing:
+        new_entries = {}
+        render_context = RenderContext()
+        for stmt in load(missing):
+            key = get_render_key(stmt.statement_id, language, stmt_format)
+            rendered[key] = stmt.to_dict(language, stmt_format, render_context)
+            new_entries[key] = {'stamps': get_render_stamps(stmt), 'statement': rendered[key]}
+        render_cache.set_many(new_entries)
+    return [rendered[key] for key in keys]
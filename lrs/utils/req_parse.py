@@ -1,7 +1,5 @@
 import ast
 import base64
-import email
-import hashlib
 import json
 
 from isodate import parse_duration
@@ -10,20 +8,17 @@ from Crypto.PublicKey import RSA
 from jose import jws
 
 from django.contrib.sites.shortcuts import get_current_site
-from django.core.cache import caches
 from django.urls import reverse
 from django.http import QueryDict
 
 from . import convert_to_datatype, convert_post_body_to_dict, validate_timestamp
 from .time import truncate_duration
 from .etag import get_etag_info
+from .multipart import parse_multipart
 from ..exceptions import OauthUnauthorized, OauthBadRequest, ParamError, BadRequest
 
 from oauth_provider.utils import get_oauth_request, require_params
 from oauth_provider.decorators import CheckOauth
-from oauth_provider.store import store
-
-att_cache = caches['attachment_cache']
 
 
 def parse(request, more_id=None):
@@ -34,7 +29,11 @@ def parse(request, more_id=None):
     # Traditional authorization should be passed in headers
     r_dict['auth'] = {}
 
-    body_str = request.body.decode("utf-8") if isinstance(request.body, bytes) else request.body
+    # Only a form-encoded body can carry the authorization, so other bodies
+    # aren't read here and multipart ones can still be streamed
+    body_str = ""
+    if 'Authorization' not in r_dict['headers'] and is_form_encoded(r_dict):
+        body_str = get_body_str(request)
 
     if 'Authorization' in r_dict['headers']:
         # OAuth will always be dict, not http auth. Set required fields for
@@ -67,9 +66,18 @@ def parse(request, more_id=None):
     return r_dict
 
 
+def is_form_encoded(r_dict):
+    content_type = r_dict['headers']['CONTENT_TYPE']
+    return bool(content_type) and content_type.startswith("application/x-www-form-urlencoded")
+
+
+def get_body_str(request):
+    return request.body.decode("utf-8") if isinstance(request.body, bytes) else request.body
+
+
 def set_cors_authorization(request, r_dict):
     # Not allowed to set request body so this is just a copy
-    body_str = request.body.decode("utf-8") if isinstance(request.body, bytes) else request.body
+    body_str = get_body_str(request)
     body, encoded = convert_post_body_to_dict(body_str)
     if 'HTTP_AUTHORIZATION' not in r_dict['headers'] and 'HTTP_AUTHORIZATION' not in r_dict['headers']:
         if 'HTTP_AUTHORIZATION' in body:
@@ -106,13 +114,10 @@ def set_normal_authorization(request, r_dict):
             else:
                 raise OauthBadRequest(error)
         
-        # Consumer and token should be clean by now
-        consumer = store.get_consumer(request, oauth_request, oauth_request['oauth_consumer_key'])
-        token = store.get_access_token(request, oauth_request, consumer, oauth_request.get_parameter('oauth_token'))
-
-        # Set consumer and token for authentication piece
-        r_dict['auth']['oauth_consumer'] = consumer
-        r_dict['auth']['oauth_token'] = token
+        # Consumer and token should be clean by now, check_access_token keeps
+        # the ones it verified
+        r_dict['auth']['oauth_consumer'] = request.oauth_consumer
+        r_dict['auth']['oauth_token'] = request.oauth_token
         r_dict['auth']['type'] = 'oauth'
     else:
         r_dict['auth']['type'] = 'http'
@@ -236,74 +241,61 @@ def parse_normal_request(request, r_dict):
 
 
 def parse_attachment(request, r_dict):
+    # The body is read from the request as a stream, each part is spooled to
+    # a temporary file and hashed while it is read
+    parts = parse_multipart(request, r_dict['headers']['CONTENT_TYPE'])
+    if not parts:
+        raise ParamError("This content was not multipart for the multipart request.")
 
-    message = request.body if isinstance(request.body, str) else request.body.decode("utf-8")
+    # Stmt part will always be first
+    stmt_part = parts.pop(0)
+    if stmt_part['Content-Type'] != "application/json":
+        raise ParamError(
+            "Content-Type of statement was not application/json")
     
-    # Python email parse library insists on having the multipart header in the body
-    # workaround to add it to the beginning since it will always be included in the header
-    lines = message.splitlines()
-    if not lines[0].startswith('Content-Type: multipart/mixed; boundary='):
-        if 'boundary' in r_dict['headers']['CONTENT_TYPE']:
-            message = "Content-Type:" + r_dict['headers']['CONTENT_TYPE'] + "\r\n" + message
-        else:
-            raise BadRequest("Could not find the boundary for the multipart content")
+    try:
+        r_dict['body'] = json.loads(stmt_part.read().decode("utf-8"))
+    except Exception:
+        raise ParamError("Statement was not valid JSON")
     
-    # end workaround
-    msg = email.message_from_string(message)
-    if msg.is_multipart():
-
-        # Stmt part will always be first
-        stmt_part = msg.get_payload().pop(0)
-        if stmt_part['Content-Type'] != "application/json":
-            raise ParamError(
-                "Content-Type of statement was not application/json")
-        
-        try:
-            r_dict['body'] = json.loads(stmt_part.get_payload())
-        except Exception:
-            raise ParamError("Statement was not valid JSON")
-        
-        stmt_sha2s = []
-        if isinstance(r_dict['body'], dict):
-            if "attachments" in r_dict['body']:
-                stmt_sha2s = [a['sha2'] for a in r_dict['body']['attachments']]
-        else:
-            stmt_sha2s = [a['sha2'] for s in r_dict['body'] if 'attachments' in s for a in s['attachments']]
+    stmt_sha2s = []
+    if isinstance(r_dict['body'], dict):
+        if "attachments" in r_dict['body']:
+            stmt_sha2s = [a['sha2'] for a in r_dict['body']['attachments']]
+    else:
+        stmt_sha2s = [a['sha2'] for s in r_dict['body'] if 'attachments' in s for a in s['attachments']]
+    
+    # Each attachment in msg must have binary encoding and hash in header
+    part_dict = {}
+    
+    for part in parts:
+        encoding = part.get('Content-Transfer-Encoding', None)
         
-        # Each attachment in msg must have binary encoding and hash in header
-        part_dict = {}
+        if encoding != "binary":
+            raise BadRequest("Each attachment part should have 'binary' as Content-Transfer-Encoding")
         
-        for part in msg.get_payload():
-            encoding = part.get('Content-Transfer-Encoding', None)
-            
-            if encoding != "binary":
-                raise BadRequest("Each attachment part should have 'binary' as Content-Transfer-Encoding")
-            
-            if 'X-Experience-API-Hash' not in part:
-                raise BadRequest("X-Experience-API-Hash header was missing from attachment")
-            
-            part_hash = part.get('X-Experience-API-Hash')
-            validate_hash(part_hash, part)
-            
-            part_dict[part_hash] = part
+        if 'X-Experience-API-Hash' not in part:
+            raise BadRequest("X-Experience-API-Hash header was missing from attachment")
         
-        r_dict['payload_sha2s'] = [p['X-Experience-API-Hash'] for p in msg.get_payload()]
-
-        if not set(r_dict['payload_sha2s']).issubset(set(stmt_sha2s)):
-            raise BadRequest("Not all attachments match with statement payload")
+        part_hash = part.get('X-Experience-API-Hash')
+        validate_hash(part_hash, part)
         
-        parse_signature_attachments(r_dict, part_dict)
+        part_dict[part_hash] = part
     
-    else:
-        raise ParamError("This content was not multipart for the multipart request.")
+    r_dict['payload_sha2s'] = [p['X-Experience-API-Hash'] for p in parts]
+
+    if not set(r_dict['payload_sha2s']).issubset(set(stmt_sha2s)):
+        raise BadRequest("Not all attachments match with statement payload")
     
-    # Saves all attachments (including signatures) to memory temporarily
-    # for further processing
-    temp_save_attachments(msg)
+    parse_signature_attachments(r_dict, part_dict)
+
+    # The spooled payloads (including signatures) are handed to the statement
+    # managers to store
+    r_dict['payloads'] = {part_hash: part.file for part_hash, part in part_dict.items()}
 
 
 def validate_hash(part_hash, part):
-    if part_hash != str(hashlib.sha256(get_part_payload(part).encode("utf-8")).hexdigest()):
+    if part_hash != part.hexdigest():
         raise BadRequest(
             "Hash header %s did not match calculated hash" \
             % part_hash)
@@ -382,7 +374,7 @@ def handle_signatures(stmt_tuples, sha2s_on_request, part_dict):
 def validate_signature(statement, signatures, part):
 
     sha2_key = signatures[0]
-    signature = get_part_payload(part)
+    signature = part.read().decode("utf-8")
     algorithm = jws.get_unverified_headers(signature).get('alg', None)
     
     if not algorithm:
@@ -485,25 +477,6 @@ def compare_payloads(jws_payload, body_payload, sha2_key):
     return json.dumps(jws_placeholder, sort_keys=True) == json.dumps(body_placeholder, sort_keys=True)
 
 
-def temp_save_attachments(msg):
-    for part in msg.get_payload():
-        xhash = part.get('X-Experience-API-Hash')
-        att_cache.set(xhash, get_part_payload(part))
-
-
-def get_part_payload(part):
-    c_type = part['Content-Type']
-    # Email class adds newline for text/plain
-    # workaround
-    if "text/plain" in c_type:
-        payload = part.get_payload()
-        if payload.endswith('\n'):
-            payload = payload[:-1]
-    else:
-        payload = part.get_payload()
-    return payload
-
-
 def cert_to_key(cert):
     return RSA.importKey(base64.b64decode(cert))
 
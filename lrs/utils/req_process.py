@@ -8,22 +8,29 @@ import math
 from isodate.isodatetime import parse_datetime
 from datetime import datetime, timezone
 
-from django.http import HttpResponse, HttpResponseNotFound, JsonResponse
+from django.http import HttpResponse, HttpResponseNotFound, JsonResponse, StreamingHttpResponse
 from django.conf import settings
+from django.db.models import F
 from django.utils.timezone import utc
 
+from .lookup_cache import sync_lookup_caches, clear_lookup_caches
 from .time import truncate_duration, last_modified_from_statements
 from .retrieve_statement import complex_get, parse_more_request
 from ..exceptions import NotFound
-from ..models import Statement, Agent, Activity
+from ..models import Statement, StatementAttachment, Agent, Activity
 from ..managers.ActivityProfileManager import ActivityProfileManager
 from ..managers.ActivityStateManager import ActivityStateManager
 from ..managers.AgentProfileManager import AgentProfileManager
 from ..managers.StatementManager import StatementManager
+from ..managers.StatementBatchManager import StatementBatchManager
 from ..tasks import check_activity_metadata, check_statement_hooks
+from .task_dispatch import task_dispatcher
 
+# Bytes of an attachment payload read from storage at a time
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
 
-def process_statement(stmt, auth, payload_sha2s):
+
+def prepare_statement(stmt):
     # Add id to statement if not present
     if 'id' not in stmt:
         stmt['id'] = str(uuid.uuid4())
@@ -70,18 +77,41 @@ def process_statement(stmt, auth, payload_sha2s):
     if 'timestamp' not in stmt:
         stmt['timestamp'] = stmt['stored']
 
-    # Copy full statement and send off to StatementManager to save
+    # Copy full statement to save with the statement
     stmt['full_statement'] = copy.deepcopy(stmt)
-    st = StatementManager(stmt, auth, payload_sha2s).model_object
+    return stmt
+
 
+def get_statement_response(stmt, st):
     if stmt['verb'].verb_id == 'http://adlnet.gov/expapi/verbs/voided':
         return st.statement_id, st.object_statementref
     
     return st.statement_id, None
 
 
-def process_body(stmts, auth, payload_sha2s):
-    return [process_statement(st, auth, payload_sha2s) for st in stmts]
+def process_statement(stmt, auth, payloads):
+    # Send off to StatementManager to save
+    prepare_statement(stmt)
+    st = StatementManager(stmt, auth, payloads).model_object
+    return get_statement_response(stmt, st)
+
+
+def process_body(stmts, auth, payloads):
+    # Pick up verb, activity and agent changes made by other processes
+    sync_lookup_caches()
+    try:
+        # Without an authority in the request each statement's authority is used
+        # for the ones after it, so those still have to be saved one at a time
+        if not auth['agent']:
+            return [process_statement(st, auth, payloads) for st in stmts]
+
+        stmts = [prepare_statement(st) for st in stmts]
+        model_objects = StatementBatchManager(stmts, auth, payloads).model_objects
+        return [get_statement_response(stmt, st) for stmt, st in zip(stmts, model_objects)]
+    except Exception:
+        # The rows cached while storing these may get rolled back
+        clear_lookup_caches()
+        raise
 
 
 def process_complex_get(req_dict):
@@ -139,6 +169,15 @@ def process_complex_get(req_dict):
     # Create returned stmt list from the req dict
     stmt_result = complex_get(param_dict, limit, language, format, attachments)
 
+    # Large pages are sent with chunked transfer, so there is no length
+    if 'stream' in stmt_result:
+        return stream_response(stmt_result['stream'], req_dict), None, stmt_result
+
+    # Exact statements come back as the finished body
+    if 'raw' in stmt_result:
+        resp = HttpResponse(stmt_result['raw'], content_type=mime_type, status=200)
+        return resp, len(stmt_result['raw']), stmt_result
+
     # Get the length of the response - make sure in string format to count
     # every character
     if isinstance(stmt_result, dict):
@@ -149,8 +188,8 @@ def process_complex_get(req_dict):
     # If attachments=True in req_dict then include the attachment payload and
     # return different mime type
     if attachments:
-        stmt_result_str, mime_type, content_length = build_response(stmt_result)
-        resp = HttpResponse(stmt_result_str, content_type=mime_type, status=200)
+        parts, mime_type, content_length = build_response(stmt_result)
+        resp = stream_response(parts, req_dict, mime_type)
     
     # Else attachments are false for the complex get so just dump the
     # stmt_result
@@ -174,17 +213,18 @@ def statements_post(req_dict):
     else:
         body = req_dict['body']
 
-    stmt_responses = process_body(body, auth, req_dict.get('payload_sha2s', None))
+    stmt_responses = process_body(body, auth, req_dict.get('payloads', None))
     stmt_ids = [stmt_tup[0] for stmt_tup in stmt_responses]
     stmts_to_void = [str(stmt_tup[1]) for stmt_tup in stmt_responses if stmt_tup[1]]
     
-    check_activity_metadata.delay(stmt_ids)
+    # Sent to the broker in batches once the request commits
+    task_dispatcher.dispatch(check_activity_metadata, stmt_ids)
     
     if stmts_to_void:
         Statement.objects.filter(statement_id__in=stmts_to_void).update(voided=True)
     
     if settings.USE_HOOKS:
-        check_statement_hooks.delay(stmt_ids)
+        task_dispatcher.dispatch(check_statement_hooks, stmt_ids)
     
     return JsonResponse([st for st in stmt_ids], safe=False)
 
@@ -192,21 +232,32 @@ def statements_post(req_dict):
 def statements_put(req_dict):
     auth = req_dict['auth']
     # Since it is single stmt put in list
-    stmt_responses = process_body([req_dict['body']], auth, req_dict.get('payload_sha2s', None))
+    stmt_responses = process_body([req_dict['body']], auth, req_dict.get('payloads', None))
     stmt_ids = [stmt_tup[0] for stmt_tup in stmt_responses]
     stmts_to_void = [str(stmt_tup[1])
                      for stmt_tup in stmt_responses if stmt_tup[1]]
-    check_activity_metadata.delay(stmt_ids)
+    task_dispatcher.dispatch(check_activity_metadata, stmt_ids)
     if stmts_to_void:
         Statement.objects.filter(statement_id__in=stmts_to_void).update(voided=True)
     if settings.USE_HOOKS:
-        check_statement_hooks.delay(stmt_ids)
+        task_dispatcher.dispatch(check_statement_hooks, stmt_ids)
     return HttpResponse("", status=204)
 
 
 def statements_more_get(req_dict):
     stmt_result, attachments = parse_more_request(req_dict['more_id'])
 
+    if 'stream' in stmt_result:
+        resp = stream_response(stmt_result['stream'], req_dict)
+        resp['Last-Modified'] = last_modified_from_result(stmt_result).strftime("%a, %d-%b-%Y %H:%M:%S %Z")
+        return resp
+
+    if 'raw' in stmt_result:
+        resp = HttpResponse(stmt_result['raw'], content_type="application/json", status=200)
+        resp['Content-Length'] = str(len(stmt_result['raw']))
+        resp['Last-Modified'] = last_modified_from_result(stmt_result).strftime("%a, %d-%b-%Y %H:%M:%S %Z")
+        return resp
+
     if isinstance(stmt_result, dict):
         content_length = len(json.dumps(stmt_result))
     else:
@@ -215,8 +266,8 @@ def statements_more_get(req_dict):
 
     # If there are attachments, include them in the payload
     if attachments:
-        stmt_result_str, mime_type, content_length = build_response(stmt_result)
-        resp = HttpResponse(stmt_result_str, content_type=mime_type, status=200)
+        parts, mime_type, content_length = build_response(stmt_result)
+        resp = stream_response(parts, req_dict, mime_type)
     
     # If not, just dump the stmt_result
     else:
@@ -244,8 +295,8 @@ def statements_get(req_dict):
         stmt_dict = st.to_dict(ret_format=req_dict['params']['format'])
         
         if req_dict['params']['attachments']:
-            response_body, mime_type, content_length = build_response(stmt_dict, True)
-            resp = HttpResponse(response_body, content_type=mime_type, status=200)
+            parts, mime_type, content_length = build_response(stmt_dict, True)
+            resp = stream_response(parts, req_dict, mime_type)
         else:
             response_body = json.dumps(stmt_dict, sort_keys=False)
             resp = HttpResponse(response_body, content_type=mime_type, status=200)
@@ -259,80 +310,89 @@ def statements_get(req_dict):
     else:
         resp, content_length, stmt_result = process_complex_get(req_dict)
         
-        latest_stored = last_modified_from_statements(stmt_result["statements"])
+        latest_stored = last_modified_from_result(stmt_result)
 
-        resp['Content-Length'] = str(content_length)               
+        if content_length is not None:
+            resp['Content-Length'] = str(content_length)
         resp['Last-Modified'] = latest_stored.strftime("%a, %d-%b-%Y %H:%M:%S %Z")
 
     return resp
 
+
+def stream_response(content, req_dict, content_type="application/json"):
+    # HEAD gets the headers without reading the statements or payloads at all
+    return StreamingHttpResponse(content if req_dict['method'] != 'HEAD' else [], content_type=content_type,
+                                 status=200)
+
+
+def last_modified_from_result(stmt_result):
+    # Raw and streamed results carry the stored times of their statements
+    # next to the body
+    if 'stored' in stmt_result:
+        return max(stmt_result['stored'], default=datetime.min.replace(tzinfo=timezone.utc))
+    return last_modified_from_statements(stmt_result["statements"])
+
+
 def build_response(stmt_result, single=False):
-    sha2s = []
-    mime_type = "application/json"
+    # Returns the multipart/mixed body as an iterator of bytes with its length,
+    # so attachment payloads are streamed from storage instead of being held
+    # in memory
     if single:
         statements = [stmt_result]
     else:
         statements = stmt_result['statements']
-    # Iterate through each attachment in each statement
-    for stmt in statements:
-        if 'attachments' in stmt:
-            statement_db_obj = Statement.objects.get(statement_id=stmt['id'])
-            attachments = getattr(statement_db_obj, "stmt_attachments", None)
-            if attachments:
-                for attachment in attachments.all():
-                    if attachment.payload:
-
-                        sha2s.append({
-                            "sha2": attachment.canonical_data['sha2'], 
-                            "payload": attachment.payload,
-                            "contentType": attachment.canonical_data['contentType']
-                        })
-
-                        # sha2s.append(
-                            # (att.canonical_data['sha2'], att.payload, att.canonical_data['contentType']))
-    
-    # Create multipart message and attach json message to it
-    string_list = []
+    # Attachments of every statement in one query, sent in statement order.
+    # Exact statements keep the ID as it was sent, so both sides are compared
+    # in the same UUID format
+    stmt_ids = [str(uuid.UUID(str(stmt['id']))) for stmt in statements if 'attachments' in stmt]
+    stmt_attachments = {}
+    for attachment in StatementAttachment.objects.filter(statement__statement_id__in=stmt_ids) \
+            .annotate(stmt_id=F('statement__statement_id')).order_by('pk'):
+        stmt_attachments.setdefault(str(attachment.stmt_id), []).append(attachment)
+    attachments = [attachment for stmt_id in stmt_ids for attachment in stmt_attachments.get(stmt_id, [])
+                   if attachment.payload]
+
     line_feed = "\r\n"
     boundary = "======ADL_LRS======"
-
-    string_list.append(f"{line_feed}--{boundary + line_feed}")
-    string_list.append(f"Content-Type:application/json{line_feed + line_feed}")
-    
     if isinstance(stmt_result, dict):
         result_str = json.dumps(stmt_result, sort_keys=False)
-        string_list.append(result_str + line_feed)
     else:
-        string_list.append(stmt_result + line_feed)
-
-    for sha2 in sha2s:
-        string_list.append(f"--" + boundary + line_feed)
-        string_list.append(f"Content-Type:{str(sha2['contentType']) + line_feed}")
-        string_list.append(f"Content-Transfer-Encoding:binary{line_feed}")
-        string_list.append(f"X-Experience-API-Hash:{str(sha2['sha2']) + line_feed + line_feed}")
-
-        chunks = []
+        result_str = stmt_result
+    statement_part = (f"{line_feed}--{boundary + line_feed}"
+                      f"Content-Type:application/json{line_feed + line_feed}"
+                      f"{result_str + line_feed}").encode("utf-8")
+
+    # Part headers and sizes are worked out up front so a missing payload
+    # fails the request before anything is sent
+    payload_parts = []
+    for attachment in attachments:
+        header = (f"--{boundary + line_feed}"
+                  f"Content-Type:{str(attachment.canonical_data['contentType']) + line_feed}"
+                  f"Content-Transfer-Encoding:binary{line_feed}"
+                  f"X-Experience-API-Hash:{str(attachment.canonical_data['sha2']) + line_feed + line_feed}")
         try:
-            # Default chunk size is 64kb
-            for chunk in sha2["payload"].chunks():
-                if isinstance(chunk, bytes):
-                    chunk = chunk.decode("utf-8")
-                
-                chunks.append(chunk)
-        
+            size = attachment.payload.size
         except OSError:
-            raise NotFound(2, f"No such file or directory {chunks} {sha2}", sha2["payload"].name)
-        
-        try:
-            string_list.append("".join(chunks) + line_feed)
-        except TypeError as te:
-            raise TypeError(f"{type(string_list)} vs. {type(chunks)} \n\n{te}")
+            raise NotFound(f"No such file or directory {attachment.payload.name}")
+        payload_parts.append((header.encode("utf-8"), attachment.payload, size))
+    closing = f"--{boundary}--{line_feed}".encode("utf-8")
 
-    string_list.append("--" + boundary + "--\r\n")
+    content_length = len(statement_part) + len(closing) + sum(
+        len(header) + size + len(line_feed) for header, payload, size in payload_parts)
     mime_type = 'multipart/mixed; boundary=' + '"%s"' % boundary
-    attachment_body = "".join([str(s) for s in string_list])
-    
-    return attachment_body, mime_type, len(attachment_body)
+    return stream_multipart(statement_part, payload_parts, closing), mime_type, content_length
+
+
+def stream_multipart(statement_part, payload_parts, closing):
+    yield statement_part
+    for header, payload, size in payload_parts:
+        yield header
+        # Payloads are sent as stored, a fixed size chunk at a time
+        with payload.open('rb') as f:
+            for chunk in f.chunks(ATTACHMENT_CHUNK_SIZE):
+                yield chunk
+        yield b"\r\n"
+    yield closing
 
 
 def activity_state_post(req_dict):
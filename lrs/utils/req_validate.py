@@ -41,11 +41,27 @@ def validate_oauth_for_documents(req_dict, endpoint):
                 raise Forbidden(err_msg)
 
 
-def validate_void_statement(void_id):
+def get_existing_statementIds(stmt_ids):
+    # One IN (...) probe for every statement ID in the batch
+    return set(Statement.objects.filter(statement_id__in=stmt_ids).values_list('statement_id', flat=True))
+
+
+def get_void_targets(void_ids):
+    # One IN (...) probe for every statement being voided in the batch
+    targets = {}
+    for stmt in Statement.objects.filter(statement_id__in=void_ids).select_related('verb'):
+        targets.setdefault(stmt.statement_id, []).append(stmt)
+    return targets
+
+
+def validate_void_statement(void_id, targets=None):
     # Retrieve statement, check if the verb is 'voided' - if not then set the voided flag to true else return error
     # since you cannot unvoid a statement and should just reissue the
     # statement under a new ID.
-    stmts = Statement.objects.filter(statement_id=void_id)
+    if targets is None:
+        stmts = Statement.objects.filter(statement_id=void_id)
+    else:
+        stmts = targets.get(uuid.UUID(void_id), [])
     if len(stmts) > 1:
         raise IDNotFoundError(
             "Something went wrong. %s statements found with id %s" % (len(stmts), void_id))
@@ -63,17 +79,26 @@ def validate_void_statement(void_id):
 def validate_body(body, auth, content_type):
     statement_being_checked = None
     try:
+        stmt_ids = [statement['id'] for statement in body if 'id' in statement]
+        void_ids = [statement['object']['id'] for statement in body
+                    if statement['verb']['id'] == 'http://adlnet.gov/expapi/verbs/voided']
+        existing_ids = get_existing_statementIds(stmt_ids) if stmt_ids else set()
+        void_targets = get_void_targets(void_ids) if void_ids else {}
         for statement in body:
             statement_being_checked = statement
-            server_validate_statement(statement, auth, content_type)
+            server_validate_statement(statement, auth, content_type, existing_ids, void_targets)
     except ValueError:
         raise ValueError(f"'id' not iterable within statement: {statement_being_checked}, {type(statement_being_checked)}), {auth}, {content_type}")
         
-def server_validate_statement(stmt, auth, content_type):
+def server_validate_statement(stmt, auth, content_type, existing_ids=None, void_targets=None):
     try:
         if 'id' in stmt:
             statement_id = stmt['id']
-            if check_for_existing_statementId(statement_id):
+            if existing_ids is None:
+                exists = check_for_existing_statementId(statement_id)
+            else:
+                exists = uuid.UUID(statement_id) in existing_ids
+            if exists:
                 err_msg = "A statement with ID %s already exists" % statement_id
                 raise ParamConflict(err_msg)
     
@@ -81,7 +106,7 @@ def server_validate_statement(stmt, auth, content_type):
         raise ValueError(f"'id' not iterable within statement: {stmt}, {type(stmt)}), {auth}, {content_type}")
 
     if stmt['verb']['id'] == 'http://adlnet.gov/expapi/verbs/voided':
-        validate_void_statement(stmt['object']['id'])
+        validate_void_statement(stmt['object']['id'], void_targets)
 
     if 'attachments' in stmt:
         attachment_data = stmt['attachments']
@@ -1,32 +1,57 @@
-import bcoding
-import hashlib
 import json
-import uuid
 from datetime import datetime
-from itertools import chain
 
-from django.core.cache import cache
 from django.conf import settings
-from django.core.paginator import Paginator
+from django.core import signing
 from django.urls import reverse
-from django.db.models import Q
+from django.db import connection
+from django.db.models import Max, Prefetch, Q, TextField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from django.utils import timezone
 
 from . import convert_to_datetime_object
-from ..models import Statement, Agent
+from ..models import Activity, Statement, StatementActivity, StatementAgent, Agent
+from .render_cache import get_rendered_statements
 from ..exceptions import NotFound
 
 
-def complex_get(param_dict, limit, language, stmt_format, attachments) -> dict:
+# Salt for the signed cursors used as more ids
+MORE_CURSOR_SALT = 'lrs.statements.more'
+# Query params a cursor carries so the filter can be run again for the next page
+CURSOR_PARAMS = ['agent', 'related_agents', 'verb', 'activity', 'related_activities', 'registration',
+                 'since', 'until', 'ascending']
+# Relations rendered by the canonical and ids formats, with the substatement's
+# own, so rendering a page takes the same number of queries however long it is
+AGENT_RELATED = ['actor', 'object_agent', 'context_team', 'context_instructor']
+RENDER_RELATED = AGENT_RELATED + ['verb', 'authority', 'object_activity', 'object_substatement'] + \
+    ['object_substatement__' + f for f in AGENT_RELATED + ['verb', 'object_activity']]
+CONTEXT_ACTIVITY_PREFETCH = ['context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other']
+RENDER_PREFETCH = CONTEXT_ACTIVITY_PREFETCH + ['object_substatement__' + f for f in CONTEXT_ACTIVITY_PREFETCH]
+# Members of every agent that can be a rendered group
+MEMBER_PREFETCH = [f + '__member' for f in AGENT_RELATED + ['authority']] + \
+    ['object_substatement__' + f + '__member' for f in AGENT_RELATED]
+# Columns the ids format leaves out of the related rows, only the
+# identifiers are rendered
+IDS_DEFERRED = ['verb__canonical_data', 'object_activity__canonical_data',
+                'object_substatement__verb__canonical_data', 'object_substatement__object_activity__canonical_data']
+
+
+def complex_get(param_dict, limit, language, stmt_format, attachments, cursor=None) -> dict:
     # keep track if a filter other than time or sequence is used
     reffilter = False
 
+    since = None
     sinceQ = Q()
     if 'since' in param_dict:
-        sinceQ = Q(stored__gt=convert_to_datetime_object(param_dict['since']))
+        since = convert_to_datetime_object(param_dict['since'])
+        sinceQ = Q(stored__gt=since)
 
+    until = None
     untilQ = Q()
     if 'until' in param_dict:
-        untilQ = Q(stored__lte=convert_to_datetime_object(param_dict['until']))
+        until = convert_to_datetime_object(param_dict['until'])
+        untilQ = Q(stored__lte=until)
 
     # If want ordered by ascending
     stored_param = '-stored'
@@ -35,8 +60,10 @@ def complex_get(param_dict, limit, language, stmt_format, attachments) -> dict:
 
     # For statements/read/mine oauth scope
     authQ = Q()
+    mine_only = None
     if 'auth' in param_dict and (param_dict['auth'] and 'statements_mine_only' in param_dict['auth']):
         q_auth = param_dict['auth']['agent']
+        mine_only = q_auth.pk
 
         # If oauth - set authority to look for as the user
         if q_auth.oauth_identifier:
@@ -58,29 +85,15 @@ def complex_get(param_dict, limit, language, stmt_format, attachments) -> dict:
             'related_agents']
         agent = Agent.objects.retrieve(**data)
         if agent:
-            agentQ = Q(actor=agent) | Q(object_agent=agent)
-            if related:
-                agentQ = agentQ | Q(authority=agent) \
-                    | Q(context_instructor=agent) | Q(context_team=agent) \
-                    | Q(object_substatement__actor=agent) \
-                    | Q(object_substatement__object_agent=agent) \
-                    | Q(object_substatement__context_instructor=agent) \
-                    | Q(object_substatement__context_team=agent)
-            # If it is an agent and not a group, retrieve all groups it is part of
+            # If it is an agent and not a group, match all groups it is part of
+            agent_ids = Agent.objects.filter(pk=agent.pk)
             if agent.objectType == "Agent":
-                groups = agent.member.all()
-                if groups.exists():
-                    for g in groups.iterator():
-                        agentQ = agentQ | Q(actor=g) | Q(object_agent=g)
-                        if related:
-                            agentQ = agentQ | Q(authority=g) \
-                                | Q(context_instructor=g) | Q(context_team=g) \
-                                | Q(object_substatement__actor=g) \
-                                | Q(object_substatement__object_agent=g) \
-                                | Q(object_substatement__context_instructor=g) \
-                                | Q(object_substatement__context_team=g)
+                agent_ids = Agent.objects.filter(Q(pk=agent.pk) | Q(member=agent))
+            roles = StatementAgent.RELATED_ROLES if related else StatementAgent.DIRECT_ROLES
+            agentQ = Q(pk__in=StatementAgent.objects.filter(agent__in=agent_ids.values('pk'), role__in=roles)
+                       .values('statement_id'))
         else:
-            return create_under_limit_stmt_result([], stored_param, language, stmt_format)
+            return {'statements': [], 'more': ""}
 
     verbQ = Q()
     if 'verb' in param_dict:
@@ -91,17 +104,11 @@ def complex_get(param_dict, limit, language, stmt_format, attachments) -> dict:
     activityQ = Q()
     if 'activity' in param_dict:
         reffilter = True
-        activityQ = Q(object_activity__activity_id=param_dict['activity'])
+        relations = ['object']
         if 'related_activities' in param_dict and param_dict['related_activities']:
-            activityQ = activityQ | Q(context_ca_parent__activity_id=param_dict['activity']) \
-                | Q(context_ca_grouping__activity_id=param_dict['activity']) \
-                | Q(context_ca_category__activity_id=param_dict['activity']) \
-                | Q(context_ca_other__activity_id=param_dict['activity']) \
-                | Q(object_substatement__object_activity__activity_id=param_dict['activity']) \
-                | Q(object_substatement__context_ca_parent__activity_id=param_dict['activity']) \
-                | Q(object_substatement__context_ca_grouping__activity_id=param_dict['activity']) \
-                | Q(object_substatement__context_ca_category__activity_id=param_dict['activity']) \
-                | Q(object_substatement__context_ca_other__activity_id=param_dict['activity'])
+            relations = StatementActivity.RELATED_RELATIONS
+        activityQ = Q(pk__in=StatementActivity.objects.filter(
+            activity__activity_id=param_dict['activity'], relation__in=relations).values('statement_id'))
 
     registrationQ = Q()
     if 'registration' in param_dict:
@@ -109,39 +116,128 @@ def complex_get(param_dict, limit, language, stmt_format, attachments) -> dict:
         registrationQ = Q(context_registration=param_dict['registration'])
 
     voidQ = Q(voided=False)
-    stmtset = Statement.objects.select_related('actor', 'verb', 'context_team', 'context_instructor', 'authority',
-                                               'object_agent', 'object_activity', 'object_substatement') \
-        .prefetch_related('context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other') \
-        .filter(untilQ & sinceQ & authQ & agentQ & verbQ & activityQ & registrationQ).distinct()
-    
-    # Workaround since flat doesn't work with UUIDFields
-    st_ids = stmtset.values_list('statement_id')
-    stmtset = [st_id[0] for st_id in st_ids]
+    stmtset = Statement.objects.filter(untilQ & sinceQ & authQ & agentQ & verbQ & activityQ & registrationQ)
 
-    if reffilter:
-        stmtset = stmtset + stmt_ref_search(stmtset, untilQ, sinceQ)
-        actual_length = Statement.objects.filter(Q(statement_id__in=stmtset) & voidQ).distinct().count()        
-    else:
-        actual_length = len(stmtset)
+    # Statements that target the matching statements are included as well
+    if reffilter and Statement.objects.filter(
+            Q(object_statementref__in=stmtset.values('statement_id')) & untilQ & sinceQ).exists():
+        stmtset = Statement.objects.filter(statement_id__in=stmt_ref_search(stmtset, since, until))
 
     # Calculate limit of stmts to return
     return_limit = set_limit(limit)
-
-    # If there are more stmts than the limit, need to break it up and return
-    # more id
-    if actual_length > return_limit:
-        return create_over_limit_stmt_result(stmtset, stored_param, return_limit, language, stmt_format, attachments)
+    if cursor is None:
+        # Later pages leave out statements stored after the first one was
+        # returned
+        cursor = {'params': {p: param_dict[p] for p in CURSOR_PARAMS if p in param_dict},
+                  'mine_only': mine_only,
+                  'limit': return_limit, 'attachments': attachments, 'language': language,
+                  'format': stmt_format, 'snapshot': timezone.now().isoformat(), 'position': None}
+    pageQ = Q(stored__lte=datetime.fromisoformat(cursor['snapshot']))
+    if cursor['position']:
+        pageQ = pageQ & get_position_filter(cursor['position'], stored_param)
+
+    order = (stored_param, stored_param.replace('stored', 'id'))
+    page = stmtset.filter(voidQ & pageQ).order_by(*order)
+    if return_limit > settings.STATEMENT_STREAM_LIMIT and not attachments:
+        return create_streamed_stmt_result(page, return_limit, cursor, language, stmt_format)
+
+    # Exact statements are sent as stored, so the JSON text is read as is and
+    # never decoded
+    if stmt_format == 'exact' and not attachments:
+        rows = list(get_raw_rows(page)[:return_limit + 1])
+        return create_raw_stmt_result(rows, return_limit, cursor)
+
+    # One query for the page, one extra statement tells if there is another
+    if stmt_format == 'exact':
+        stmt_list = list(project_stmt_format(page, stmt_format)[:return_limit + 1])
+        rows = [(stmt.id, stmt.stored) for stmt in stmt_list]
+        statements = [stmt.to_dict(language, stmt_format) for stmt in stmt_list[:return_limit]]
     else:
-        return create_under_limit_stmt_result(stmtset, stored_param, language, stmt_format)
+        # Only the ids of the page are read, the renders come from the cache
+        rows = list(page.values_list('id', 'stored', 'statement_id')[:return_limit + 1])
+        statements = render_rows(rows[:return_limit], language, stmt_format)
+    return create_stmt_result(statements, rows, return_limit, cursor)
+
+
+def get_raw_rows(page):
+    return page.annotate(full_statement_text=Cast('full_statement', TextField())) \
+        .values_list('id', 'stored', 'full_statement_text')
+
 
+def render_rows(rows, language, stmt_format):
+    # rows are (id, stored, statement_id) of the statements to render
+    return get_rendered_statements(
+        [row[2] for row in rows], language, stmt_format,
+        lambda ids: project_stmt_format(Statement.objects.filter(statement_id__in=ids), stmt_format))
 
-def stmt_ref_search(stmt_list, untilQ, sinceQ, acc=[]):
-    while stmt_list:
-        ref_list = [sid for sid in Statement.objects.filter(
-            Q(object_statementref__in=stmt_list) & untilQ & sinceQ)
-            .distinct().values_list('statement_id', flat=True)]
-        (acc, stmt_list) = (acc + stmt_list, ref_list)
-    return acc
+
+def project_stmt_format(stmtset, stmt_format):
+    # Only read the columns and relations the format renders
+    if stmt_format == 'exact':
+        return stmtset.only('stored', 'full_statement')
+
+    activities = Activity.objects.all()
+    deferred = ['full_statement', 'user']
+    if stmt_format == 'ids':
+        activities = activities.only('activity_id', 'canonical_version')
+        deferred += IDS_DEFERRED
+    return stmtset.select_related(*RENDER_RELATED).defer(*deferred).prefetch_related(
+        *[Prefetch(field, queryset=activities) for field in RENDER_PREFETCH], *MEMBER_PREFETCH, 'stmt_attachments')
+
+
+def stmt_ref_search(stmtset, since, until):
+    # Ids of the statements in stmtset and every statement that targets one of
+    # them through a chain of StatementRefs. The statements in stmtset are
+    # always kept, only the referring ones count against the limit, nearest
+    # first
+    if connection.vendor == 'postgresql':
+        return stmt_ref_search_cte(stmtset, since, until)
+
+    sinceQ = Q(stored__gt=since) if since else Q()
+    untilQ = Q(stored__lte=until) if until else Q()
+    # Workaround since flat doesn't work with UUIDFields
+    stmt_list = [st_id[0] for st_id in stmtset.values_list('statement_id')]
+    found = set(stmt_list)
+    remaining = settings.STMT_REF_MAX_STATEMENTS
+    depth = 0
+    while stmt_list and depth < settings.STMT_REF_MAX_DEPTH and remaining > 0:
+        refs = Statement.objects.filter(Q(object_statementref__in=stmt_list) & untilQ & sinceQ).order_by(
+            'statement_id').values_list('statement_id', flat=True)
+        stmt_list = [sid for sid in dict.fromkeys(refs) if sid not in found][:remaining]
+        found.update(stmt_list)
+        remaining -= len(stmt_list)
+        depth += 1
+    return list(found)
+
+
+def stmt_ref_search_cte(stmtset, since, until):
+    # Same search as one recursive query, used as a subquery so it costs no
+    # extra round trips however long the chains are
+    stmt_sql, params = stmtset.values('statement_id').query.sql_with_params()
+    params = list(params) + [settings.STMT_REF_MAX_DEPTH]
+    time_sql = ""
+    if since:
+        time_sql += " AND ref.stored > %s"
+        params.append(since)
+    if until:
+        time_sql += " AND ref.stored <= %s"
+        params.append(until)
+    params.append(settings.STMT_REF_MAX_STATEMENTS)
+
+    sql = ("WITH RECURSIVE refs (statement_id, depth) AS ("
+           "SELECT matching.statement_id, 0 FROM (%s) AS matching "
+           "UNION "
+           "SELECT ref.statement_id, refs.depth + 1 FROM %s AS ref "
+           "INNER JOIN refs ON ref.object_statementref = refs.statement_id "
+           "WHERE refs.depth < %%s%s) "
+           "SELECT statement_id FROM refs WHERE depth = 0 "
+           "UNION "
+           "SELECT statement_id FROM ("
+           "SELECT statement_id FROM refs WHERE depth > 0 "
+           "AND statement_id NOT IN (SELECT statement_id FROM refs WHERE depth = 0) "
+           "GROUP BY statement_id ORDER BY MIN(depth), statement_id LIMIT %%s) AS referring") % (
+        stmt_sql, connection.ops.quote_name(Statement._meta.db_table), time_sql)
+    return RawSQL(sql, params)
 
 
 def set_limit(req_limit):
@@ -150,145 +246,92 @@ def set_limit(req_limit):
     return req_limit
 
 
-def create_under_limit_stmt_result(stmt_set, stored, language, stmt_format) -> dict:
-    stmt_result = {}
-    if stmt_set:
-        stmt_set = Statement.objects.select_related('actor', 'verb', 'context_team', 'context_instructor', 'authority',
-                                                    'object_agent', 'object_activity', 'object_substatement') \
-            .prefetch_related('context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other') \
-            .filter(Q(statement_id__in=stmt_set) & Q(voided=False)).distinct()
+def get_position_filter(position, stored_param):
+    # Statements after the last one on the previous page, in (stored, id) order
+    stored, pk = datetime.fromisoformat(position[0]), position[1]
+    if stored_param == 'stored':
+        return Q(stored__gt=stored) | Q(stored=stored, id__gt=pk)
+    return Q(stored__lt=stored) | Q(stored=stored, id__lt=pk)
 
-        stmt_result['statements'] = [stmt.to_dict(language, stmt_format) for stmt in
-                                     stmt_set.order_by(stored)]
-        stmt_result['more'] = ""
-    else:
-        stmt_result['statements'] = []
-        stmt_result['more'] = ""
-    return stmt_result
-
-def create_cache_key():
-    # Create unique hash data to use for the cache key
-    hash_data = [
-        str(datetime.now()),
-        str(uuid.uuid4())
-    ]
-
-    # Create cache key from hashed data (always 32 digits)
-    bcode = bcoding.bencode(hash_data)
-    assert bcode is not None
-
-    key = hashlib.md5(bcode).hexdigest()
-    return key
-
-def create_over_limit_stmt_result(stmt_list, stored, limit, language, stmt_format, attachments) -> dict:
-    # First time someone queries POST/GET
-    result = {}
-    cache_list = []
-
-    stmt_list = Statement.objects.filter(
-        Q(statement_id__in=stmt_list) & Q(voided=False)).distinct()
-    cache_list.append([s for s in stmt_list.order_by(
-        stored).values_list('id', flat=True)])
-    stmt_pager = Paginator(cache_list[0], limit)
-
-    # Always start on first page
-    current_page = 1
-    total_pages = stmt_pager.num_pages
-    # Create cache key from hashed data (always 32 digits)
-    cache_key = create_cache_key()
-
-    # Add data to cache
-    cache_list.append(current_page)
-    cache_list.append(total_pages)
-    cache_list.append(limit)
-    cache_list.append(attachments)
-    cache_list.append(language)
-    cache_list.append(stmt_format)
-    cache_list.append(stored)
-
-    # Encode data
-    encoded_info = json.dumps(cache_list)
-    # Save encoded_dict in cache
-    cache.set(cache_key, encoded_info)
-
-    result['statements'] = [stmt.to_dict(language, stmt_format) for stmt in
-                            Statement.objects.select_related('actor', 'verb', 'context_team', 'context_instructor', 'authority',
-                                                             'object_agent', 'object_activity', 'object_substatement')
-                            .prefetch_related('context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other')
-                            .filter(id__in=stmt_pager.page(1).object_list).order_by(stored)]
-    result['more'] = "%s/%s" % (reverse('lrs:statements_more_placeholder').lower(), cache_key)
+
+def create_stmt_result(statements, rows, limit, cursor) -> dict:
+    # rows start with the (id, stored) of each statement on the page, one
+    # extra one is queried to know if there is another page
+    result = {'statements': statements, 'more': ""}
+    if len(rows) > limit:
+        result['more'] = get_more_url(cursor, rows[limit - 1][1], rows[limit - 1][0])
     return result
 
 
-def parse_more_request(req_id):
-    # Retrieve encoded info for statements
-    encoded_info = cache.get(req_id)
-    # Could have expired or never existed
-    if not encoded_info:
-        raise NotFound("List does not exist - may have expired after 24 hours")
-    # Decode info
-    decoded_info = json.loads(encoded_info)
-
-    data = {}
-    # Info is always cached as [stmt_list, start_page, total_pages, limit,
-    # attachments, language, format]
-    data["stmt_list"] = decoded_info[0]
-    data["start_page"] = decoded_info[1]
-    data["total_pages"] = decoded_info[2]
-    data["limit"] = decoded_info[3]
-    data["attachments"] = decoded_info[4]
-    data["language"] = decoded_info[5]
-    data["format"] = decoded_info[6]
-    data["stored"] = decoded_info[7]
-
-    # Build statementResult
-    stmt_result = build_more_statement_result(req_id, **data)
-    return stmt_result, data["attachments"]
-
-# Gets called from req_process after complex_get with list of django objects and also gets called from parse_more_request when
-# more_id is used so list will be serialized
-
-
-def build_more_statement_result(more_id, **data):
-    result = {}
-    current_page = data["start_page"] + 1
-    stmt_pager = Paginator(data["stmt_list"], data["limit"])
-    result['statements'] = [stmt.to_dict(data["language"], data["format"]) for stmt in
-                            Statement.objects.select_related('actor', 'verb', 'context_team', 'context_instructor', 'authority',
-                                                             'object_agent', 'object_activity', 'object_substatement')
-                            .prefetch_related('context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other')
-                            .filter(id__in=stmt_pager.page(current_page).object_list).order_by(data["stored"])]
-
-    # If that was the last page to display then just return the remaining stmts
-    if current_page == data["total_pages"]:
-        result['more'] = ""
-        # Set current page back for when someone hits the URL again
-        current_page -= 1
-        # Retrieve list stored in cache
-        encoded_list = cache.get(more_id)
-        # Decode info to set the current page back then encode again
-        decoded_list = json.loads(encoded_list)
-        decoded_list[1] = current_page
-        encoded_list = json.dumps(decoded_list)
-        cache.set(more_id, encoded_list)
-    # There are more pages to display
+def create_raw_stmt_result(rows, limit, cursor) -> dict:
+    # rows are (id, stored, full statement JSON text), the statements are
+    # spliced into the StatementResult as they are and the body is only
+    # encoded once
+    more = ""
+    if len(rows) > limit:
+        more = get_more_url(cursor, rows[limit - 1][1], rows[limit - 1][0])
+    body = '{"statements": [%s], "more": %s}' % (", ".join(row[2] for row in rows[:limit]), json.dumps(more))
+    return {'raw': body.encode('utf-8'), 'stored': [row[1] for row in rows[:limit]], 'more': more}
+
+
+def create_streamed_stmt_result(page, limit, cursor, language, stmt_format) -> dict:
+    # The body is encoded while it is sent, only the stored time of the
+    # latest statement is needed up front for Last-Modified
+    latest = Statement.objects.filter(pk__in=page.values('pk')[:limit]).aggregate(latest=Max('stored'))['latest']
+    return {'stream': stream_stmt_result(page, limit, cursor, language, stmt_format),
+            'stored': [latest] if latest else []}
+
+
+def stream_stmt_result(page, limit, cursor, language, stmt_format):
+    # Same StatementResult as create_stmt_result, read from the database and
+    # encoded one chunk of statements at a time
+    chunk_size = settings.STATEMENT_STREAM_CHUNK_SIZE
+    rows = get_raw_rows(page) if stmt_format == 'exact' else page.values_list('id', 'stored', 'statement_id')
+    yield '{"statements": ['
+    more = ""
+    chunk = []
+    count = 0
+    for row in rows[:limit + 1].iterator(chunk_size=chunk_size):
+        # The extra statement only tells there is another page
+        if count == limit:
+            more = get_more_url(cursor, last[1], last[0])
+            break
+        chunk.append(row)
+        count += 1
+        last = row
+        if len(chunk) == chunk_size:
+            yield encode_stmt_chunk(chunk, count == len(chunk), language, stmt_format)
+            chunk = []
+    if chunk:
+        yield encode_stmt_chunk(chunk, count == len(chunk), language, stmt_format)
+    yield '], "more": %s}' % json.dumps(more)
+
+
+def encode_stmt_chunk(rows, first, language, stmt_format):
+    if stmt_format == 'exact':
+        statements = [row[2] for row in rows]
     else:
-        # Create cache key from hashed data (always 32 digits)
-        cache_key = create_cache_key()
-        result['more'] = "%s/%s" % (reverse('lrs:statements_more_placeholder').lower(), cache_key)
-
-        more_cache_list = []
-        # Increment next page
-        start_page = current_page
-        more_cache_list.append(data["stmt_list"])
-        more_cache_list.append(start_page)
-        more_cache_list.append(data["total_pages"])
-        more_cache_list.append(data["limit"])
-        more_cache_list.append(data["attachments"])
-        more_cache_list.append(data["language"])
-        more_cache_list.append(data["format"])
-        more_cache_list.append(data["stored"])
-        # Encode info
-        encoded_list = json.dumps(more_cache_list)
-        cache.set(cache_key, encoded_list)
-    return result
+        statements = [json.dumps(stmt) for stmt in render_rows(rows, language, stmt_format)]
+    return ("" if first else ", ") + ", ".join(statements)
+
+
+def get_more_url(cursor, stored, pk):
+    cursor = dict(cursor, position=[stored.isoformat(), pk])
+    return "%s/%s" % (reverse('lrs:statements_more_placeholder').lower(),
+                      signing.dumps(cursor, salt=MORE_CURSOR_SALT, compress=True))
+
+
+def parse_more_request(req_id):
+    # The more id is the signed cursor itself, so there is nothing to look up
+    # and it never expires
+    try:
+        cursor = signing.loads(req_id, salt=MORE_CURSOR_SALT)
+    except signing.BadSignature:
+        raise NotFound("List does not exist")
+
+    param_dict = dict(cursor['params'])
+    if cursor['mine_only']:
+        param_dict['auth'] = {'agent': Agent.objects.get(pk=cursor['mine_only']), 'statements_mine_only': True}
+    stmt_result = complex_get(param_dict, cursor['limit'], cursor['language'], cursor['format'],
+                              cursor['attachments'], cursor)
+    return stmt_result, cursor['attachments']
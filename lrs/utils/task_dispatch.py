@@ -0,0 +1,142 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class TaskDispatcher(object):
+    """
+    Buffers the statement IDs of tasks that take a list of them and sends
+    them to the broker in batches from a background thread, every
+    TASK_DISPATCH_INTERVAL seconds or once TASK_DISPATCH_BATCH_SIZE IDs are
+    waiting for a task, so requests never wait on the broker. IDs are only
+    buffered once the transaction that stored the statements commits.
+
+    Batches the broker doesn't take are run on a thread pool in this process,
+    and for TASK_DISPATCH_RETRY_INTERVAL seconds after that the broker isn't
+    tried again. At exit the IDs still waiting are sent, and run right here
+    if the broker doesn't take them since the pool is shut down by then.
+    """
+
+    def __init__(self):
+        # task name -> (task, [statement IDs])
+        self.pending = {}
+        self.pid = None
+        self.pool = None
+        self.wakeup = threading.Event()
+        self.broker_down_until = 0
+        self.published = 0
+        self.ran_locally = 0
+        self.exiting = False
+        self._lock = threading.Lock()
+        # Held while batches are sent, exit waits for the ones the thread has
+        self._flush_lock = threading.Lock()
+        atexit.register(self.exit)
+
+    def dispatch(self, task, stmt_ids):
+        ids = [str(st) for st in stmt_ids]
+        if ids:
+            transaction.on_commit(lambda: self.add(task, ids))
+
+    def add(self, task, ids):
+        if not settings.TASK_DISPATCH_INTERVAL:
+            self.send(task, ids)
+            return
+        with self._lock:
+            self.start()
+            pending = self.pending.setdefault(task.name, (task, []))[1]
+            pending.extend(ids)
+            full = len(pending) >= settings.TASK_DISPATCH_BATCH_SIZE
+        if full:
+            self.wakeup.set()
+
+    def start(self):
+        # Threads don't survive a fork, so a process forked after IDs were
+        # dispatched starts its own and leaves the parent's IDs to the parent
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.pending = {}
+        self.pool = None
+        self.wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        threading.Thread(target=self.run, name='task-dispatch', daemon=True).start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(settings.TASK_DISPATCH_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not dispatch statement tasks")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self.pending = self.pending, {}
+            size = settings.TASK_DISPATCH_BATCH_SIZE
+            for task, ids in pending.values():
+                for start in range(0, len(ids), size):
+                    self.send(task, ids[start:start + size])
+
+    def exit(self):
+        # IDs buffered before a fork are the parent's to send
+        if self.pid != os.getpid():
+            return
+        self.exiting = True
+        self.flush()
+
+    def send(self, task, ids):
+        if time.monotonic() >= self.broker_down_until:
+            try:
+                task.delay(ids)
+            except Exception:
+                logger.exception("Could not publish %s, running it in this process" % task.name)
+                self.broker_down_until = time.monotonic() + settings.TASK_DISPATCH_RETRY_INTERVAL
+            else:
+                with self._lock:
+                    self.published += 1
+                return
+        self.run_locally(task, ids)
+
+    def run_locally(self, task, ids):
+        with self._lock:
+            if self.pool is None and not self.exiting:
+                self.pool = ThreadPoolExecutor(max_workers=settings.TASK_DISPATCH_FALLBACK_WORKERS,
+                                               thread_name_prefix='task-fallback')
+            self.ran_locally += 1
+            pool = self.pool
+        if not self.exiting:
+            try:
+                pool.submit(run_task, task, ids)
+                return
+            except RuntimeError:
+                # The pool takes no more work once the interpreter is exiting
+                pass
+        run_task(task, ids)
+
+    def stats(self):
+        with self._lock:
+            return {'pending': sum(len(ids) for _, ids in self.pending.values()),
+                    'published': self.published, 'ran_locally': self.ran_locally}
+
+
+def run_task(task, ids):
+    try:
+        task(ids)
+    except Exception:
+        logger.exception("Statement task %s failed" % task.name)
+    finally:
+        # Connections opened on a pool thread would otherwise stay open
+        connections.close_all()
+
+
+task_dispatcher = TaskDispatcher()
@@ -0,0 +1,262 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+# Returned by the tiers when a key isn't there, None can be a cached value
+MISSING = object()
+
+# In-process tiers by LOCATION. caches makes a backend instance per thread,
+# and like LocMemCache's stores every instance in the process shares these
+_local_tiers = {}
+
+
+class LocalTier(object):
+    # key -> (pickled value, expiry), least recently used first
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.RLock()
+        self.counts = dict.fromkeys(['local_hits', 'shared_hits', 'spool_hits', 'misses', 'evictions', 'spooled'], 0)
+
+
+class TieredCache(BaseCache):
+    """
+    Cache backend with a bounded in-process LRU in front of a cache every
+    worker shares. Values pickled to more than SPOOL_THRESHOLD bytes skip the
+    LRU and go to a separate spool cache instead of the shared one, normally a
+    FileBasedCache on local disk, so large values don't get written to the
+    database or push everything else out of memory.
+
+    OPTIONS:
+        SHARED           alias of the shared cache
+        SPOOL            alias of the cache for large values, optional
+        SPOOL_THRESHOLD  pickled size in bytes above which values are spooled
+        LOCAL_MAX_SIZE   pickled bytes the in-process LRU holds
+        LOCAL_TIMEOUT    seconds at most a value is served from the LRU
+
+    The LRU is shared by every thread of the process, by LOCATION. A value
+    changed by another worker is only seen here once the local copy expires,
+    so it suits caches whose readers check what they get, like the stamped
+    statement renders.
+
+    A spooled value deletes its key from the shared tier, which is read
+    first. A value that fits in the shared tier doesn't delete its key from
+    the spool: the shared copy is read instead, and an old spooled copy is
+    only seen if the shared one is culled before it expires.
+
+    get_many and set_many make one call to each tier, so a shared cache that
+    batches them, like BatchedDatabaseCache, costs one read and one write
+    per page of values, and a delete when some of them are spooled.
+    """
+
+    def __init__(self, location, params):
+        super(TieredCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self.shared_alias = options['SHARED']
+        self.spool_alias = options.get('SPOOL', None)
+        self.spool_threshold = int(options.get('SPOOL_THRESHOLD', 256 * 1024))
+        self.local_max_size = int(options.get('LOCAL_MAX_SIZE', 32 * 1024 * 1024))
+        self.local_timeout = int(options.get('LOCAL_TIMEOUT', 300))
+        self._local = _local_tiers.setdefault(location, LocalTier())
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias]
+
+    @property
+    def spool(self):
+        return caches[self.spool_alias] if self.spool_alias else None
+
+    def get_read_tiers(self):
+        tiers = [('shared', self.shared)]
+        if self.spool_alias:
+            tiers.append(('spool', self.spool))
+        return tiers
+
+    def is_spooled(self, size):
+        return bool(self.spool_alias) and size > self.spool_threshold
+
+    def get_tier(self, spooled):
+        return self.spool if spooled else self.shared
+
+    def get_timeout(self, timeout):
+        return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+    def get_local_expiry(self, timeout):
+        timeout = self.get_timeout(timeout)
+        if timeout is None:
+            return time.monotonic() + self.local_timeout
+        return time.monotonic() + min(timeout, self.local_timeout)
+
+    def count(self, name, n=1):
+        with self._local.lock:
+            self._local.counts[name] += n
+
+    def local_get(self, key):
+        local = self._local
+        with local.lock:
+            entry = local.entries.get(key, None)
+            if entry is None:
+                return MISSING
+            if entry[1] <= time.monotonic():
+                self.local_delete(key)
+                return MISSING
+            local.entries.move_to_end(key)
+            local.counts['local_hits'] += 1
+            return pickle.loads(entry[0])
+
+    def local_set(self, key, data, expiry):
+        local = self._local
+        with local.lock:
+            self.local_delete(key)
+            if len(data) > self.spool_threshold or len(data) > self.local_max_size:
+                return
+            local.entries[key] = (data, expiry)
+            local.size += len(data)
+            while local.size > self.local_max_size:
+                _, (old, _) = local.entries.popitem(last=False)
+                local.size -= len(old)
+                local.counts['evictions'] += 1
+
+    def local_delete(self, key):
+        local = self._local
+        with local.lock:
+            entry = local.entries.pop(key, None)
+            if entry is not None:
+                local.size -= len(entry[0])
+            return entry is not None
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_key(key, version=version)
+        self.validate_key(local_key)
+        if self.local_get(local_key) is not MISSING:
+            return False
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        spooled = self.is_spooled(len(data))
+        other = self.shared if spooled else self.spool
+        if other is not None and other.has_key(key, version=version):
+            return False
+        if not self.get_tier(spooled).add(key, value, self.get_timeout(timeout), version=version):
+            return False
+        self.local_set(local_key, data, self.get_local_expiry(timeout))
+        return True
+
+    def get(self, key, default=None, version=None):
+        local_key = self.make_key(key, version=version)
+        self.validate_key(local_key)
+        value = self.local_get(local_key)
+        if value is not MISSING:
+            return value
+        for name, tier in self.get_read_tiers():
+            value = tier.get(key, MISSING, version=version)
+            if value is not MISSING:
+                self.record_hit(name)
+                # The tier's own expiry isn't known, so it gets the full local one
+                self.local_set(local_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                               self.get_local_expiry(None))
+                return value
+        self.count('misses')
+        return default
+
+    def get_many(self, keys, version=None):
+        found = {}
+        remaining = []
+        for key in keys:
+            value = self.local_get(self.make_key(key, version=version))
+            if value is not MISSING:
+                found[key] = value
+            else:
+                remaining.append(key)
+        # One round trip per tier for everything the LRU didn't have
+        for name, tier in self.get_read_tiers():
+            if not remaining:
+                break
+            values = tier.get_many(remaining, version=version)
+            for key, value in values.items():
+                self.record_hit(name)
+                self.local_set(self.make_key(key, version=version), pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                               self.get_local_expiry(None))
+                found[key] = value
+            remaining = [key for key in remaining if key not in values]
+        self.count('misses', len(remaining))
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_key(key, version=version)
+        self.validate_key(local_key)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        spooled = self.is_spooled(len(data))
+        self.get_tier(spooled).set(key, value, self.get_timeout(timeout), version=version)
+        if spooled:
+            # A copy left in the shared tier would be read instead
+            self.shared.delete(key, version=version)
+            self.count('spooled')
+        self.local_set(local_key, data, self.get_local_expiry(timeout))
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        by_tier = {}
+        expiry = self.get_local_expiry(timeout)
+        for key, value in data.items():
+            local_key = self.make_key(key, version=version)
+            self.validate_key(local_key)
+            pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            by_tier.setdefault(self.is_spooled(len(pickled)), {})[key] = value
+            self.local_set(local_key, pickled, expiry)
+        failed = []
+        for spooled, values in by_tier.items():
+            failed.extend(self.get_tier(spooled).set_many(values, self.get_timeout(timeout), version=version) or [])
+            if spooled:
+                # Copies left in the shared tier would be read instead
+                self.shared.delete_many(list(values), version=version)
+                self.count('spooled', len(values))
+        for key in failed:
+            self.local_delete(self.make_key(key, version=version))
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_key(key, version=version)
+        with self._local.lock:
+            entry = self._local.entries.get(local_key, None)
+            if entry is not None:
+                self._local.entries[local_key] = (entry[0], self.get_local_expiry(timeout))
+        touched = False
+        for _, tier in self.get_read_tiers():
+            touched = tier.touch(key, self.get_timeout(timeout), version=version) or touched
+        return touched
+
+    def delete(self, key, version=None):
+        local_key = self.make_key(key, version=version)
+        self.validate_key(local_key)
+        deleted = self.local_delete(local_key)
+        for _, tier in self.get_read_tiers():
+            deleted = tier.delete(key, version=version) or deleted
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        for key in keys:
+            self.local_delete(self.make_key(key, version=version))
+        for _, tier in self.get_read_tiers():
+            tier.delete_many(keys, version=version)
+
+    def clear(self):
+        self.clear_local()
+        for _, tier in self.get_read_tiers():
+            tier.clear()
+
+    def clear_local(self):
+        with self._local.lock:
+            self._local.entries.clear()
+            self._local.size = 0
+
+    def record_hit(self, name):
+        self.count('%s_hits' % name)
+
+    def stats(self):
+        with self._local.lock:
+            return dict(self._local.counts, local_entries=len(self._local.entries), local_size=self._local.size)
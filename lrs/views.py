@@ -8,7 +8,7 @@ from django.core.exceptions import SuspiciousOperation
 from django.utils.decorators import decorator_from_middleware
 from django.views.decorators.http import require_http_methods
 
-from .exceptions import BadRequest, Unauthorized, Forbidden, NotFound, Conflict, PreconditionFail, OauthUnauthorized, OauthBadRequest
+from .exceptions import BadRequest, Unauthorized, Forbidden, NotFound, Conflict, PreconditionFail, RequestEntityTooLarge, OauthUnauthorized, OauthBadRequest
 from .utils import req_validate, req_parse, req_process, XAPIVersionHeaderMiddleware, XAPIConsistentThroughMiddleware
 
 # This uses the lrs logger for LRS specific information
@@ -118,8 +118,20 @@ def agents(request):
     return handle_request(request)
 
 
-@transaction.atomic
+# Methods that only read, the alternate request syntax is always a POST
+READ_METHODS = ['GET', 'HEAD']
+
+
 def handle_request(request, more_id=None):
+    # Reads run in autocommit instead of paying for a transaction, everything
+    # else is atomic
+    if request.method in READ_METHODS:
+        return dispatch_request(request, more_id)
+    with transaction.atomic():
+        return dispatch_request(request, more_id)
+
+
+def dispatch_request(request, more_id=None):
 
     validators = {
         reverse('lrs:statements').lower(): {
@@ -243,6 +255,10 @@ def handle_request(request, more_id=None):
         status = 412
         log_exception(status, request.path)
         response = HttpResponse(str(pf), status=status)
+    except RequestEntityTooLarge as tl:
+        status = 413
+        log_exception(status, request.path)
+        response = HttpResponse(str(tl), status=status)
     except Exception as err:
         status = 500
         log_exception(status, request.path)
@@ -98,5 +98,9 @@ class CheckOauth(object):
         if token.user:
             request.user = token.user
 
+        # LRS CHANGE - KEEP THE CONSUMER AND TOKEN SO THE LRS DOESN'T LOOK THEM UP AGAIN
+        request.oauth_consumer = consumer
+        request.oauth_token = token
+
         return (None, None)
 oauth_required = CheckOauth
@@ -6,6 +6,7 @@ from time import time
 import oauth2 as oauth
 from Crypto.PublicKey import RSA
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 
 from oauth_provider.compat import AUTH_USER_MODEL, get_random_string
 from oauth_provider.managers import TokenManager
@@ -13,6 +14,8 @@ from oauth_provider.consts import KEY_SIZE, RSA_SECRET_SIZE, CONSUMER_KEY_SIZE,
     PENDING, VERIFIER_SIZE, MAX_URL_LENGTH, OUT_OF_BAND, REGULAR_SECRET_SIZE
 from oauth_provider.utils import check_valid_callback
 
+from lrs.utils.lookup_cache import oauth_cache
+
 
 class Nonce(models.Model):
     token_key = models.CharField(max_length=KEY_SIZE)
@@ -20,6 +23,10 @@ class Nonce(models.Model):
     key = models.CharField(max_length=255)
     timestamp = models.PositiveIntegerField(db_index=True)
 
+    # LRS CHANGE - UNIQUE SO A NONCE CAN BE CHECKED WITH ONE INSERT
+    class Meta:
+        unique_together = ('consumer_key', 'token_key', 'key', 'timestamp')
+
     def __unicode__(self):
         return "Nonce %s for %s" % (self.key, self.consumer_key)
 
@@ -186,3 +193,15 @@ class Token(models.Model):
 
     def key_partial(self):
         return self.key[:10]
+
+
+# LRS CHANGE - CACHED CONSUMERS AND ACCESS TOKENS GO WHENEVER ONE CHANGES, REQUEST
+# TOKENS ARE NEVER CACHED
+def invalidate_oauth_cache(sender, instance, **kwargs):
+    if sender is not Token or instance.token_type == Token.ACCESS:
+        oauth_cache.invalidate()
+
+post_save.connect(invalidate_oauth_cache, sender=Consumer)
+post_delete.connect(invalidate_oauth_cache, sender=Consumer)
+post_save.connect(invalidate_oauth_cache, sender=Token)
+post_delete.connect(invalidate_oauth_cache, sender=Token)
@@ -1,12 +1,19 @@
+import heapq
+import threading
+import time
+
 import oauth2 as oauth
 
 from django.conf import settings
-from oauth_provider.compat import now
+from django.contrib.auth.models import User
 
 from oauth_provider.store import InvalidConsumerError, InvalidTokenError, Store
 from oauth_provider.models import Nonce, Token, Consumer, VERIFIER_SIZE
 
+from lrs.utils.lookup_cache import oauth_cache
+
 NONCE_VALID_PERIOD = getattr(settings, "OAUTH_NONCE_VALID_PERIOD", None)
+NONCE_SWEEP_INTERVAL = getattr(settings, "OAUTH_NONCE_SWEEP_INTERVAL", 60)
 SCOPES = [x[1] for x in settings.OAUTH_SCOPES]
 
 
@@ -16,11 +23,17 @@ class ModelStore(Store):
     """
 
     def get_consumer(self, request, oauth_request, consumer_key):
+        # LRS CHANGE - ACCEPTED CONSUMERS ARE CACHED WITH THEIR USER
+        consumer = oauth_cache.get_with_user(Consumer, User, ('consumer', consumer_key))
+        if consumer is not None:
+            return consumer
         try:
             # LRS CHANGE - ADDED STATUS OF CONSUMER TO BE ACCEPTED
-            return Consumer.objects.get(key=consumer_key, status=2)
+            consumer = Consumer.objects.select_related('user').get(key=consumer_key, status=2)
         except Consumer.DoesNotExist:
             raise InvalidConsumerError()
+        oauth_cache.set_with_user(('consumer', consumer_key), consumer)
+        return consumer
 
     def get_consumer_for_request_token(self, request, oauth_request, request_token):
         return request_token.consumer
@@ -85,11 +98,19 @@ class ModelStore(Store):
         return access_token
 
     def get_access_token(self, request, oauth_request, consumer, access_token_key):
-        try:
-            # LRS CHANGE - ADDED IS_APPROVED PARAM TO BE SURE
-            return Token.objects.get(key=access_token_key, token_type=Token.ACCESS, is_approved=True)
-        except Token.DoesNotExist:
-            raise InvalidTokenError()
+        # LRS CHANGE - APPROVED ACCESS TOKENS ARE CACHED WITH THEIR USER
+        token = oauth_cache.get_with_user(Token, User, ('token', access_token_key))
+        if token is None:
+            try:
+                # LRS CHANGE - ADDED IS_APPROVED PARAM TO BE SURE
+                token = Token.objects.select_related('user').get(
+                    key=access_token_key, token_type=Token.ACCESS, is_approved=True)
+            except Token.DoesNotExist:
+                raise InvalidTokenError()
+            oauth_cache.set_with_user(('token', access_token_key), token)
+        if consumer is not None and token.consumer_id == consumer.pk:
+            token.consumer = consumer
+        return token
 
     def get_user_for_access_token(self, request, oauth_request, access_token):
         return access_token.user
@@ -100,12 +121,63 @@ class ModelStore(Store):
     def check_nonce(self, request, oauth_request, nonce, timestamp=0):
         timestamp = int(timestamp)
 
-        if NONCE_VALID_PERIOD and int(now().strftime("%s")) - timestamp > NONCE_VALID_PERIOD:
+        if NONCE_VALID_PERIOD and int(time.time()) - timestamp > NONCE_VALID_PERIOD:
             return False
 
+        # LRS CHANGE - NONCES USED ON THIS PROCESS ARE TURNED AWAY WITHOUT A QUERY,
+        # ANY OTHER IS STORED, AN EXISTING ROW MEANS ANOTHER PROCESS HAD IT
+        consumer_key = oauth_request['oauth_consumer_key']
+        token_key = oauth_request.get('oauth_token', '')
+        if not nonce_store.add((consumer_key, token_key, nonce, timestamp), timestamp):
+            return False
         nonce, created = Nonce.objects.get_or_create(
-            consumer_key=oauth_request['oauth_consumer_key'],
-            token_key=oauth_request.get('oauth_token', ''),
+            consumer_key=consumer_key,
+            token_key=token_key,
             key=nonce, timestamp=timestamp,
         )
         return created
+
+
+class NonceStore(object):
+    """
+    LRS CHANGE - Nonces seen by this process, each kept until its timestamp is
+    older than OAUTH_NONCE_VALID_PERIOD. A timestamp further than that from
+    now either way is turned away, so nothing is kept longer. The Nonce table
+    is swept of expired rows every OAUTH_NONCE_SWEEP_INTERVAL seconds.
+    """
+
+    def __init__(self, period, sweep_interval):
+        self.period = period
+        self.sweep_interval = sweep_interval
+        self.last_sweep = None
+        self._expiries = {}
+        # (expiry, key) in expiry order
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def add(self, key, timestamp):
+        # False if the nonce was already used or its timestamp is out of range
+        if not self.period:
+            return True
+        current = time.time()
+        if abs(current - timestamp) > self.period:
+            return False
+        with self._lock:
+            while self._heap and self._heap[0][0] <= current:
+                expiry, expired = heapq.heappop(self._heap)
+                if self._expiries.get(expired) == expiry:
+                    del self._expiries[expired]
+            if key in self._expiries:
+                return False
+            expiry = timestamp + self.period
+            self._expiries[key] = expiry
+            heapq.heappush(self._heap, (expiry, key))
+            sweep = self.last_sweep is None or current - self.last_sweep > self.sweep_interval
+            if sweep:
+                self.last_sweep = current
+        if sweep:
+            Nonce.objects.filter(timestamp__lt=int(current) - self.period).delete()
+        return True
+
+
+nonce_store = NonceStore(NONCE_VALID_PERIOD, NONCE_SWEEP_INTERVAL)
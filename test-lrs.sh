@@ -1,4 +1,7 @@
 #!/bin/bash
 
 cp settings.ini.example adl_lrs/settings.ini
-python3 -m unittest discover -s ./lrs/tests -p "test_*.py" -t .
+# Same log folders and migrations fabfile sets up
+mkdir -p ../logs/celery
+python3 manage.py makemigrations adl_lrs lrs oauth_provider
+python3 manage.py test lrs.tests --noinput